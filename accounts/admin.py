@@ -1,6 +1,7 @@
 from django.contrib import admin
-from accounts.models import Invoice, InvoiceRow, Expense
+from accounts.models import Invoice, InvoiceRow, Expense, SalesLedgerEntry
 
 admin.site.register(Expense)
 admin.site.register(Invoice)
 admin.site.register(InvoiceRow)
+admin.site.register(SalesLedgerEntry)
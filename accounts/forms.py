@@ -1,6 +1,6 @@
 from django.forms import ModelForm
 from accounts.models import Expense, Invoice, InvoiceRow, INVOICE_STATE_PAID, \
-    MAX_INVOICE_ID
+    MAX_INVOICE_ID, INVOICE_STATE
 from django import forms
 from django.utils.translation import ugettext_lazy as _
 
@@ -15,6 +15,12 @@ class ExpenseForm(ModelForm):
         super(ExpenseForm, self).__init__(*args, **kwargs)
         self.fields['date'].widget.attrs['class'] = 'date'
 
+INVOICE_STATE_SEARCH = (('', '-------------'),) + INVOICE_STATE
+
+class InvoiceSearchForm(forms.Form):
+    customer = forms.CharField(label=_('Customer'), required=False)
+    state = forms.ChoiceField(label=_('State'), required=False, choices=INVOICE_STATE_SEARCH)
+
 class InvoiceForm(ModelForm):
     invoice_id = forms.IntegerField(max_value=MAX_INVOICE_ID,
                                     label=_('Invoice id'),
@@ -0,0 +1,38 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from project.models import Proposal, PROPOSAL_INVOICING_FIELDS
+from accounts.models import get_proposals_invoicing, update_proposals_invoicing
+
+class Command(BaseCommand):
+    args = '[username ...]'
+    help = 'Check invoiced amounts of proposals against invoice rows (all users if none given)'
+    option_list = BaseCommand.option_list + (
+        make_option('--fix', action='store_true', dest='fix', default=False,
+                    help='Recompute invoiced amounts which are wrong'),
+    )
+
+    def handle(self, *args, **options):
+        users = User.objects.all()
+        if args:
+            users = users.filter(username__in=args)
+
+        wrong_ids = set()
+        for user_id in users.values_list('id', flat=True):
+            proposal_values = Proposal.objects.filter(owner=user_id).values('id', *PROPOSAL_INVOICING_FIELDS).order_by()
+            expected_values = get_proposals_invoicing([values['id'] for values in proposal_values])
+            for values in proposal_values:
+                expected = expected_values[values['id']]
+                for field_name in PROPOSAL_INVOICING_FIELDS:
+                    if values[field_name] != expected[field_name]:
+                        self.stdout.write("Proposal %i: %s is %s instead of %s.\n" % (values['id'],
+                                                                                     field_name,
+                                                                                     values[field_name],
+                                                                                     expected[field_name]))
+                        wrong_ids.add(values['id'])
+
+        if options['fix'] and wrong_ids:
+            update_proposals_invoicing(wrong_ids)
+            self.stdout.write("%i proposal(s) fixed.\n" % (len(wrong_ids)))
+        else:
+            self.stdout.write("%i proposal(s) with wrong invoiced amounts.\n" % (len(wrong_ids)))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from accounts.models import SalesLedgerEntry
+
+class Command(BaseCommand):
+    args = '[username ...]'
+    help = 'Rebuild monthly sales ledger from invoices (all users if none given)'
+
+    def handle(self, *args, **options):
+        users = User.objects.all()
+        if args:
+            users = users.filter(username__in=args)
+
+        i = 0
+        for user_id in users.values_list('id', flat=True):
+            SalesLedgerEntry.objects.rebuild(user_id)
+            i = i + 1
+
+        self.stdout.write("Sales ledger rebuilt for %i user(s).\n" % (i))
@@ -5,16 +5,20 @@ import datetime
 from reportlab.platypus import Paragraph, Spacer
 from reportlab.lib.units import inch
 from reportlab.platypus import Table, TableStyle
-from django.db import models, connection
+from django.db import models, connection, transaction, IntegrityError
+from django.db.backends.util import typecast_date
 from core.models import OwnedObject
 from django.utils.translation import ugettext_lazy as _, ugettext
 from contact.models import Contact
 from django.core.urlresolvers import reverse
-from project.models import Row, Proposal, update_row_amount, \
+from project.models import Row, Proposal, update_row_amount, defer_amount_update, \
     ROW_CATEGORY_SERVICE, ROW_CATEGORY, PROPOSAL_STATE_ACCEPTED, ProposalRow, \
-    VAT_RATES_2_1, VAT_RATES_5_5, VAT_RATES_19_6
+    VAT_RATES
 from django.db.models.aggregates import Sum, Min, Max
-from django.db.models.signals import post_save, pre_save, post_delete
+from django.db.models.signals import post_save, pre_save, post_delete, post_init
+from django.db.models.query_utils import Q
+from django.db.models.expressions import F
+from django.contrib.auth.models import User
 from django.core.validators import MaxValueValidator
 from accounts.utils.pdf import InvoiceTemplate
 
@@ -57,9 +61,143 @@ INVOICE_STATE = ((INVOICE_STATE_EDITED, _('Edited')),
               (INVOICE_STATE_SENT, _('Sent')),
               (INVOICE_STATE_PAID, _('Paid')))
 
+def to_decimal(value):
+    """
+    Raw cursors return floats on some backends (sqlite), Decimal on others
+    """
+    if value is None:
+        return Decimal(0)
+    if isinstance(value, Decimal):
+        return value
+    return Decimal(str(value))
+
+def get_natures(categories):
+    """
+    Bitmask of row categories stored in Invoice.natures
+    """
+    natures = 0
+    for category in categories:
+        natures |= 1 << (category - 1)
+    return natures
+
+class SalesSummary(object):
+    """
+    Sales figures displayed on the dashboard, computed for an owner
+    in a constant number of queries by InvoiceManager.get_sales_summary
+    """
+    def __init__(self, reference_date):
+        self.reference_date = reference_date
+        self.paid = Decimal(0)
+        self.paid_previous_year = Decimal(0)
+        self.waiting = Decimal(0)
+        self.service_paid = Decimal(0)
+        self.service_paid_previous_year = Decimal(0)
+        self.service_waiting = Decimal(0)
+        self.to_be_invoiced = Decimal(0)
+        self.service_to_be_invoiced = Decimal(0)
+        self.first_invoice_paid_date = None
+
+    def get_total(self):
+        return self.paid + self.waiting + self.to_be_invoiced
+
+    def get_service_total(self):
+        return self.service_paid + self.service_waiting + self.service_to_be_invoiced
+
+    total = property(get_total)
+    service_total = property(get_service_total)
+
 class InvoiceManager(models.Manager):
+    def get_sales_summary(self, owner, reference_date=None):
+        """
+        Computes paid, waiting and to be invoiced sales (and their service
+        part) for the current and previous year with conditional sums
+        instead of one aggregate query per figure
+        """
+        if not reference_date:
+            reference_date = datetime.date.today()
+        year_begin = datetime.date(reference_date.year, 1, 1)
+        previous_year_begin = datetime.date(reference_date.year - 1, 1, 1)
+        previous_year_end = datetime.date(reference_date.year - 1, 12, 31)
+        summary = SalesSummary(reference_date)
+        cursor = connection.cursor()
+
+        cursor.execute('SELECT SUM(CASE WHEN i.state = %s AND i.paid_date >= %s AND i.paid_date <= %s THEN i.amount ELSE 0 END),'
+                       ' SUM(CASE WHEN i.state = %s AND i.paid_date >= %s AND i.paid_date <= %s THEN i.amount ELSE 0 END),'
+                       ' SUM(CASE WHEN i.state = %s THEN i.amount ELSE 0 END),'
+                       ' MIN(i.paid_date)'
+                       ' FROM accounts_invoice i JOIN core_ownedobject o ON i.ownedobject_ptr_id = o.id'
+                       ' WHERE o.owner_id = %s',
+                       [INVOICE_STATE_PAID, year_begin, reference_date,
+                        INVOICE_STATE_PAID, previous_year_begin, previous_year_end,
+                        INVOICE_STATE_SENT,
+                        owner.id])
+        row = cursor.fetchone()
+        summary.paid = to_decimal(row[0])
+        summary.paid_previous_year = to_decimal(row[1])
+        summary.waiting = to_decimal(row[2])
+        summary.first_invoice_paid_date = row[3]
+        if isinstance(summary.first_invoice_paid_date, basestring):
+            summary.first_invoice_paid_date = typecast_date(summary.first_invoice_paid_date)
+
+        cursor.execute('SELECT SUM(CASE WHEN i.state = %s AND r.category = %s AND i.paid_date >= %s AND i.paid_date <= %s THEN r.amount ELSE 0 END),'
+                       ' SUM(CASE WHEN i.state = %s AND r.category = %s AND i.paid_date >= %s AND i.paid_date <= %s THEN r.amount ELSE 0 END),'
+                       ' SUM(CASE WHEN i.state = %s AND r.category = %s THEN r.amount ELSE 0 END),'
+                       ' SUM(CASE WHEN i.state <> %s AND p.balanced_by_sent_invoice = %s THEN r.amount ELSE 0 END),'
+                       ' SUM(CASE WHEN i.state = %s AND r.proposal_id IS NULL THEN r.amount ELSE 0 END),'
+                       ' SUM(CASE WHEN i.state <> %s AND p.state = %s AND r.category = %s AND p.balanced_by_sent_invoice = %s THEN r.amount ELSE 0 END)'
+                       ' FROM accounts_invoicerow r JOIN core_ownedobject o ON r.ownedobject_ptr_id = o.id'
+                       ' JOIN accounts_invoice i ON r.invoice_id = i.ownedobject_ptr_id'
+                       ' LEFT OUTER JOIN project_proposal p ON r.proposal_id = p.ownedobject_ptr_id'
+                       ' WHERE o.owner_id = %s',
+                       [INVOICE_STATE_PAID, ROW_CATEGORY_SERVICE, year_begin, datetime.date(reference_date.year, 12, 31),
+                        INVOICE_STATE_PAID, ROW_CATEGORY_SERVICE, previous_year_begin, previous_year_end,
+                        INVOICE_STATE_SENT, ROW_CATEGORY_SERVICE,
+                        INVOICE_STATE_EDITED, False,
+                        INVOICE_STATE_EDITED,
+                        INVOICE_STATE_EDITED, PROPOSAL_STATE_ACCEPTED, ROW_CATEGORY_SERVICE, False,
+                        owner.id])
+        row = cursor.fetchone()
+        summary.service_paid = to_decimal(row[0])
+        summary.service_paid_previous_year = to_decimal(row[1])
+        summary.service_waiting = to_decimal(row[2])
+        invoiced_from_proposals = to_decimal(row[3])
+        invoiced_without_proposals = to_decimal(row[4])
+        service_invoiced_from_proposals = to_decimal(row[5])
+
+        cursor.execute('SELECT (SELECT SUM(p.amount) FROM project_proposal p JOIN core_ownedobject o ON p.ownedobject_ptr_id = o.id'
+                       '         WHERE o.owner_id = %s AND p.state = %s AND p.balanced_by_sent_invoice = %s),'
+                       ' (SELECT SUM(pr.amount) FROM project_proposalrow pr JOIN core_ownedobject o ON pr.ownedobject_ptr_id = o.id'
+                       '  JOIN project_proposal p ON pr.proposal_id = p.ownedobject_ptr_id'
+                       '  WHERE o.owner_id = %s AND p.state = %s AND pr.category = %s AND p.balanced_by_sent_invoice = %s)',
+                       [owner.id, PROPOSAL_STATE_ACCEPTED, False,
+                        owner.id, PROPOSAL_STATE_ACCEPTED, ROW_CATEGORY_SERVICE, False])
+        row = cursor.fetchone()
+        summary.to_be_invoiced = to_decimal(row[0]) - invoiced_from_proposals + invoiced_without_proposals
+        summary.service_to_be_invoiced = to_decimal(row[1]) - service_invoiced_from_proposals
+
+        return summary
+
+    def annotate_rows(self, invoices):
+        """
+        Adds the vat of their rows to invoices, fetched by the
+        query of invoices and used by get_vat
+        """
+        return invoices.extra(select={'rows_vat': 'SELECT SUM(r.amount * r.vat_rate / 100) FROM accounts_invoicerow r'
+                                                  ' WHERE r.invoice_id = accounts_invoice.ownedobject_ptr_id'})
+
     def get_next_invoice_id(self, owner):
-        return (Invoice.objects.filter(owner=owner).aggregate(invoice_id=Max('invoice_id'))['invoice_id'] or 0) + 1
+        last_invoice_ids = InvoiceIdSequence.objects.filter(owner=owner).values_list('last_invoice_id', flat=True)
+        return (last_invoice_ids and last_invoice_ids[0] or 0) + 1
+
+    def allocate_invoice_id(self, owner):
+        """
+        Reserves the next invoice id of owner. The sequence row stays
+        locked by the update until the end of the transaction, so
+        concurrent allocations wait and get distinct ids
+        """
+        InvoiceIdSequence.objects.get_or_create(owner=owner)
+        InvoiceIdSequence.objects.filter(owner=owner).update(last_invoice_id=F('last_invoice_id') + 1)
+        return InvoiceIdSequence.objects.get(owner=owner).last_invoice_id
 
     def get_paid_sales(self, owner, reference_date=None):
         if not reference_date:
@@ -154,11 +292,10 @@ class InvoiceManager(models.Manager):
 
     def get_to_be_invoiced(self, owner):
         accepted_proposal_amount_sum = Proposal.objects.filter(state=PROPOSAL_STATE_ACCEPTED,
-                                                   owner=owner).extra(where=['project_proposal.ownedobject_ptr_id NOT IN (SELECT proposal_id FROM accounts_invoicerow irow JOIN accounts_invoice i ON irow.invoice_id = i.ownedobject_ptr_id WHERE i.state IN (%s,%s) AND irow.balance_payments = %s)'],
-                                                                                 params=[INVOICE_STATE_SENT, INVOICE_STATE_PAID, True]).aggregate(amount=Sum('amount'))
+                                                               balanced_by_sent_invoice=False,
+                                                               owner=owner).aggregate(amount=Sum('amount'))
         # exclude amount found in sent or paid invoices referencing accepted proposal, aka computing already invoiced from not sold proposal
-        invoicerows_to_exclude = InvoiceRow.objects.extra(where=['accounts_invoicerow.proposal_id NOT IN (SELECT proposal_id FROM accounts_invoicerow irow JOIN accounts_invoice i ON irow.invoice_id = i.ownedobject_ptr_id WHERE i.state IN (%s,%s) AND irow.balance_payments = %s)'],
-                                                          params=[INVOICE_STATE_SENT, INVOICE_STATE_PAID, True]).exclude(invoice__state=INVOICE_STATE_EDITED).filter(owner=owner).aggregate(amount=Sum('amount'))
+        invoicerows_to_exclude = InvoiceRow.objects.filter(proposal__balanced_by_sent_invoice=False).exclude(invoice__state=INVOICE_STATE_EDITED).filter(owner=owner).aggregate(amount=Sum('amount'))
 
         # adding invoice rows of edited invoices which don't have proposal linked
         invoicerows_whithout_proposals = InvoiceRow.objects.filter(owner=owner,
@@ -168,42 +305,104 @@ class InvoiceManager(models.Manager):
 
     def get_service_to_be_invoiced(self, owner):
         accepted_proposal_amount_sum = ProposalRow.objects.filter(proposal__state=PROPOSAL_STATE_ACCEPTED,
+                                                                  proposal__balanced_by_sent_invoice=False,
                                                                   category=ROW_CATEGORY_SERVICE,
-                                                                  owner=owner).extra(where=['project_proposal.ownedobject_ptr_id NOT IN (SELECT proposal_id FROM accounts_invoicerow irow JOIN accounts_invoice i ON irow.invoice_id = i.ownedobject_ptr_id WHERE i.state IN (%s,%s) AND irow.balance_payments = %s)'],
-                                                                                 params=[INVOICE_STATE_SENT, INVOICE_STATE_PAID, True]).aggregate(amount=Sum('amount'))
+                                                                  owner=owner).aggregate(amount=Sum('amount'))
         invoicerows_to_exclude = InvoiceRow.objects.filter(proposal__state=PROPOSAL_STATE_ACCEPTED,
+                                                           proposal__balanced_by_sent_invoice=False,
                                                            category=ROW_CATEGORY_SERVICE,
-                                                           owner=owner).extra(where=['accounts_invoicerow.proposal_id NOT IN (SELECT proposal_id FROM accounts_invoicerow irow JOIN accounts_invoice i ON irow.invoice_id = i.ownedobject_ptr_id WHERE i.state IN (%s,%s) AND irow.balance_payments = %s)'],
-                                                                             params=[INVOICE_STATE_SENT, INVOICE_STATE_PAID, True]).exclude(invoice__state=INVOICE_STATE_EDITED).filter(owner=owner).aggregate(amount=Sum('amount'))
+                                                           owner=owner).exclude(invoice__state=INVOICE_STATE_EDITED).aggregate(amount=Sum('amount'))
         return (accepted_proposal_amount_sum['amount'] or 0) - (invoicerows_to_exclude['amount'] or 0)
 
+    def get_vat_totals(self, invoices):
+        """
+        VatTotals of invoices, given as a queryset or a list
+        """
+        if hasattr(invoices, 'values_list'):
+            invoice_ids = invoices.values_list('pk', flat=True)
+        else:
+            invoice_ids = [invoice.pk for invoice in invoices]
+        return VatTotals(InvoiceRow.objects.filter(invoice__in=invoice_ids))
+
     def get_vat_for_period(self, owner, begin_date, end_date):
         if not begin_date or not end_date:
             return 0
-        amount_sum_2_1 = InvoiceRow.objects.filter(vat_rate=VAT_RATES_2_1,
-                                                   invoice__state=INVOICE_STATE_PAID,
+        return VatTotals(InvoiceRow.objects.filter(invoice__state=INVOICE_STATE_PAID,
                                                    invoice__owner=owner,
                                                    invoice__paid_date__gte=begin_date,
-                                                   invoice__paid_date__lte=end_date).aggregate(vat=Sum('amount'))
-        amount_sum_5_5 = InvoiceRow.objects.filter(vat_rate=VAT_RATES_5_5,
-                                                   invoice__state=INVOICE_STATE_PAID,
-                                                   invoice__owner=owner,
-                                                   invoice__paid_date__gte=begin_date,
-                                                   invoice__paid_date__lte=end_date).aggregate(vat=Sum('amount'))
-        amount_sum_19_6 = InvoiceRow.objects.filter(vat_rate=VAT_RATES_19_6,
-                                                    invoice__state=INVOICE_STATE_PAID,
-                                                    invoice__owner=owner,
-                                                    invoice__paid_date__gte=begin_date,
-                                                    invoice__paid_date__lte=end_date).aggregate(vat=Sum('amount'))
-        return (amount_sum_2_1['vat'] or 0) * VAT_RATES_2_1 / 100\
-               + (amount_sum_5_5['vat'] or 0) * VAT_RATES_5_5 / 100\
-               + (amount_sum_19_6['vat'] or 0) * VAT_RATES_19_6 / 100
+                                                   invoice__paid_date__lte=end_date)).get_vat()
+
+class InvoiceIdSequence(models.Model):
+    """
+    Last invoice id used by an owner
+    """
+    owner = models.OneToOneField(User)
+    last_invoice_id = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return "%s %d" % (self.owner, self.last_invoice_id)
+
+def record_invoice_id(owner_id, invoice_id):
+    if not InvoiceIdSequence.objects.filter(owner=owner_id,
+                                            last_invoice_id__lt=invoice_id).update(last_invoice_id=invoice_id):
+        InvoiceIdSequence.objects.get_or_create(owner_id=owner_id,
+                                                defaults={'last_invoice_id': invoice_id})
+
+class owner_lock(object):
+    """
+    Serializes changes of data derived from all the invoices of an owner
+    by locking its invoice id sequence row until the end of the
+    transaction. Without a managed transaction, the block runs in one
+    committed at its end.
+    """
+    def __init__(self, owner_id):
+        self.owner_id = owner_id
+
+    def __enter__(self):
+        self.managed = transaction.is_managed()
+        if not self.managed:
+            transaction.enter_transaction_management()
+            transaction.managed(True)
+        sequences = InvoiceIdSequence.objects.filter(owner=self.owner_id)
+        if not sequences.update(last_invoice_id=F('last_invoice_id')):
+            InvoiceIdSequence.objects.get_or_create(owner_id=self.owner_id)
+            sequences.update(last_invoice_id=F('last_invoice_id'))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.managed:
+            try:
+                if exc_type is None:
+                    transaction.commit()
+                else:
+                    transaction.rollback()
+            finally:
+                transaction.leave_transaction_management()
+        return False
+
+def release_invoice_id(owner_id, invoice_id=None):
+    """
+    Lowers the last invoice id of owner to the greatest id still used
+    when invoice_id (any id if None) was the last one, so that it is
+    suggested again. The first update locks the sequence row until the
+    end of the transaction, allocations wait for the new value
+    """
+    sequences = InvoiceIdSequence.objects.filter(owner=owner_id)
+    if invoice_id is not None:
+        sequences = sequences.filter(last_invoice_id=invoice_id)
+    if sequences.update(last_invoice_id=F('last_invoice_id')):
+        last_invoice_id = Invoice.objects.filter(invoice_owner=owner_id).aggregate(last=Max('invoice_id'))['last']
+        InvoiceIdSequence.objects.filter(owner=owner_id).update(last_invoice_id=last_invoice_id or 0)
 
 class Invoice(OwnedObject):
     customer = models.ForeignKey(Contact, blank=True, null=True, verbose_name=_('Customer'))
     invoice_id = models.IntegerField(verbose_name=_("Invoice id"))
+    # copy of owner so that the database can check (owner, invoice_id) is unique
+    invoice_owner = models.ForeignKey(User, editable=False, related_name='+')
     state = models.IntegerField(choices=INVOICE_STATE, default=INVOICE_STATE_EDITED, verbose_name=_("State"), db_index=True)
     amount = models.DecimalField(blank=True, max_digits=12, decimal_places=2, default=0, verbose_name=_("Amount"))
+    # categories of rows, see get_natures
+    natures = models.IntegerField(default=0, editable=False)
     edition_date = models.DateField(verbose_name=_("Edition date"), help_text=_('format: mm/dd/yyyy'), db_index=True)
     payment_date = models.DateField(verbose_name=_("Payment date"), help_text=_('format: mm/dd/yyyy'), db_index=True)
     payment_type = models.IntegerField(choices=PAYMENT_TYPE, blank=True, null=True, verbose_name=_('Payment type'))
@@ -218,6 +417,7 @@ class Invoice(OwnedObject):
 
     class Meta:
         ordering = ['invoice_id']
+        unique_together = (('invoice_owner', 'invoice_id'),)
 
     def __unicode__(self):
         return "<a href=\"%s\">%s</a>" % (reverse('invoice_detail', kwargs={'id' : self.id}), ugettext("invoice #%d") % (self.invoice_id))
@@ -230,32 +430,56 @@ class Invoice(OwnedObject):
             return False
         return True
 
-    def isInvoiceIdUnique(self, owner):
-        invoices = Invoice.objects.filter(owner=owner,
-                                          invoice_id=self.invoice_id)
-        if self.id:
-            invoices = invoices.exclude(id=self.id)
-
-        if len(invoices):
-            return False
-
-        return True
-
     def getNature(self):
-        natures = self.invoice_rows.values_list('category', flat=True).order_by('category').distinct()
         result = []
-        natures_dict = dict(ROW_CATEGORY)
-        for nature in natures:
-            result.append(unicode(natures_dict[nature]))
+        for category, label in ROW_CATEGORY:
+            if self.natures & get_natures([category]):
+                result.append(unicode(label))
 
         return " & ".join(result)
 
     def save(self, force_insert=False, force_update=False, using=None, user=None):
         if not self.isInvoiceIdValid():
             raise InvalidInvoiceIdError(ugettext('Invoice id must be less than or equal to %d') % (MAX_INVOICE_ID))
-        if not self.isInvoiceIdUnique(user):
-            raise InvoiceIdNotUniqueError(ugettext("Invoice id must be unique"))
-        super(Invoice, self).save(force_insert, force_update, using, user)
+        if self.pk and self.invoice_id == self._saved_invoice_id:
+            super(Invoice, self).save(force_insert, force_update, using, user)
+            return
+
+        # uniqueness is checked by the database. The save is made in a
+        # savepoint, within a transaction if none is managed yet, so that
+        # a duplicate leaves the current transaction usable
+        adding = self.pk is None
+        managed = transaction.is_managed(using=using)
+        if not managed:
+            transaction.enter_transaction_management(using=using)
+            transaction.managed(True, using=using)
+        try:
+            sid = transaction.savepoint(using=using)
+            try:
+                super(Invoice, self).save(force_insert, force_update, using, user)
+                record_invoice_id(self.owner_id, self.invoice_id)
+                if not adding and self._saved_invoice_id:
+                    release_invoice_id(self.owner_id, self._saved_invoice_id)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid, using=using)
+                if adding:
+                    self.id = self.ownedobject_ptr_id = None
+                if Invoice.objects.filter(invoice_owner=self.invoice_owner_id,
+                                          invoice_id=self.invoice_id).exclude(pk=self.pk).count():
+                    raise InvoiceIdNotUniqueError(ugettext("Invoice id must be unique"))
+                raise
+            transaction.savepoint_commit(sid, using=using)
+            if not managed:
+                transaction.commit(using=using)
+        except:
+            # the transaction entered here must not be left pending
+            if not managed:
+                transaction.rollback(using=using)
+            raise
+        finally:
+            if not managed:
+                transaction.leave_transaction_management(using=using)
+        self._saved_invoice_id = self.invoice_id
 
     def check_amounts(self):
         proposals = Proposal.objects.filter(invoice_rows__invoice=self).distinct()
@@ -269,19 +493,33 @@ class Invoice(OwnedObject):
         return True
 
     def get_vat(self):
-        cursor = connection.cursor()
-        cursor.execute('SELECT SUM(accounts_invoicerow.amount * accounts_invoicerow.vat_rate / 100) AS "vat" FROM "accounts_invoicerow" WHERE "accounts_invoicerow"."invoice_id" = %s', [self.id])
-        row = cursor.fetchone()
-        vat = row[0] or Decimal(0)
+        if hasattr(self, 'rows_vat'):
+            vat = to_decimal(self.rows_vat)
+        else:
+            vat = VatTotals(self.invoice_rows.all()).get_vat()
         vat = vat.quantize(Decimal(1)) if vat == vat.to_integral() else vat.normalize()
         return vat
 
     def amount_including_tax(self):
         return self.amount + self.get_vat()
 
+    def get_pdf_filename(self):
+        return ugettext('invoice_%(invoice_id)d.pdf') % {'invoice_id': self.invoice_id}
+
+    def get_pdf_cache_objects(self):
+        """
+        Objects used to render the pdf of the invoice
+        """
+        objects = [self, self.customer]
+        if self.customer:
+            objects.append(self.customer.address)
+        for row in self.invoice_rows.select_related('proposal'):
+            objects.append(row)
+            objects.append(row.proposal)
+        return objects
+
     def to_pdf(self, user, response):
-        filename = ugettext('invoice_%(invoice_id)d.pdf') % {'invoice_id': self.invoice_id}
-        response['Content-Disposition'] = 'attachment; filename=%s' % (filename)
+        response['Content-Disposition'] = 'attachment; filename=%s' % (self.get_pdf_filename())
 
         invoice_template = InvoiceTemplate(response, user)
 
@@ -308,10 +546,11 @@ class Invoice(OwnedObject):
             left_block.append(Paragraph(self.footer_note, InvoiceTemplate.styleNSmall))
         else:
             left_block.append(Spacer(invoice_template.doc.width, 0.2 * inch))
-        if self.owner.get_profile().iban_bban:
-            left_block.append(Paragraph(_("IBAN/BBAN : %s") % (self.owner.get_profile().iban_bban), InvoiceTemplate.styleNSmall))
-            if self.owner.get_profile().bic:
-                left_block.append(Paragraph(_("BIC/SWIFT : %s") % (self.owner.get_profile().bic), InvoiceTemplate.styleNSmall))
+        letterhead = invoice_template.letterhead
+        if letterhead.iban_bban:
+            left_block.append(Paragraph(_("IBAN/BBAN : %s") % (letterhead.iban_bban), InvoiceTemplate.styleNSmall))
+            if letterhead.bic:
+                left_block.append(Paragraph(_("BIC/SWIFT : %s") % (letterhead.bic), InvoiceTemplate.styleNSmall))
 
         data = [[left_block,
                 '',
@@ -343,12 +582,310 @@ class InvoiceRow(Row):
     def save(self, force_insert=False, force_update=False, using=None, user=None):
         super(InvoiceRow, self).save(force_insert, force_update, using, user)
 
+def get_invoices_amount(invoice_ids):
+    """
+    Amount and natures of invoices computed from their rows, by invoice id
+    """
+    values = {}
+    rows = InvoiceRow.objects.filter(invoice__in=invoice_ids)
+    for invoice_id, category, amount in rows.values_list('invoice', 'category').annotate(Sum('amount')).order_by():
+        invoice_amount, natures = values.get(invoice_id, (0, 0))
+        values[invoice_id] = (invoice_amount + (amount or 0), natures | get_natures([category]))
+    return values
+
+def update_invoices_amount(invoice_ids):
+    values = get_invoices_amount(invoice_ids)
+    for invoice in Invoice.objects.filter(pk__in=invoice_ids).iterator():
+        invoice.amount, invoice.natures = values.get(invoice.id, (0, 0))
+        invoice.save(user=invoice.owner)
+
 def update_invoice_amount(sender, instance, created=None, **kwargs):
     row = instance
+    if defer_amount_update(update_invoices_amount, row.invoice_id):
+        return
     invoice = row.invoice
-    invoice.amount = invoice.invoice_rows.all().aggregate(sum=Sum('amount'))['sum'] or 0
+    invoice.amount, invoice.natures = get_invoices_amount([invoice.id]).get(invoice.id, (0, 0))
     invoice.save(user=invoice.owner)
 
+def get_proposals_invoicing(proposal_ids):
+    """
+    Invoiced amount and balancing flags of proposals computed
+    from their invoice rows, by proposal id
+    """
+    rows = InvoiceRow.objects.filter(proposal__in=proposal_ids)
+    amounts = dict(rows.values_list('proposal').annotate(Sum('amount')).order_by())
+    balanced = set(rows.filter(balance_payments=True).values_list('proposal', flat=True).order_by())
+    balanced_by_sent_invoice = set(rows.filter(balance_payments=True,
+                                               invoice__state__in=[INVOICE_STATE_SENT, INVOICE_STATE_PAID]).values_list('proposal', flat=True).order_by())
+    invoicing = {}
+    for proposal_id in proposal_ids:
+        invoicing[proposal_id] = {'invoiced_amount': to_decimal(amounts.get(proposal_id)),
+                                  'balanced': proposal_id in balanced,
+                                  'balanced_by_sent_invoice': proposal_id in balanced_by_sent_invoice}
+    return invoicing
+
+def update_proposals_invoicing(proposal_ids):
+    for proposal_id, values in get_proposals_invoicing(proposal_ids).items():
+        Proposal.objects.filter(pk=proposal_id).update(**values)
+
+def defer_proposals_invoicing_update(proposal_ids):
+    proposal_ids = [proposal_id for proposal_id in proposal_ids
+                    if proposal_id and not defer_amount_update(update_proposals_invoicing, proposal_id)]
+    if proposal_ids:
+        update_proposals_invoicing(proposal_ids)
+
+def init_saved_proposal_id(sender, instance, **kwargs):
+    instance._saved_proposal_id = instance.proposal_id
+
+def update_proposal_invoicing(sender, instance, raw=False, **kwargs):
+    row = instance
+    if raw:
+        return
+    # the row may have been moved from another proposal
+    defer_proposals_invoicing_update(set([row.proposal_id, row._saved_proposal_id]))
+    row._saved_proposal_id = row.proposal_id
+
 pre_save.connect(update_row_amount, sender=InvoiceRow)
+post_init.connect(init_saved_proposal_id, sender=InvoiceRow)
 post_save.connect(update_invoice_amount, sender=InvoiceRow)
+post_save.connect(update_proposal_invoicing, sender=InvoiceRow)
 post_delete.connect(update_invoice_amount, sender=InvoiceRow)
+post_delete.connect(update_proposal_invoicing, sender=InvoiceRow)
+
+class VatTotals(object):
+    """
+    Bases of invoice rows by invoice and vat rate, fetched with one
+    GROUP BY query, and their vat as exact decimals
+    """
+    def __init__(self, rows):
+        self.bases = {}
+        for invoice_id, vat_rate, base in rows.exclude(vat_rate=None).values_list('invoice', 'vat_rate').annotate(Sum('amount')).order_by():
+            self.bases.setdefault(invoice_id, {})[to_decimal(vat_rate)] = to_decimal(base)
+
+    def get_rates(self, invoice_ids=None):
+        """
+        Base and vat by vat rate for the given invoices, all invoices if None
+        """
+        if invoice_ids is None:
+            invoice_ids = self.bases.keys()
+        bases = {}
+        for invoice_id in invoice_ids:
+            for vat_rate, base in self.bases.get(invoice_id, {}).items():
+                bases[vat_rate] = bases.get(vat_rate, 0) + base
+        rates = {}
+        for vat_rate, base in bases.items():
+            rates[vat_rate] = (base, base * vat_rate / 100)
+        return rates
+
+    def get_vat(self, invoice_ids=None):
+        return sum([vat for base, vat in self.get_rates(invoice_ids).values()], Decimal(0))
+
+def first_day_of_month(value):
+    if isinstance(value, basestring):
+        value = typecast_date(value)
+    if value:
+        return value.replace(day=1)
+    return None
+
+def get_ledger_months(invoice):
+    """
+    Months of the sales ledger an invoice contributes to :
+    paid month for paid invoices, payment month for the others
+    """
+    months = set()
+    if invoice.state == INVOICE_STATE_PAID:
+        month = first_day_of_month(invoice.paid_date)
+    else:
+        month = first_day_of_month(invoice.payment_date)
+    if month:
+        months.add(month)
+    return months
+
+class SalesLedgerManager(models.Manager):
+    def update_months(self, owner_id, months):
+        """
+        Recomputes ledger entries of an owner for the given months
+        from invoice rows. Concurrent updates of an owner are serialized,
+        entries of a month are deleted and inserted by one at a time.
+        """
+        if not months:
+            return
+        with owner_lock(owner_id):
+            for month in months:
+                self.filter(owner=owner_id, month=month).delete()
+                next_month = (month + datetime.timedelta(31)).replace(day=1)
+                entries = {}
+                paid_rows = InvoiceRow.objects.filter(invoice__owner=owner_id,
+                                                      invoice__state=INVOICE_STATE_PAID,
+                                                      invoice__paid_date__gte=month,
+                                                      invoice__paid_date__lt=next_month)
+                waiting_rows = InvoiceRow.objects.filter(invoice__owner=owner_id,
+                                                         invoice__state__lte=INVOICE_STATE_SENT,
+                                                         invoice__payment_date__gte=month,
+                                                         invoice__payment_date__lt=next_month)
+                for field_name, rows in (('paid', paid_rows), ('waiting', waiting_rows)):
+                    for row in rows.values('category', 'vat_rate').annotate(amount=Sum('amount')).order_by():
+                        key = (row['category'], row['vat_rate'])
+                        if key not in entries:
+                            entries[key] = SalesLedgerEntry(owner_id=owner_id,
+                                                            month=month,
+                                                            category=row['category'],
+                                                            vat_rate=row['vat_rate'])
+                        setattr(entries[key], field_name, row['amount'] or 0)
+
+                for entry in entries.values():
+                    entry.save()
+
+    def rebuild(self, owner_id):
+        with owner_lock(owner_id):
+            self.filter(owner=owner_id).delete()
+            months = set()
+            for invoice in Invoice.objects.filter(owner=owner_id).only('state', 'paid_date', 'payment_date'):
+                months.update(get_ledger_months(invoice))
+            self.update_months(owner_id, months)
+
+    def for_period(self, owner=None, begin_date=None, end_date=None):
+        entries = self.all()
+        if owner:
+            entries = entries.filter(owner=owner)
+        if begin_date:
+            entries = entries.filter(month__gte=first_day_of_month(begin_date))
+        if end_date:
+            entries = entries.filter(month__lte=first_day_of_month(end_date))
+        return entries
+
+    def get_paid_sales(self, owner=None, begin_date=None, end_date=None):
+        return self.for_period(owner, begin_date, end_date).aggregate(sales=Sum('paid'))['sales'] or 0
+
+    def get_waiting_sales(self, owner=None, begin_date=None, end_date=None):
+        return self.for_period(owner, begin_date, end_date).aggregate(waiting=Sum('waiting'))['waiting'] or 0
+
+class SalesLedgerEntry(models.Model):
+    """
+    Monthly rollup of invoice rows of an owner by category and vat rate,
+    giving site wide sales totals of the admin dashboard without scanning
+    all invoice rows. Maintained by invoice signals, rebuilt by command
+    rebuild_sales_ledger
+    """
+    owner = models.ForeignKey(User)
+    month = models.DateField(verbose_name=_('Month'), db_index=True)
+    category = models.IntegerField(choices=ROW_CATEGORY, verbose_name=_('Category'))
+    vat_rate = models.DecimalField(choices=VAT_RATES, decimal_places=1, max_digits=4, verbose_name=_('Vat'), blank=True, null=True)
+    paid = models.DecimalField(max_digits=12, decimal_places=2, default=0, verbose_name=_('Paid'))
+    waiting = models.DecimalField(max_digits=12, decimal_places=2, default=0, verbose_name=_('Waiting'))
+
+    objects = SalesLedgerManager()
+
+    class Meta:
+        ordering = ['month']
+        unique_together = (('owner', 'month', 'category', 'vat_rate'),)
+
+def init_sales_ledger_months(sender, instance, **kwargs):
+    instance._ledger_months = get_ledger_months(instance)
+
+def update_sales_ledger(sender, instance, raw=False, **kwargs):
+    # invoices loaded from fixtures come before their rows and without
+    # their owner, the ledger is rebuilt by command rebuild_sales_ledger
+    if raw:
+        return
+    invoice = instance
+    months = getattr(invoice, '_ledger_months', set()) | get_ledger_months(invoice)
+    SalesLedgerEntry.objects.update_months(invoice.owner_id, months)
+    invoice._ledger_months = get_ledger_months(invoice)
+
+def init_saved_invoice_id(sender, instance, **kwargs):
+    instance._saved_invoice_id = instance.pk and instance.invoice_id
+    instance._saved_state = instance.state
+
+def release_deleted_invoice_id(sender, instance, **kwargs):
+    release_invoice_id(instance.invoice_owner_id, instance.invoice_id)
+
+def set_invoice_owner(sender, instance, raw=False, **kwargs):
+    # owner of objects loaded from fixtures is only known by their parent
+    if not raw:
+        instance.invoice_owner_id = instance.owner_id
+
+def update_balanced_proposals(sender, instance, created, raw=False, **kwargs):
+    invoice = instance
+    if raw or invoice.state == invoice._saved_state:
+        return
+    # balancing rows only count for proposals once their invoice is sent
+    if not created:
+        defer_proposals_invoicing_update(invoice.invoice_rows.filter(balance_payments=True).values_list('proposal', flat=True).order_by())
+    invoice._saved_state = invoice.state
+
+post_init.connect(init_sales_ledger_months, sender=Invoice)
+post_init.connect(init_saved_invoice_id, sender=Invoice)
+pre_save.connect(set_invoice_owner, sender=Invoice)
+post_save.connect(update_sales_ledger, sender=Invoice)
+post_save.connect(update_balanced_proposals, sender=Invoice)
+post_delete.connect(update_sales_ledger, sender=Invoice)
+post_delete.connect(release_deleted_invoice_id, sender=Invoice)
+
+class SalesSnapshot(object):
+    """
+    Paid and waiting sales of an owner between two dates, fetched once
+    and answering the sales questions of InvoiceManager in memory.
+    Questions falling outside of the snapshot are delegated to InvoiceManager
+    """
+    def __init__(self, owner, begin_date, end_date):
+        self.owner = owner
+        self.begin_date = begin_date
+        self.end_date = end_date
+        self.paid = []
+        self.waiting = []
+        self.vat = []
+        invoices = Invoice.objects.filter(owner=owner).filter(Q(state=INVOICE_STATE_PAID,
+                                                                paid_date__gte=begin_date,
+                                                                paid_date__lte=end_date)
+                                                              | Q(state__lte=INVOICE_STATE_SENT,
+                                                                  payment_date__gte=begin_date,
+                                                                  payment_date__lte=end_date))
+        for id, state, paid_date, payment_date, amount in invoices.values_list('id', 'state', 'paid_date', 'payment_date', 'amount').order_by():
+            if state == INVOICE_STATE_PAID:
+                self.paid.append((self._date(paid_date), amount))
+                self.vat.append((self._date(paid_date), id))
+            else:
+                self.waiting.append((self._date(payment_date), amount))
+
+        self.vat_totals = VatTotals(InvoiceRow.objects.filter(invoice__owner=owner,
+                                                              invoice__state=INVOICE_STATE_PAID,
+                                                              invoice__paid_date__gte=begin_date,
+                                                              invoice__paid_date__lte=end_date))
+
+    def _date(self, value):
+        if isinstance(value, basestring):
+            return typecast_date(value)
+        return value
+
+    def covers(self, begin_date, end_date):
+        return begin_date >= self.begin_date and end_date <= self.end_date
+
+    def get_paid_sales(self, owner, reference_date=None):
+        if not reference_date:
+            reference_date = datetime.date.today()
+        year_begin = datetime.date(reference_date.year, 1, 1)
+        if not self.covers(year_begin, reference_date):
+            return Invoice.objects.get_paid_sales(owner, reference_date)
+        return sum([amount for paid_date, amount in self.paid if year_begin <= paid_date <= reference_date])
+
+    def get_paid_sales_for_period(self, owner, begin_date, end_date):
+        if not begin_date or not end_date:
+            return 0
+        if not self.covers(begin_date, end_date):
+            return Invoice.objects.get_paid_sales_for_period(owner, begin_date, end_date)
+        return sum([amount for paid_date, amount in self.paid if begin_date <= paid_date <= end_date])
+
+    def get_waiting_sales_for_period(self, owner, end_date, begin_date=None):
+        if not end_date:
+            return 0
+        if not begin_date or not self.covers(begin_date, end_date):
+            return Invoice.objects.get_waiting_sales_for_period(owner, end_date, begin_date)
+        return sum([amount for payment_date, amount in self.waiting if begin_date <= payment_date <= end_date])
+
+    def get_vat_for_period(self, owner, begin_date, end_date):
+        if not begin_date or not end_date:
+            return 0
+        if not self.covers(begin_date, end_date):
+            return Invoice.objects.get_vat_for_period(owner, begin_date, end_date)
+        return self.vat_totals.get_vat([id for paid_date, id in self.vat if begin_date <= paid_date <= end_date])
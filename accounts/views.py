@@ -3,7 +3,8 @@
 from django.shortcuts import render_to_response, get_object_or_404, redirect
 from django.template.context import RequestContext
 from django.utils.translation import ugettext_lazy as _, ugettext
-from accounts.forms import ExpenseForm, InvoiceRowForm, InvoiceForm
+from accounts.forms import ExpenseForm, InvoiceRowForm, InvoiceForm, \
+    InvoiceSearchForm
 from accounts.models import Expense, Invoice, InvoiceRow, InvoiceRowAmountError, \
     InvoiceIdNotUniqueError, INVOICE_STATE_PAID
 from django.http import HttpResponse
@@ -13,12 +14,13 @@ from django.db.transaction import commit_on_success
 from contact.models import Contact, CONTACT_TYPE_COMPANY
 from django.forms.models import inlineformset_factory
 from project.models import Proposal, PROPOSAL_STATE_BALANCED, \
-    PROPOSAL_STATE_ACCEPTED
+    PROPOSAL_STATE_ACCEPTED, batch_edit
 from django.contrib import messages
 from django.core.urlresolvers import reverse
 from django.db import transaction
 from custom_canvas import NumberedCanvas
 from core.decorators import settings_required
+from project.utils.pdf_cache import pdf_download_response
 from django.core.paginator import Paginator, EmptyPage, InvalidPage
 from autoentrepreneur.decorators import subscription_required
 from django.db.models.query_utils import Q
@@ -197,16 +199,94 @@ def expense_list_export(request):
     doc.build(story, canvasmaker=NumberedCanvas)
     return response
 
+INVOICE_LIST_PAGE_SIZE = 25
+
+def get_invoice_page(invoices, order, direction, after=None, before=None):
+    """
+    Returns the page of invoices following the one with invoice id after,
+    or preceding the one with invoice id before, and whether there are
+    previous and next pages.
+    Pages start from the sort key of this invoice instead of an offset,
+    so that all pages are as fast to get as the first one.
+    Invoice ids are unique for an owner and break ties of the sort key.
+    """
+    cursor = None
+    try:
+        cursor = invoices.filter(invoice_id=int(after or before)).values(order, 'invoice_id')[0]
+    except (TypeError, ValueError, IndexError):
+        pass
+    backward = cursor is not None and not after
+
+    descending = (direction == 'desc') != backward
+    if descending:
+        sign, lookup = '-', 'lt'
+    else:
+        sign, lookup = '', 'gt'
+
+    if cursor:
+        after_cursor = Q(**{'invoice_id__%s' % (lookup): cursor['invoice_id']})
+        if order != 'invoice_id':
+            after_cursor = Q(**{'%s__%s' % (order, lookup): cursor[order]}) \
+                           | (Q(**{order: cursor[order]}) & after_cursor)
+        invoices = invoices.filter(after_cursor)
+
+    ordering = [sign + order]
+    if order != 'invoice_id':
+        ordering.append(sign + 'invoice_id')
+    invoices = list(invoices.order_by(*ordering)[:INVOICE_LIST_PAGE_SIZE + 1])
+    has_more = len(invoices) > INVOICE_LIST_PAGE_SIZE
+    invoices = invoices[:INVOICE_LIST_PAGE_SIZE]
+    if backward:
+        invoices.reverse()
+        return invoices, has_more, True
+    return invoices, cursor is not None, has_more
+
 @settings_required
 @subscription_required
 def invoice_list(request):
     user = request.user
-    invoices = Invoice.objects.filter(owner=user).order_by('-invoice_id')
+
+    o = request.GET.get('o', 'invoice_id')
+    if o not in ('invoice_id', 'edition_date', 'state', 'amount'):
+        o = 'invoice_id'
+
+    ot = request.GET.get('ot', 'desc')
+    if ot not in ('asc', 'desc'):
+        ot = 'desc'
+
+    # invoice_owner is indexed with invoice_id
+    invoice_list = Invoice.objects.filter(invoice_owner=user)
+
+    # search criteria
+    form = InvoiceSearchForm(request.GET)
+    if form.is_valid():
+        data = form.cleaned_data
+        if data['customer']:
+            invoice_list = invoice_list.filter(Q(customer__name__icontains=data['customer']) | Q(customer__firstname__icontains=data['customer']))
+        if data['state']:
+            invoice_list = invoice_list.filter(state=data['state'])
+    else:
+        data = {'customer': '',
+                'state': ''}
+
+    invoice_list = Invoice.objects.annotate_rows(invoice_list.select_related('customer'))
+    invoices, has_previous, has_next = get_invoice_page(invoice_list,
+                                                        o,
+                                                        ot,
+                                                        request.GET.get('after'),
+                                                        request.GET.get('before'))
+
     years = range(datetime.date.today().year, user.get_profile().creation_date.year - 1, -1)
     return render_to_response('invoice/list.html',
                               {'active': 'accounts',
                                'title': _('Invoices'),
                                'invoices': invoices,
+                               'has_previous': has_previous,
+                               'has_next': has_next,
+                               'o': o,
+                               'ot': ot,
+                               'form': form,
+                               'search_criteria': data,
                                'years': years},
                               context_instance=RequestContext(request))
 
@@ -233,7 +313,7 @@ def invoice_list_export(request):
     year = int(request.GET.get('year'))
     invoices = Invoice.objects.filter(owner=user,
                                       state__gte=INVOICE_STATE_PAID,
-                                      paid_date__year=year).order_by('invoice_id')
+                                      paid_date__year=year).select_related('customer').order_by('invoice_id')
     filename = ugettext('invoice_book_%(year)d.pdf') % {'year': year}
     response = HttpResponse(mimetype='application/pdf')
     response['Content-Disposition'] = 'attachment; filename=%s' % (filename)
@@ -358,18 +438,19 @@ def invoice_create_or_edit(request, id=None, customer_id=None, proposal_id=None)
                     invoice.state = INVOICE_STATE_PAID
                 invoice.save(user=user)
                 invoiceForm.save_m2m()
-                for invoicerowform in invoicerowformset.forms:
-                    if invoicerowform not in invoicerowformset.deleted_forms and invoicerowform.cleaned_data:
-                        invoicerow = invoicerowform.save(commit=False)
-                        invoicerow.invoice = invoice
-                        invoicerow.save(user=user)
+                with batch_edit():
+                    for invoicerowform in invoicerowformset.forms:
+                        if invoicerowform not in invoicerowformset.deleted_forms and invoicerowform.cleaned_data:
+                            invoicerow = invoicerowform.save(commit=False)
+                            invoicerow.invoice = invoice
+                            invoicerow.save(user=user)
 
-                        if invoicerow.proposal and invoicerow.balance_payments and invoice.paid_date:
-                            invoicerow.proposal.state = PROPOSAL_STATE_BALANCED
-                            invoicerow.proposal.save()
+                            if invoicerow.proposal and invoicerow.balance_payments and invoice.paid_date:
+                                invoicerow.proposal.state = PROPOSAL_STATE_BALANCED
+                                invoicerow.proposal.save()
 
-                for deleted_invoicerowform in invoicerowformset.deleted_forms:
-                    deleted_invoicerowform.instance.delete()
+                    for deleted_invoicerowform in invoicerowformset.deleted_forms:
+                        deleted_invoicerowform.instance.delete()
 
                 invoice.check_amounts()
 
@@ -480,9 +561,7 @@ def invoice_download(request, id):
     user = request.user
     invoice = get_object_or_404(Invoice, pk=id, owner=user)
 
-    response = HttpResponse(mimetype='application/pdf')
-    invoice.to_pdf(user, response)
-    return response
+    return pdf_download_response(user, invoice)
 
 @settings_required
 @subscription_required
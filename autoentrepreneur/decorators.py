@@ -7,6 +7,7 @@ from django.utils.translation import ugettext_lazy as _
 from django.contrib.sites.models import Site
 from django.utils.decorators import available_attrs
 from django.utils.functional import wraps
+from core.decorators import get_request_access_state
 
 def subscription_required(view_func, redirect_field_name=REDIRECT_FIELD_NAME):
     """
@@ -14,7 +15,7 @@ def subscription_required(view_func, redirect_field_name=REDIRECT_FIELD_NAME):
     use login_required.
     """
     def decorator(request, *args, **kwargs):
-        if request.user.get_profile().is_allowed():
+        if get_request_access_state(request)['allowed']:
             return view_func(request, *args, **kwargs)
         messages.warning(request, _('Your subscription has expired. You need to subscribe again to keep using %(site_name)s') % {'site_name': Site.objects.get_current().name})
         return HttpResponseRedirect(reverse('subscribe'))
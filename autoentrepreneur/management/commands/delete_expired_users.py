@@ -1,8 +1,7 @@
-import shutil
 from django.core.management.base import BaseCommand
 from bugtracker.models import Issue, Comment, Vote
 from django.conf import settings
-from autoentrepreneur.models import Subscription
+from autoentrepreneur.models import Subscription, store
 from django.contrib.auth.models import User
 
 class Command(BaseCommand):
@@ -15,9 +14,7 @@ class Command(BaseCommand):
         for user in expired_users:
             i = i + 1
             user = User.objects.get(pk=user)
-            shutil.rmtree('%s%s' % (settings.FILE_UPLOAD_DIR,
-                                    user.get_profile().uuid),
-                                    True)
+            store.delete_directory(user.get_profile().uuid)
             Issue.objects.filter(owner=user).update(owner=None)
             Comment.objects.filter(owner=user).update(owner=None)
             Vote.objects.filter(owner=user).delete()
@@ -1,9 +1,8 @@
 from django.core.management.base import BaseCommand
 from bugtracker.models import Issue, Comment, Vote
 from django.conf import settings
-from autoentrepreneur.models import UserProfile
+from autoentrepreneur.models import UserProfile, store
 import datetime
-import shutil
 
 class Command(BaseCommand):
     help = 'Delete unregistered users'
@@ -15,9 +14,7 @@ class Command(BaseCommand):
         i = 0
         for profile in unregistered_profiles:
             i = i + 1
-            shutil.rmtree('%s%s' % (settings.FILE_UPLOAD_DIR,
-                                    profile.uuid),
-                                    True)
+            store.delete_directory(profile.uuid)
             Issue.objects.filter(owner=profile.user).update(owner=None)
             Comment.objects.filter(owner=profile.user).update(owner=None)
             Vote.objects.filter(owner=profile.user).delete()
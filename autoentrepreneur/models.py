@@ -1,22 +1,24 @@
 # -*- coding: utf-8 -*-
 import logging
+import time
 import uuid
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth.models import User
 from contact.models import Address
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.db.models.aggregates import Max, Count
 from core.models import OwnedObject
 from bugtracker.models import Issue
 from django.core.mail import send_mail
+from django.core.cache import cache
 from django.contrib.sites.models import Site
 import datetime
 from django.conf import settings
 from registration.signals import user_registered
-from django.core.files.storage import FileSystemStorage
+from core.storage import DeduplicatedStorage
 import unicodedata
-from accounts.models import Invoice
+from accounts.models import Invoice, SalesSnapshot
 from django.db.models.expressions import F
 from notification.models import Notification
 
@@ -29,6 +31,42 @@ AUTOENTREPRENEUR_ACTIVITY = ((AUTOENTREPRENEUR_ACTIVITY_PRODUCT_SALE_BIC, _('Pro
                              (AUTOENTREPRENEUR_ACTIVITY_SERVICE_BNC, _('Provision of a service (BNC)')),
                              (AUTOENTREPRENEUR_ACTIVITY_LIBERAL_BNC, _('Liberal profession (BNC)')))
 
+# seconds before the cached sales limits are reloaded, so that changes made
+# by other processes are eventually seen
+SALES_LIMIT_CACHE_TIMEOUT = 3600
+
+class SalesLimitManager(models.Manager):
+    """
+    Sales limits are a few reference rows changing once a year : the whole
+    table is kept in memory and reloaded when a limit is saved or deleted
+    """
+    _cache = None
+    _cache_time = 0
+
+    def clear_cache(self):
+        SalesLimitManager._cache = None
+
+    def get_limits(self):
+        if SalesLimitManager._cache is None \
+            or time.time() - SalesLimitManager._cache_time > SALES_LIMIT_CACHE_TIMEOUT:
+            limits = {}
+            for sales_limit in self.all():
+                limits[(sales_limit.year, sales_limit.activity)] = sales_limit
+            SalesLimitManager._cache = limits
+            SalesLimitManager._cache_time = time.time()
+        return SalesLimitManager._cache
+
+    def get_limit(self, year, activity):
+        limits = self.get_limits()
+        if (year, activity) not in limits:
+            # may have been added by another process
+            self.clear_cache()
+            limits = self.get_limits()
+        try:
+            return limits[(year, activity)]
+        except KeyError:
+            raise SalesLimit.DoesNotExist('No sales limit defined for %s and activity %s' % (year, activity))
+
 class SalesLimit(models.Model):
     year = models.IntegerField(verbose_name=_('Year'))
     activity = models.IntegerField(choices=AUTOENTREPRENEUR_ACTIVITY,
@@ -36,9 +74,17 @@ class SalesLimit(models.Model):
     limit = models.IntegerField(verbose_name=_('Limit'))
     limit2 = models.IntegerField(verbose_name=_('Limit 2'))
 
+    objects = SalesLimitManager()
+
     def __unicode__(self):
         return u"%s - %s - %s/%s" % (self.year, self.get_activity_display(), self.limit, self.limit2)
 
+def clear_sales_limit_cache(sender, instance, **kwargs):
+    SalesLimit.objects.clear_cache()
+
+post_save.connect(clear_sales_limit_cache, sender=SalesLimit)
+post_delete.connect(clear_sales_limit_cache, sender=SalesLimit)
+
 SUBSCRIPTION_STATE_NOT_PAID = 1
 SUBSCRIPTION_STATE_PAID = 2
 SUBSCRIPTION_STATE_TRIAL = 3
@@ -105,7 +151,9 @@ class SubscriptionManager(models.Manager):
 
     def add_days(self, days):
         """Add hours and days to active subscriptions"""
-        return self.filter(expiration_date__gte=datetime.date.today()).update(expiration_date=F('expiration_date') + days)
+        subscriptions = self.filter(expiration_date__gte=datetime.date.today())
+        clear_access_state(set(subscriptions.values_list('owner', flat=True)))
+        return subscriptions.update(expiration_date=F('expiration_date') + days)
 
 class Subscription(OwnedObject):
     state = models.IntegerField(choices=SUBSCRIPTION_STATE, verbose_name=_('State'), db_index=True)
@@ -182,7 +230,7 @@ AUTOENTREPRENEUR_REGISTER = ((AUTOENTREPRENEUR_REGISTER_RM, 'RM'),
                              (AUTOENTREPRENEUR_REGISTER_RCS, 'RCS'),
                              (AUTOENTREPRENEUR_REGISTER_RSEIRL, 'RSEIRL'))
 
-store = FileSystemStorage(location=settings.FILE_UPLOAD_DIR)
+store = DeduplicatedStorage(location=settings.FILE_UPLOAD_DIR)
 
 def logo_upload_to_handler(instance, filename):
         return "%s/logo/%s" % (instance.user.get_profile().uuid, unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore'))
@@ -297,7 +345,7 @@ class UserProfile(models.Model):
         if not year:
             year = today.year
         if self.activity:
-            limit = SalesLimit.objects.get(year=year, activity=self.activity).limit
+            limit = SalesLimit.objects.get_limit(year, self.activity).limit
             if self.creation_date and self.creation_date.year == year:
                 worked_days = datetime.date(year + 1, 1, 1) - self.creation_date
                 days_in_year = datetime.date(year + 1, 1, 1) - datetime.date(year, 1, 1)
@@ -310,7 +358,7 @@ class UserProfile(models.Model):
         if not year:
             year = today.year
         if self.activity:
-            limit = SalesLimit.objects.get(year=year, activity=self.activity).limit2
+            limit = SalesLimit.objects.get_limit(year, self.activity).limit2
             if self.creation_date and self.creation_date.year == year:
                 worked_days = datetime.date(year + 1, 1, 1) - self.creation_date
                 days_in_year = datetime.date(year + 1, 1, 1) - datetime.date(year, 1, 1)
@@ -323,7 +371,7 @@ class UserProfile(models.Model):
         if not year:
             year = today.year
         if self.activity == AUTOENTREPRENEUR_ACTIVITY_PRODUCT_SALE_BIC:
-            service_limit = SalesLimit.objects.get(year=year, activity=AUTOENTREPRENEUR_ACTIVITY_SERVICE_BIC).limit
+            service_limit = SalesLimit.objects.get_limit(year, AUTOENTREPRENEUR_ACTIVITY_SERVICE_BIC).limit
             if self.creation_date and self.creation_date.year == year:
                 worked_days = datetime.date(year + 1, 1, 1) - self.creation_date
                 days_in_year = datetime.date(year + 1, 1, 1) - datetime.date(year, 1, 1)
@@ -404,7 +452,7 @@ class UserProfile(models.Model):
 
         return tax_rate
 
-    def get_tax_rate(self, reference_date=None, period_is_only_overrun=False):
+    def get_tax_rate(self, reference_date=None, period_is_only_overrun=False, sales=None):
         tax_rate = 0
         if not self.activity:
             return tax_rate
@@ -412,6 +460,9 @@ class UserProfile(models.Model):
         if not reference_date:
             reference_date = datetime.date.today()
 
+        if sales is None:
+            sales = Invoice.objects
+
         freeing_tax_payment = self.freeing_tax_payment
 
         if reference_date.month == 2 and reference_date.day == 29:
@@ -425,14 +476,14 @@ class UserProfile(models.Model):
         paid_previous_year = 0
         limit_previous_year = 0
         if not first_year:
-            paid_previous_year = Invoice.objects.get_paid_sales(owner=self.user,
-                                                                reference_date=datetime.date(one_year_back.year, 12, 31))
+            paid_previous_year = sales.get_paid_sales(owner=self.user,
+                                                      reference_date=datetime.date(one_year_back.year, 12, 31))
             limit_previous_year = self.get_sales_limit(year=one_year_back.year)
 
         if not first_year and paid_previous_year > limit_previous_year:
             freeing_tax_payment = False
 
-        paid = Invoice.objects.get_paid_sales(owner=self.user, reference_date=reference_date)
+        paid = sales.get_paid_sales(owner=self.user, reference_date=reference_date)
         limit = self.get_sales_limit(reference_date.year)
 
         if paid > limit:
@@ -512,30 +563,32 @@ class UserProfile(models.Model):
             first_year = False
         return first_year
 
-    def get_tax_data(self, reference_date=None):
+    def get_tax_data(self, reference_date=None, sales=None):
         if not reference_date:
             reference_date = datetime.date.today()
         today = reference_date or datetime.date.today()
+        if sales is None:
+            sales = Invoice.objects
 
         begin_date, end_date = self.get_period_for_tax(reference_date)
         pay_date = self.get_pay_date(end_date)
-        amount_paid_for_tax = Invoice.objects.get_paid_sales_for_period(self.user, begin_date, end_date)
+        amount_paid_for_tax = sales.get_paid_sales_for_period(self.user, begin_date, end_date)
         waiting_amount_for_tax = 0
         if reference_date >= today:
-            waiting_amount_for_tax = Invoice.objects.get_waiting_sales_for_period(self.user, end_date, begin_date)
+            waiting_amount_for_tax = sales.get_waiting_sales_for_period(self.user, end_date, begin_date)
 
         first_year = self.is_first_year(begin_date)
         one_year_back = datetime.date(begin_date.year - 1, begin_date.month, begin_date.day)
         if not first_year:
-            paid_previous_year = Invoice.objects.get_paid_sales(owner=self.user,
-                                                                reference_date=datetime.date(one_year_back.year, 12, 31))
+            paid_previous_year = sales.get_paid_sales(owner=self.user,
+                                                      reference_date=datetime.date(one_year_back.year, 12, 31))
         only_overrun = False
         sales_limit = self.get_sales_limit(year=begin_date.year)
         limit_previous_year = self.get_sales_limit(year=one_year_back.year)
-        paid = Invoice.objects.get_paid_sales(owner=self.user, reference_date=end_date)
+        paid = sales.get_paid_sales(owner=self.user, reference_date=end_date)
         if amount_paid_for_tax <= paid - sales_limit or (not first_year and paid_previous_year > limit_previous_year):
             only_overrun = True
-        tax_rate = self.get_tax_rate(reference_date, period_is_only_overrun=only_overrun)
+        tax_rate = self.get_tax_rate(reference_date, period_is_only_overrun=only_overrun, sales=sales)
         if only_overrun:
             base_taxed_amount = amount_paid_for_tax
         else:
@@ -544,7 +597,7 @@ class UserProfile(models.Model):
         extra_taxes = self.get_extra_taxes(end_date, paid, amount_paid_for_tax)
         estimated_amount_for_tax = amount_paid_for_tax + waiting_amount_for_tax
         estimated_amount_to_pay = float(base_taxed_amount + waiting_amount_for_tax) * float(tax_rate) / 100
-        vat_amount = Invoice.objects.get_vat_for_period(self.user, begin_date, end_date)
+        vat_amount = sales.get_vat_for_period(self.user, begin_date, end_date)
 
         taxes = {'period_begin': begin_date,
                  'period_end': end_date,
@@ -560,6 +613,84 @@ class UserProfile(models.Model):
 
         return taxes
 
+    def get_tax_data_for_dates(self, reference_dates):
+        """
+        Same as get_tax_data for several reference dates, fetching
+        the sales involved in all the periods at once
+        """
+        if not reference_dates:
+            return []
+        first_sales_year = None
+        last_date = None
+        for reference_date in reference_dates:
+            begin_date, end_date = self.get_period_for_tax(reference_date)
+            year = min(begin_date.year, reference_date.year) - 1
+            if first_sales_year is None or year < first_sales_year:
+                first_sales_year = year
+            for date in (end_date, reference_date):
+                if last_date is None or date > last_date:
+                    last_date = date
+        sales = SalesSnapshot(self.user, datetime.date(first_sales_year, 1, 1), last_date)
+        return [self.get_tax_data(reference_date, sales=sales) for reference_date in reference_dates]
+
+    def get_tax_schedule(self, reference_date=None, periods=3):
+        """
+        Tax data of consecutive declaration periods, starting with the one
+        declared at reference_date
+        """
+        reference_date = reference_date or datetime.date.today()
+        reference_dates = []
+        for i in range(periods):
+            reference_dates.append(reference_date)
+            begin_date, end_date = self.get_period_for_tax(reference_date)
+            reference_date = self.get_pay_date(end_date) + datetime.timedelta(1)
+        return self.get_tax_data_for_dates(reference_dates)
+
+# seconds during which the access state of a user is kept in cache
+ACCESS_STATE_CACHE_TIMEOUT = 300
+
+def get_access_state_cache_key(user_id):
+    return 'autoentrepreneur_access_state_%s' % (user_id)
+
+def get_access_state(user):
+    """
+    Returns whether settings are defined and subscription allows access
+    for user. Cached for the day it was computed, cleared when the user,
+    its profile, address or subscriptions change. Only granted access is
+    cached : a user who has just paid or filled his settings must not be
+    denied by another process still holding the previous state.
+    """
+    today = datetime.date.today()
+    key = get_access_state_cache_key(user.id)
+    state = cache.get(key)
+    if state is None or state['date'] != today:
+        profile = user.get_profile()
+        state = {'date': today,
+                 'settings_defined': profile.settings_defined(),
+                 'allowed': profile.is_allowed()}
+        if state['settings_defined'] and state['allowed']:
+            cache.set(key, state, ACCESS_STATE_CACHE_TIMEOUT)
+    return state
+
+def clear_access_state(user_ids):
+    cache.delete_many([get_access_state_cache_key(user_id) for user_id in user_ids])
+
+def clear_access_state_for_user(sender, instance, **kwargs):
+    clear_access_state([instance.id])
+
+def clear_access_state_for_owner(sender, instance, **kwargs):
+    if instance.owner_id:
+        clear_access_state([instance.owner_id])
+
+def clear_access_state_for_profile(sender, instance, **kwargs):
+    clear_access_state([instance.user_id])
+
+post_save.connect(clear_access_state_for_user, sender=User)
+post_save.connect(clear_access_state_for_profile, sender=UserProfile)
+post_save.connect(clear_access_state_for_owner, sender=Address)
+post_save.connect(clear_access_state_for_owner, sender=Subscription)
+post_delete.connect(clear_access_state_for_owner, sender=Subscription)
+
 def user_post_save(sender, instance, created, **kwargs):
     if created and not kwargs.get('raw', False):
         notification = Notification()
@@ -4,13 +4,14 @@ from autoentrepreneur.models import Subscription, SUBSCRIPTION_STATE_NOT_PAID, \
     SUBSCRIPTION_STATE_TRIAL, SUBSCRIPTION_STATE_PAID, SUBSCRIPTION_STATE_FREE, \
     UserProfile, AUTOENTREPRENEUR_PROFESSIONAL_CATEGORY_TRADER, \
     AUTOENTREPRENEUR_PROFESSIONAL_CATEGORY_CRAFTSMAN, \
-    AUTOENTREPRENEUR_PROFESSIONAL_CATEGORY_LIBERAL, SalesLimit
+    AUTOENTREPRENEUR_PROFESSIONAL_CATEGORY_LIBERAL, SalesLimit, get_access_state, \
+    get_access_state_cache_key, clear_access_state_for_owner
 from django.db.utils import IntegrityError
 from contact.models import Contact, Address, CONTACT_TYPE_COMPANY
 from project.models import Project, PROJECT_STATE_PROSPECT, Proposal, \
     PROPOSAL_STATE_DRAFT, ROW_CATEGORY_SERVICE, ProposalRow
 from accounts.models import Invoice, INVOICE_STATE_PAID, PAYMENT_TYPE_CHECK, \
-    InvoiceRow, Expense
+    InvoiceRow, Expense, INVOICE_STATE_SENT
 from bugtracker.models import ISSUE_CATEGORY_BUG, ISSUE_STATE_OPEN, Issue, \
     Comment, Vote
 from django.core.urlresolvers import reverse
@@ -19,6 +20,8 @@ from django.contrib.sites.models import Site
 from django.utils.translation import ugettext
 from django.conf import settings
 from django.core.management import call_command
+from django.core.cache import cache
+from django.db.models.signals import post_save
 import datetime
 from autoentrepreneur.models import AUTOENTREPRENEUR_PAYMENT_OPTION_QUATERLY, \
     AUTOENTREPRENEUR_PAYMENT_OPTION_MONTHLY, \
@@ -57,6 +60,9 @@ class SubscriptionTest(TestCase):
                                       limit=sl.limit,
                                       limit2=sl.limit2)
 
+    def tearDown(self):
+        SalesLimit.objects.clear_cache()
+
     def testNotAllowedIfNoSubscription(self):
         user = User.objects.get(pk=1)
         profile = user.get_profile()
@@ -145,6 +151,33 @@ class SubscriptionTest(TestCase):
 
         self.assertTrue(profile.is_allowed())
 
+    def testAccessStateInvalidatedBySubscription(self):
+        user = User.objects.get(pk=1)
+        self.assertFalse(get_access_state(user)['allowed'])
+        subscription = Subscription.objects.create(owner=user,
+                                                   state=SUBSCRIPTION_STATE_PAID,
+                                                   expiration_date=datetime.date.today() + datetime.timedelta(1),
+                                                   transaction_id='XXX')
+        self.assertTrue(get_access_state(user)['allowed'])
+        subscription.delete()
+        self.assertFalse(get_access_state(user)['allowed'])
+
+    def testDeniedAccessStateNotCached(self):
+        user = User.objects.get(pk=1)
+        self.assertFalse(get_access_state(user)['allowed'])
+        self.assertEquals(cache.get(get_access_state_cache_key(user.id)), None)
+        # as done by another process, without invalidating this process cache
+        Subscription.objects.filter(owner=user).delete()
+        post_save.disconnect(clear_access_state_for_owner, sender=Subscription)
+        try:
+            Subscription.objects.create(owner=user,
+                                        state=SUBSCRIPTION_STATE_PAID,
+                                        expiration_date=datetime.date.today() + datetime.timedelta(1),
+                                        transaction_id='XXX')
+        finally:
+            post_save.connect(clear_access_state_for_owner, sender=Subscription)
+        self.assertTrue(get_access_state(user)['allowed'])
+
     def testNextDateBeforeExpiration(self):
         user = User.objects.get(pk=1)
         profile = user.get_profile()
@@ -1018,6 +1051,7 @@ class TaxTest(TestCase):
 
     def tearDown(self):
         autoentrepreneur.models.datetime = datetime
+        SalesLimit.objects.clear_cache()
 
     def testGetQuarter(self):
         self.assertEquals(self.user.get_profile().get_quarter(datetimestub.DatetimeStub.date(2011, 1, 1)), (1, 2011))
@@ -1725,6 +1759,61 @@ class TaxTest(TestCase):
         profile.save()
         self.assertEquals(profile.get_professional_training_tax_rate(), 0.2)
 
+    def testSalesLimitCache(self):
+        profile = self.user.get_profile()
+        profile.creation_date = datetimestub.DatetimeStub.date(2010, 1, 1)
+        profile.activity = AUTOENTREPRENEUR_ACTIVITY_SERVICE_BNC
+        profile.save()
+        sales_limit = SalesLimit.objects.create(year=2005, activity=AUTOENTREPRENEUR_ACTIVITY_SERVICE_BNC, limit=30000, limit2=32000)
+        self.assertEquals(profile.get_sales_limit(2005), 30000)
+        sales_limit.limit = 31000
+        sales_limit.save()
+        self.assertEquals(profile.get_sales_limit(2005), 31000)
+        sales_limit.delete()
+        self.assertRaises(SalesLimit.DoesNotExist, profile.get_sales_limit, 2005)
+
+    def testTaxSchedule(self):
+        profile = self.user.get_profile()
+        profile.creation_date = datetimestub.DatetimeStub.date(2010, 1, 1)
+        profile.freeing_tax_payment = False
+        profile.creation_help = False
+        profile.payment_option = AUTOENTREPRENEUR_PAYMENT_OPTION_QUATERLY
+        profile.activity = AUTOENTREPRENEUR_ACTIVITY_SERVICE_BNC
+        profile.save()
+
+        invoice_id = 1
+        for state, paid_date, payment_date, vat_rate in [(INVOICE_STATE_PAID, datetime.date(2010, 11, 15), datetime.date(2010, 11, 30), None),
+                                                         (INVOICE_STATE_PAID, datetime.date(2011, 2, 10), datetime.date(2011, 2, 28), '19.6'),
+                                                         (INVOICE_STATE_PAID, datetime.date(2011, 5, 20), datetime.date(2011, 5, 31), '5.5'),
+                                                         (INVOICE_STATE_SENT, None, datetime.date(2011, 8, 31), None)]:
+            invoice = Invoice.objects.create(invoice_id=invoice_id,
+                                             state=state,
+                                             amount='1000',
+                                             edition_date=payment_date,
+                                             payment_date=payment_date,
+                                             paid_date=paid_date,
+                                             payment_type=PAYMENT_TYPE_CHECK,
+                                             owner_id=self.user.id)
+            InvoiceRow.objects.create(invoice=invoice,
+                                      label='Day of work',
+                                      category=ROW_CATEGORY_SERVICE,
+                                      quantity=10,
+                                      unit_price='100',
+                                      vat_rate=vat_rate,
+                                      balance_payments=False,
+                                      owner_id=self.user.id)
+            invoice_id = invoice_id + 1
+
+        reference_date = datetimestub.DatetimeStub.date(2011, 4, 15)
+        schedule = profile.get_tax_schedule(reference_date, periods=3)
+        self.assertEquals([taxes['period_begin'] for taxes in schedule],
+                          [datetime.date(2011, 1, 1), datetime.date(2011, 4, 1), datetime.date(2011, 7, 1)])
+        reference_dates = [reference_date,
+                           datetimestub.DatetimeStub.date(2011, 5, 1),
+                           datetimestub.DatetimeStub.date(2011, 8, 1)]
+        for taxes, date in zip(schedule, reference_dates):
+            self.assertEquals(taxes, profile.get_tax_data(date))
+
     def testLeapYear(self):
         profile = self.user.get_profile()
         profile.creation_date = datetimestub.DatetimeStub.date(2011, 1, 1)
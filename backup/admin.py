@@ -1,5 +1,16 @@
 from django.contrib import admin
-from backup.models import BackupRequest, RestoreRequest
+from backup.models import BackupRequest, RestoreRequest, InvoiceArchiveRequest
 
-admin.site.register(BackupRequest)
-admin.site.register(RestoreRequest)
+class BackupRequestAdmin(admin.ModelAdmin):
+    list_display = ['user', 'state', 'start_datetime', 'get_duration', 'object_count', 'get_objects_per_second', 'byte_count']
+    list_filter = ['state']
+    ordering = ['-start_datetime']
+
+class RestoreRequestAdmin(admin.ModelAdmin):
+    list_display = ['user', 'state', 'action', 'start_datetime', 'get_duration', 'object_count', 'get_objects_per_second', 'byte_count']
+    list_filter = ['state', 'action']
+    ordering = ['-start_datetime']
+
+admin.site.register(BackupRequest, BackupRequestAdmin)
+admin.site.register(RestoreRequest, RestoreRequestAdmin)
+admin.site.register(InvoiceArchiveRequest)
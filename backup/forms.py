@@ -1,5 +1,6 @@
 from django import forms
-from backup.models import BackupRequest, RestoreRequest
+from backup.models import BackupRequest, RestoreRequest, InvoiceArchiveRequest
+import datetime
 from django.utils.translation import ugettext_lazy as _
 
 class BackupForm(forms.ModelForm):
@@ -7,16 +8,39 @@ class BackupForm(forms.ModelForm):
 
     class Meta:
         model = BackupRequest
-        exclude = ['user', 'state', 'creation_datetime', 'last_state_datetime', 'error_message']
+        fields = ['incremental']
 
 class RestoreForm(forms.ModelForm):
     backup_or_restore = forms.CharField(initial='restore', widget=forms.HiddenInput())
 
     class Meta:
         model = RestoreRequest
-        exclude = ['user', 'state', 'creation_datetime', 'last_state_datetime', 'error_message']
+        fields = ['action', 'backup_file']
+
+class InvoiceArchiveForm(forms.ModelForm):
+    backup_or_restore = forms.CharField(initial='invoice_archive', widget=forms.HiddenInput())
+    year = forms.TypedChoiceField(label=_('Year'), coerce=int)
+
+    class Meta:
+        model = InvoiceArchiveRequest
+        fields = ['year']
+
+    def __init__(self, first_year, *args, **kwargs):
+        super(InvoiceArchiveForm, self).__init__(*args, **kwargs)
+        years = range(datetime.date.today().year, first_year - 1, -1)
+        self.fields['year'].choices = [(year, year) for year in years]
+
+CSV_EXPORT_INVOICES = 'invoices'
+CSV_EXPORT_INVOICE_ROWS = 'invoice_rows'
+CSV_EXPORT_EXPENSES = 'expenses'
+CSV_EXPORT_PROPOSALS = 'proposals'
+CSV_EXPORT = ((CSV_EXPORT_INVOICES, _('Invoices')),
+              (CSV_EXPORT_INVOICE_ROWS, _('Invoice rows')),
+              (CSV_EXPORT_EXPENSES, _('Expenses')),
+              (CSV_EXPORT_PROPOSALS, _('Proposals')))
 
 class CSVForm(forms.Form):
+    data = forms.ChoiceField(label=_('Data'), choices=CSV_EXPORT, required=False, initial=CSV_EXPORT_INVOICES)
     begin_date = forms.DateField(label=_('From date'), required=False, help_text=_('Optional. If not set, export from the first invoice'))
     end_date = forms.DateField(label=_('To date'), required=False, help_text=_('Optional. If not set, export until now'))
 
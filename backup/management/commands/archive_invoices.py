@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from backup.models import InvoiceArchiveRequest, BACKUP_RESTORE_STATE_IN_PROGRESS, \
+    BACKUP_RESTORE_STATE_PENDING
+
+class Command(BaseCommand):
+    help = 'Execute pending invoice archive requests'
+
+    def handle(self, *args, **options):
+        pending = InvoiceArchiveRequest.objects.filter(state=BACKUP_RESTORE_STATE_PENDING).count()
+        if not pending:
+            self.stdout.write("No pending invoice archive requests.\n")
+            return
+
+        in_progress = InvoiceArchiveRequest.objects.filter(state=BACKUP_RESTORE_STATE_IN_PROGRESS).count()
+
+        request_to_treat = settings.CONCURRENT_BACKUP_REQUEST - in_progress
+        if request_to_treat <= 0:
+            self.stdout.write("Maximum concurrent requests reached. Doing nothing.\n")
+            return
+
+        pending_requests = InvoiceArchiveRequest.objects.filter(state=BACKUP_RESTORE_STATE_PENDING).order_by('creation_datetime')[:request_to_treat]
+        self.stdout.write("%i requests will be treated.\n" % (len(pending_requests)))
+        for request in pending_requests:
+            request.archive()
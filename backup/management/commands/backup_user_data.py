@@ -1,7 +1,7 @@
 from django.core.management.base import BaseCommand
 from django.conf import settings
 from backup.models import BackupRequest, BACKUP_RESTORE_STATE_IN_PROGRESS, \
-    BACKUP_RESTORE_STATE_PENDING
+    BACKUP_RESTORE_STATE_PENDING, claim_request
 import datetime
 
 class Command(BaseCommand):
@@ -25,4 +25,5 @@ class Command(BaseCommand):
         pending_requests = BackupRequest.objects.filter(state=BACKUP_RESTORE_STATE_PENDING).order_by('creation_datetime')[:request_to_treat]
         self.stdout.write("%i requests will be treated.\n" % (len(pending_requests)))
         for request in pending_requests:
-            request.backup()
+            if claim_request(request):
+                request.backup()
@@ -0,0 +1,105 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.db import connection
+from backup.models import BackupRequest, RestoreRequest, \
+    BACKUP_RESTORE_STATE_PENDING, claim_request, recover_stale_requests, \
+    get_queue_stats, run_request
+import multiprocessing
+import time
+
+class Command(BaseCommand):
+    help = 'Execute backup and restore requests as soon as they are made'
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', dest='processes',
+                    default=getattr(settings, 'BACKUP_WORKER_PROCESSES', settings.CONCURRENT_BACKUP_REQUEST),
+                    help='Number of requests executed at the same time'),
+        make_option('--interval', type='int', dest='interval',
+                    default=getattr(settings, 'BACKUP_WORKER_INTERVAL', 5),
+                    help='Seconds to wait between two checks of the queue'),
+        make_option('--stale-timeout', type='int', dest='stale_timeout',
+                    default=getattr(settings, 'BACKUP_STALE_TIMEOUT', 60),
+                    help='Minutes without progress after which a request in progress is considered lost'),
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help='Exit when the queue is empty'),
+    )
+
+    def write_stats(self):
+        """
+        writes queue depth and wait when they changed since last call
+        """
+        stats = [get_queue_stats(model) for model in [BackupRequest, RestoreRequest]]
+        if stats == getattr(self, 'last_stats', None):
+            return
+        self.last_stats = stats
+        for model, stats in zip([BackupRequest, RestoreRequest], stats):
+            self.stdout.write("%s: %i pending, %i in progress, oldest pending for %is.\n" % (model._meta.object_name,
+                                                                                           stats['pending'],
+                                                                                           stats['in_progress'],
+                                                                                           stats['oldest_pending_wait']))
+
+    def write_done(self, key, get_duration):
+        try:
+            self.stdout.write("%s %i done in %is.\n" % (key[0], key[1], get_duration()))
+        except Exception as e:
+            self.stdout.write("%s %i failed: %s.\n" % (key[0], key[1], e))
+
+    def handle(self, *args, **options):
+        processes = options['processes']
+        pool = None
+        if processes > 1:
+            # forked processes must not share the database connection
+            connection.close()
+            pool = multiprocessing.Pool(processes)
+
+        # (model name, request id) -> result of requests being executed
+        running = {}
+        # a pool process which died leaves a result which is never ready
+        lost = False
+        try:
+            while True:
+                for key, result in running.items():
+                    if result.ready():
+                        del running[key]
+                        self.write_done(key, result.get)
+
+                for model in [BackupRequest, RestoreRequest]:
+                    # requests running here save their progress, they only
+                    # go stale when their process died
+                    recovered = recover_stale_requests(model, options['stale_timeout'])
+                    for request_id in recovered:
+                        if running.pop((model._meta.object_name, request_id), None):
+                            lost = True
+                    if recovered:
+                        self.stdout.write("%i stale %s put back in queue.\n" % (len(recovered), model._meta.object_name))
+
+                pending_requests = list(BackupRequest.objects.filter(state=BACKUP_RESTORE_STATE_PENDING)) \
+                                   + list(RestoreRequest.objects.filter(state=BACKUP_RESTORE_STATE_PENDING))
+                pending_requests.sort(key=lambda request: request.creation_datetime)
+                if pending_requests or running:
+                    self.write_stats()
+
+                for request in pending_requests[:max(processes - len(running), 0)]:
+                    if not claim_request(request):
+                        continue
+                    wait = request.last_state_datetime - request.creation_datetime
+                    key = (request._meta.object_name, request.id)
+                    self.stdout.write("%s %i claimed after waiting %is.\n" % (key[0], key[1], wait.days * 86400 + wait.seconds))
+                    if pool:
+                        running[key] = pool.apply_async(run_request, (key,))
+                    else:
+                        self.write_done(key, lambda: run_request(key))
+
+                if options['once'] and not running \
+                and not BackupRequest.objects.filter(state=BACKUP_RESTORE_STATE_PENDING).count() \
+                and not RestoreRequest.objects.filter(state=BACKUP_RESTORE_STATE_PENDING).count():
+                    break
+
+                time.sleep(options['interval'])
+        finally:
+            if pool and lost:
+                # joining would wait for the results of lost requests
+                pool.terminate()
+            elif pool:
+                pool.close()
+                pool.join()
@@ -1,7 +1,7 @@
 from django.core.management.base import BaseCommand
 from django.conf import settings
 from backup.models import BackupRequest, BACKUP_RESTORE_STATE_IN_PROGRESS, \
-    BACKUP_RESTORE_STATE_PENDING, RestoreRequest
+    BACKUP_RESTORE_STATE_PENDING, RestoreRequest, claim_request
 import datetime
 
 class Command(BaseCommand):
@@ -25,8 +25,5 @@ class Command(BaseCommand):
         pending_requests = RestoreRequest.objects.filter(state=BACKUP_RESTORE_STATE_PENDING).order_by('creation_datetime')[:request_to_treat]
         self.stdout.write("%i requests will be treated.\n" % (len(pending_requests)))
         for request in pending_requests:
-            #request.state = BACKUP_RESTORE_STATE_IN_PROGRESS
-            request.last_state_datetime = datetime.datetime.now()
-            request.save()
-
-            request.restore()
+            if claim_request(request):
+                request.restore()
@@ -0,0 +1,171 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Adding field 'RestoreRequest.start_datetime'
+        db.add_column('backup_restorerequest', 'start_datetime', self.gf('django.db.models.fields.DateTimeField')(null=True, blank=True), keep_default=False)
+
+        # Adding field 'RestoreRequest.end_datetime'
+        db.add_column('backup_restorerequest', 'end_datetime', self.gf('django.db.models.fields.DateTimeField')(null=True, blank=True), keep_default=False)
+
+        # Adding field 'RestoreRequest.object_count'
+        db.add_column('backup_restorerequest', 'object_count', self.gf('django.db.models.fields.IntegerField')(default=0), keep_default=False)
+
+        # Adding field 'RestoreRequest.total_object_count'
+        db.add_column('backup_restorerequest', 'total_object_count', self.gf('django.db.models.fields.IntegerField')(null=True, blank=True), keep_default=False)
+
+        # Adding field 'RestoreRequest.byte_count'
+        db.add_column('backup_restorerequest', 'byte_count', self.gf('django.db.models.fields.BigIntegerField')(default=0), keep_default=False)
+
+        # Adding field 'RestoreRequest.total_byte_count'
+        db.add_column('backup_restorerequest', 'total_byte_count', self.gf('django.db.models.fields.BigIntegerField')(null=True, blank=True), keep_default=False)
+
+        # Adding field 'BackupRequest.start_datetime'
+        db.add_column('backup_backuprequest', 'start_datetime', self.gf('django.db.models.fields.DateTimeField')(null=True, blank=True), keep_default=False)
+
+        # Adding field 'BackupRequest.end_datetime'
+        db.add_column('backup_backuprequest', 'end_datetime', self.gf('django.db.models.fields.DateTimeField')(null=True, blank=True), keep_default=False)
+
+        # Adding field 'BackupRequest.object_count'
+        db.add_column('backup_backuprequest', 'object_count', self.gf('django.db.models.fields.IntegerField')(default=0), keep_default=False)
+
+        # Adding field 'BackupRequest.total_object_count'
+        db.add_column('backup_backuprequest', 'total_object_count', self.gf('django.db.models.fields.IntegerField')(null=True, blank=True), keep_default=False)
+
+        # Adding field 'BackupRequest.byte_count'
+        db.add_column('backup_backuprequest', 'byte_count', self.gf('django.db.models.fields.BigIntegerField')(default=0), keep_default=False)
+
+        # Adding field 'BackupRequest.total_byte_count'
+        db.add_column('backup_backuprequest', 'total_byte_count', self.gf('django.db.models.fields.BigIntegerField')(null=True, blank=True), keep_default=False)
+
+
+    def backwards(self, orm):
+        
+        # Deleting field 'RestoreRequest.start_datetime'
+        db.delete_column('backup_restorerequest', 'start_datetime')
+
+        # Deleting field 'RestoreRequest.end_datetime'
+        db.delete_column('backup_restorerequest', 'end_datetime')
+
+        # Deleting field 'RestoreRequest.object_count'
+        db.delete_column('backup_restorerequest', 'object_count')
+
+        # Deleting field 'RestoreRequest.total_object_count'
+        db.delete_column('backup_restorerequest', 'total_object_count')
+
+        # Deleting field 'RestoreRequest.byte_count'
+        db.delete_column('backup_restorerequest', 'byte_count')
+
+        # Deleting field 'RestoreRequest.total_byte_count'
+        db.delete_column('backup_restorerequest', 'total_byte_count')
+
+        # Deleting field 'BackupRequest.start_datetime'
+        db.delete_column('backup_backuprequest', 'start_datetime')
+
+        # Deleting field 'BackupRequest.end_datetime'
+        db.delete_column('backup_backuprequest', 'end_datetime')
+
+        # Deleting field 'BackupRequest.object_count'
+        db.delete_column('backup_backuprequest', 'object_count')
+
+        # Deleting field 'BackupRequest.total_object_count'
+        db.delete_column('backup_backuprequest', 'total_object_count')
+
+        # Deleting field 'BackupRequest.byte_count'
+        db.delete_column('backup_backuprequest', 'byte_count')
+
+        # Deleting field 'BackupRequest.total_byte_count'
+        db.delete_column('backup_backuprequest', 'total_byte_count')
+
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'backup.backuprequest': {
+            'Meta': {'object_name': 'BackupRequest'},
+            'byte_count': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'creation_datetime': ('django.db.models.fields.DateTimeField', [], {}),
+            'end_datetime': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'error_message': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'incremental': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_backup_datetime': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'last_state_datetime': ('django.db.models.fields.DateTimeField', [], {}),
+            'object_count': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'since_datetime': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'start_datetime': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'state': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'total_byte_count': ('django.db.models.fields.BigIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'total_object_count': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'user': ('django.db.models.fields.related.OneToOneField', [], {'to': "orm['auth.User']", 'unique': 'True'})
+        },
+        'backup.invoicearchiverequest': {
+            'Meta': {'object_name': 'InvoiceArchiveRequest'},
+            'creation_datetime': ('django.db.models.fields.DateTimeField', [], {}),
+            'error_message': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_state_datetime': ('django.db.models.fields.DateTimeField', [], {}),
+            'state': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'user': ('django.db.models.fields.related.OneToOneField', [], {'to': "orm['auth.User']", 'unique': 'True'}),
+            'year': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'backup.restorerequest': {
+            'Meta': {'object_name': 'RestoreRequest'},
+            'action': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'backup_file': ('django.db.models.fields.files.FileField', [], {'max_length': '100', 'null': 'True', 'blank': 'True'}),
+            'byte_count': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'creation_datetime': ('django.db.models.fields.DateTimeField', [], {}),
+            'end_datetime': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'error_message': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_state_datetime': ('django.db.models.fields.DateTimeField', [], {}),
+            'object_count': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'start_datetime': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'state': ('django.db.models.fields.IntegerField', [], {'default': '1'}),
+            'total_byte_count': ('django.db.models.fields.BigIntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'total_object_count': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'user': ('django.db.models.fields.related.OneToOneField', [], {'to': "orm['auth.User']", 'unique': 'True'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        }
+    }
+
+    complete_apps = ['backup']
@@ -3,26 +3,52 @@ import datetime
 import shutil
 import tarfile
 import gzip
-
-from xml.dom import pulldom
-from django.db import models, transaction
+import zipfile
+import itertools
+import multiprocessing
+import tempfile
+import time
+import hashlib
+from cStringIO import StringIO
+
+from xml.etree.cElementTree import iterparse
+from django.db import models, transaction, connection, connections, DEFAULT_DB_ALIAS
+from django.db.models.aggregates import Min
+from django.db.models.signals import post_save, post_delete
+from django.db.models.query_utils import Q
 from django.contrib.auth.models import User
 from django.utils.translation import ugettext_lazy as _
 from contact.models import Contact, PhoneNumber, Address, Country
-from core.models import OwnedObject
-from project.models import Contract, Project, Proposal, ProposalRow
-from accounts.models import Invoice, InvoiceRow, Expense
+from core.models import OwnedObject, DeletedObject
+from project.models import Contract, Project, Proposal, ProposalRow, batch_edit, \
+    store as upload_store
+from accounts.models import Invoice, InvoiceRow, Expense, INVOICE_STATE_SENT, \
+    SalesLedgerEntry, update_sales_ledger, release_invoice_id
 import unicodedata
 from django.conf import settings
 from django.core.files.storage import FileSystemStorage
+from django.core.files.base import File
+from core.storage import file_digest
 from django.utils.encoding import smart_unicode
+from django.utils import simplejson
 from django.utils.xmlutils import SimplerXMLGenerator
 from core.context_processors import common
 from django.db.models.fields.related import ForeignKey, OneToOneField
 import os
 import errno
-from django.core.serializers.xml_serializer import getInnerText
 from django.core.mail import mail_admins
+from django.http import HttpResponse
+
+# generated xml is kept in memory up to this size before using a temporary file
+BACKUP_XML_SPOOL_SIZE = 1024 * 1024
+# number of objects of the same model whose existence is checked in one query on restore
+RESTORE_BATCH_SIZE = 500
+# minimum number of seconds between two saves of the progress of a backup or restore
+PROGRESS_SAVE_INTERVAL = getattr(settings, 'BACKUP_PROGRESS_INTERVAL', 2)
+# database alias of the connection used to save progress
+PROGRESS_DATABASE = 'backup_progress'
+# fields derived from the owner or the rows of objects, not exported
+BACKUP_EXCLUDED_FIELDS = ['ownedobject_ptr', 'invoice_owner', 'invoiced_amount', 'balanced', 'balanced_by_sent_invoice', 'natures']
 
 BACKUP_RESTORE_STATE_PENDING = 1
 BACKUP_RESTORE_STATE_IN_PROGRESS = 2
@@ -42,17 +68,203 @@ def mkdir_p(dir):
         else:
             raise
 
-class BackupRequest(models.Model):
+def claim_request(request):
+    """
+    Moves a pending request to in progress with a single update so that
+    only one worker can claim it. Returns False if it was already claimed
+    """
+    now = datetime.datetime.now()
+    claimed = request.__class__.objects.filter(pk=request.pk,
+                                               state=BACKUP_RESTORE_STATE_PENDING)\
+                                       .update(state=BACKUP_RESTORE_STATE_IN_PROGRESS,
+                                               last_state_datetime=now)
+    if not claimed:
+        return False
+    request.state = BACKUP_RESTORE_STATE_IN_PROGRESS
+    request.last_state_datetime = now
+    return True
+
+def recover_stale_requests(model, timeout):
+    """
+    Puts back in the queue requests in progress whose state or progress
+    hasn't been saved for more than timeout minutes, ie left by a worker
+    or a worker process which died. Returns the ids of requests recovered
+    """
+    limit = datetime.datetime.now() - datetime.timedelta(minutes=timeout)
+    stale_requests = model.objects.filter(state=BACKUP_RESTORE_STATE_IN_PROGRESS,
+                                          last_state_datetime__lt=limit)
+    recovered = []
+    for request_id in stale_requests.values_list('pk', flat=True):
+        # another worker may recover it first
+        if stale_requests.filter(pk=request_id).update(state=BACKUP_RESTORE_STATE_PENDING):
+            recovered.append(request_id)
+    return recovered
+
+def get_queue_stats(model):
+    """
+    Returns queue depth and the wait of the oldest pending request in seconds
+    """
+    pending = model.objects.filter(state=BACKUP_RESTORE_STATE_PENDING)
+    oldest = pending.aggregate(oldest=Min('creation_datetime'))['oldest']
+    wait = 0
+    if oldest:
+        delta = datetime.datetime.now() - oldest
+        wait = delta.days * 86400 + delta.seconds
+    return {'pending': pending.count(),
+            'in_progress': model.objects.filter(state=BACKUP_RESTORE_STATE_IN_PROGRESS).count(),
+            'oldest_pending_wait': wait}
+
+def run_request(args):
+    """
+    Executes a claimed backup or restore request and returns its duration
+    in seconds
+    """
+    model_name, request_id = args
+    start = datetime.datetime.now()
+    if model_name == 'BackupRequest':
+        BackupRequest.objects.get(pk=request_id).backup()
+    else:
+        RestoreRequest.objects.get(pk=request_id).restore()
+    delta = datetime.datetime.now() - start
+    return delta.days * 86400 + delta.seconds
+
+def get_progress_database():
+    """
+    Restores run in a transaction, progress is saved with its own
+    connection to be visible before the restore is committed. Without
+    this database in settings, progress is only visible at the end.
+    """
+    if PROGRESS_DATABASE in settings.DATABASES:
+        return PROGRESS_DATABASE
+    return DEFAULT_DB_ALIAS
+
+def close_progress_database():
+    if PROGRESS_DATABASE in settings.DATABASES:
+        connections[PROGRESS_DATABASE].close()
+
+class ProgressRequest(models.Model):
+    """
+    Progress of a backup or restore, saved at most every
+    PROGRESS_SAVE_INTERVAL seconds while it runs
+    """
+    start_datetime = models.DateTimeField(null=True, blank=True, verbose_name=_('Start date'))
+    end_datetime = models.DateTimeField(null=True, blank=True, verbose_name=_('End date'))
+    object_count = models.IntegerField(default=0, verbose_name=_('Objects'))
+    total_object_count = models.IntegerField(null=True, blank=True)
+    byte_count = models.BigIntegerField(default=0, verbose_name=_('Bytes'))
+    total_byte_count = models.BigIntegerField(null=True, blank=True)
+
+    class Meta:
+        abstract = True
+
+    def reset_progress(self):
+        self.start_datetime = datetime.datetime.now()
+        self.end_datetime = None
+        self.object_count = 0
+        self.total_object_count = None
+        self.byte_count = 0
+        self.total_byte_count = None
+
+    def update_progress(self, object_count=None, byte_count=None, force=False):
+        if object_count is not None:
+            self.object_count = object_count
+        if byte_count is not None:
+            self.byte_count = byte_count
+        if force or time.time() - getattr(self, '_progress_save_time', 0) >= PROGRESS_SAVE_INTERVAL:
+            self.save_progress()
+
+    def save_progress(self):
+        self._progress_save_time = time.time()
+        # requests executed without being saved, ie in tests, have no progress
+        if self.pk:
+            values = {'start_datetime': self.start_datetime,
+                      'end_datetime': self.end_datetime,
+                      'object_count': self.object_count,
+                      'total_object_count': self.total_object_count,
+                      'byte_count': self.byte_count,
+                      'total_byte_count': self.total_byte_count}
+            if self.state == BACKUP_RESTORE_STATE_IN_PROGRESS:
+                # heartbeat telling recover_stale_requests the request is
+                # still running. last_state_datetime of the instance is kept,
+                # backups use it as the date of their snapshot
+                values['last_state_datetime'] = datetime.datetime.now()
+            self.__class__.objects.using(get_progress_database())\
+                                  .filter(pk=self.pk)\
+                                  .update(**values)
+
+    def get_duration(self):
+        """
+        Seconds spent since start, until end if finished
+        """
+        if not self.start_datetime:
+            return None
+        delta = (self.end_datetime or datetime.datetime.now()) - self.start_datetime
+        return delta.days * 86400 + delta.seconds + delta.microseconds / 1000000.0
+    get_duration.short_description = _('Duration')
+
+    def get_objects_per_second(self):
+        duration = self.get_duration()
+        if not duration:
+            return None
+        return round(self.object_count / duration, 1)
+    get_objects_per_second.short_description = _('Objects/s')
+
+    def get_eta(self):
+        """
+        Estimated seconds until the end from the progress on objects,
+        or bytes when the number of objects isn't known
+        """
+        if self.end_datetime or not self.start_datetime:
+            return None
+        if self.total_object_count:
+            done, total = self.object_count, self.total_object_count
+        elif self.total_byte_count:
+            done, total = self.byte_count, self.total_byte_count
+        else:
+            return None
+        if not done:
+            return None
+        return int(self.get_duration() * max(total - done, 0) / done)
+
+    def get_queue_position(self):
+        """
+        Number of pending requests to execute before this one
+        """
+        if self.state <> BACKUP_RESTORE_STATE_PENDING:
+            return 0
+        return self.__class__.objects.filter(state=BACKUP_RESTORE_STATE_PENDING,
+                                             creation_datetime__lt=self.creation_datetime).count()
+
+    def get_progress(self):
+        return {'state': self.state,
+                'state_display': unicode(self.get_state_display()),
+                'pending': self.state <= BACKUP_RESTORE_STATE_IN_PROGRESS,
+                'queue_position': self.get_queue_position(),
+                'object_count': self.object_count,
+                'total_object_count': self.total_object_count,
+                'byte_count': self.byte_count,
+                'total_byte_count': self.total_byte_count,
+                'eta': self.get_eta()}
+
+class BackupRequest(ProgressRequest):
     user = models.OneToOneField(User)
     state = models.IntegerField(choices=BACKUP_RESTORE_STATE, default=BACKUP_RESTORE_STATE_PENDING)
     creation_datetime = models.DateTimeField()
     last_state_datetime = models.DateTimeField()
     error_message = models.CharField(max_length=255, null=True, blank=True)
+    incremental = models.BooleanField(default=False,
+                                      verbose_name=_('Incremental'),
+                                      help_text=_('Only save changes since your last backup. Restore your last full backup then each incremental backup in order to recover your data.'))
+    # changes saved by the last backup are those made since this date, None for a full backup
+    since_datetime = models.DateTimeField(null=True, blank=True)
+    last_backup_datetime = models.DateTimeField(null=True, blank=True)
 
     def is_done(self):
         return self.state == BACKUP_RESTORE_STATE_DONE
 
     def get_backup_filename(self):
+        if self.since_datetime:
+            return 'backup_%s_incremental.tar.gz' % (self.creation_datetime.strftime('%Y%m%d%H%M'))
         return 'backup_%s.tar.gz' % (self.creation_datetime.strftime('%Y%m%d%H%M'))
 
     def backup(self):
@@ -80,35 +292,61 @@ class BackupRequest(models.Model):
 
         self.state = BACKUP_RESTORE_STATE_IN_PROGRESS
         self.last_state_datetime = datetime.datetime.now()
+        self.since_datetime = None
+        if self.incremental:
+            self.since_datetime = self.last_backup_datetime
+        self.reset_progress()
         self.save()
 
-        self.backup_dir = '%s%s/backup/backup_%s' % (settings.FILE_UPLOAD_DIR,
-                                                     self.user.get_profile().uuid,
-                                                     self.creation_datetime.strftime('%Y%m%d%H%M'))
+        backup_dir = '%s%s/backup' % (settings.FILE_UPLOAD_DIR,
+                                      self.user.get_profile().uuid)
         try:
-            # delete previous export dir
-            shutil.rmtree('%s%s/backup' % (settings.FILE_UPLOAD_DIR,
-                                           self.user.get_profile().uuid),
-                                           True)
+            # delete previous export
+            shutil.rmtree(backup_dir, True)
+            mkdir_p(backup_dir)
+
+            # the archive is built directly from the generated xml and
+            # the uploaded files, without copying them to a directory first
+            file = gzip.GzipFile('%s/%s' % (backup_dir, self.get_backup_filename()), 'w')
+            tar = tarfile.TarFile(mode='w', fileobj=file, tarinfo=BackupTarInfo)
 
-            # create export dir
-            mkdir_p(self.backup_dir)
+            root = BackupTarInfo('backup')
+            root.type = tarfile.DIRTYPE
+            root.mode = 0755
+            root.mtime = time.time()
+            tar.addfile(root)
 
             # backup objects
-            self.stream = open("%s/data.xml" % (self.backup_dir), 'w')
+            self.stream = tempfile.SpooledTemporaryFile(max_size=BACKUP_XML_SPOOL_SIZE)
             self.backup_objects()
+            data = BackupTarInfo('backup/data.xml')
+            data.size = self.stream.tell()
+            data.mode = 0644
+            data.mtime = root.mtime
+            self.stream.seek(0)
+            tar.addfile(data, self.stream)
             self.stream.close()
 
             # backup files
-            self.backup_files()
+            self.backup_files(tar)
+
+            # manifest is checked before restoring anything
+            manifest = simplejson.dumps(self.manifest)
+            info = BackupTarInfo('backup/manifest.json')
+            info.size = len(manifest)
+            info.mode = 0644
+            info.mtime = root.mtime
+            tar.addfile(info, StringIO(manifest))
 
-            # create the archive
-            file = gzip.GzipFile('%s.tar.gz' % (self.backup_dir), 'w')
-            tar = tarfile.TarFile(mode='w', fileobj=file, tarinfo=BackupTarInfo)
-            tar.add(self.backup_dir, 'backup')
             tar.close()
             file.close()
+            self.byte_count = os.path.getsize('%s/%s' % (backup_dir, self.get_backup_filename()))
 
+            if not self.since_datetime:
+                # deletions before a full backup won't be needed anymore
+                DeletedObject.objects.filter(owner=self.user,
+                                             deletion_datetime__lt=self.last_state_datetime).delete()
+            self.last_backup_datetime = self.last_state_datetime
             self.state = BACKUP_RESTORE_STATE_DONE
         except Exception as e:
             self.state = BACKUP_RESTORE_STATE_ERROR
@@ -118,45 +356,92 @@ class BackupRequest(models.Model):
                                                                                          'message': e}
             mail_admins(mail_subject, mail_message, fail_silently=(not settings.DEBUG))
 
-        shutil.rmtree(self.backup_dir, True)
         self.last_state_datetime = datetime.datetime.now()
+        self.end_datetime = self.last_state_datetime
         self.save()
+        close_progress_database()
 
     def indent(self, level):
         self.xml.ignorableWhitespace('\n' + ' ' * 4 * level)
 
+    def get_related_uuid(self, object, field):
+        """
+        Returns the uuid of the object referenced by field, looked up in
+        the uuids loaded by backup_objects
+        """
+        related_id = getattr(object, field.attname)
+        if related_id not in self.uuids:
+            self.uuids[related_id] = getattr(object, field.name).uuid
+        return self.uuids[related_id]
+
     def backup_objects(self):
         models = [Address, Contact, Contract, PhoneNumber, Project, Proposal, ProposalRow, Invoice, InvoiceRow, Expense]
 
+        # related objects are resolved from these maps instead of being
+        # fetched for each object
+        self.uuids = dict(OwnedObject.objects.filter(owner=self.user).values_list('id', 'uuid'))
+        country_codes = dict(Country.objects.values_list('id', 'country_code2'))
+        profile_addresses = set(Address.objects.filter(owner=self.user,
+                                                       userprofile__isnull=False).values_list('id', flat=True))
+
         self.xml = SimplerXMLGenerator(self.stream, settings.DEFAULT_CHARSET)
         self.xml.startDocument()
-        self.xml.startElement("aemanager", {"version" : common()['version']})
-
+        attrs = {"version" : common()['version']}
+        if self.since_datetime:
+            attrs['since'] = self.since_datetime.isoformat()
+        self.xml.startElement("aemanager", attrs)
+
+        self.manifest = {'version': attrs['version'],
+                         'since': attrs.get('since'),
+                         'objects': {},
+                         'files': {}}
+        uuid_digest = hashlib.sha1()
+
+        querysets = []
         for model in models:
-            for object in model.objects.filter(owner=self.user):
+            objects = model.objects.filter(owner=self.user)
+            if self.since_datetime:
+                objects = objects.filter(Q(modification_datetime__gte=self.since_datetime)
+                                         | Q(modification_datetime__isnull=True))
+            querysets.append((model, objects))
+        self.total_object_count = sum([objects.exclude(id__in=profile_addresses).count() for model, objects in querysets])
+        self.update_progress(0, force=True)
+
+        for model, objects in querysets:
+            many_to_many = {}
+            for field in model._meta.many_to_many:
+                through = field.rel.through
+                from_name = field.m2m_field_name()
+                to_name = field.m2m_reverse_field_name()
+                many_to_many[field.name] = {}
+                relations = through.objects.filter(**{'%s__owner' % (from_name): self.user})\
+                                           .order_by('id')\
+                                           .values_list(from_name, to_name)
+                for from_id, to_id in relations:
+                    many_to_many[field.name].setdefault(from_id, []).append(to_id)
+
+            for object in objects:
                 # do not export address of user profile
-                if not(type(object) == Address and object.userprofile_set.count()):
+                if not(type(object) == Address and object.id in profile_addresses):
                     self.indent(1)
                     self.xml.startElement(object._meta.object_name, {'uuid': object.uuid})
                     for field in object._meta.local_fields:
-                        if field.name not in ['ownedobject_ptr']:
+                        if field.name not in BACKUP_EXCLUDED_FIELDS:
                             self.indent(2)
                             self.xml.startElement(field.name, {})
-                            if getattr(object, field.name) is not None:
+                            if getattr(object, field.attname) is not None:
                                 if type(field) == ForeignKey:
-                                    related = getattr(object, field.name)
-                                    if type(related) == Country:
+                                    if field.rel.to == Country:
                                         self.xml.addQuickElement("object", attrs={
-                                          'country_code' : smart_unicode(related.country_code2)
+                                          'country_code' : smart_unicode(country_codes[getattr(object, field.attname)])
                                         })
                                     else:
                                         self.xml.addQuickElement("object", attrs={
-                                          'uuid' : smart_unicode(related.uuid)
+                                          'uuid' : smart_unicode(self.get_related_uuid(object, field))
                                         })
                                 elif type(field) == OneToOneField:
-                                    related = getattr(object, field.name)
                                     self.xml.addQuickElement("object", attrs={
-                                      'uuid' : smart_unicode(related.uuid)
+                                      'uuid' : smart_unicode(self.get_related_uuid(object, field))
                                     })
                                 else:
                                     self.xml.characters(field.value_to_string(object))
@@ -167,30 +452,61 @@ class BackupRequest(models.Model):
                     for field in object._meta.many_to_many:
                         self.indent(2)
                         self.xml.startElement(field.name, {})
-                        for relobj in getattr(object, field.name).iterator():
+                        for related_id in many_to_many[field.name].get(object.id, []):
                             self.indent(3)
                             self.xml.addQuickElement("object", attrs={
-                              'uuid' : smart_unicode(relobj.uuid)
+                              'uuid' : smart_unicode(self.uuids[related_id])
                             })
                         self.indent(2)
                         self.xml.endElement(field.name)
 
                     self.indent(1)
                     self.xml.endElement(smart_unicode(object._meta.object_name))
+                    object_name = object._meta.object_name
+                    self.manifest['objects'][object_name] = self.manifest['objects'].get(object_name, 0) + 1
+                    uuid_digest.update('%s\n' % (object.uuid))
+                    self.update_progress(self.object_count + 1, self.stream.tell())
+
+        if self.since_datetime:
+            # objects deleted then restored with the same uuid still exist
+            deleted_objects = DeletedObject.objects.filter(owner=self.user,
+                                                           deletion_datetime__gte=self.since_datetime)\
+                                                   .exclude(uuid__in=OwnedObject.objects.filter(owner=self.user).values('uuid'))
+            for uuid in deleted_objects.values_list('uuid', flat=True).distinct():
+                self.indent(1)
+                self.xml.addQuickElement("deleted", attrs={'uuid': uuid})
 
         self.indent(0)
         self.xml.endElement("aemanager")
         self.xml.endDocument()
+        self.manifest['uuids'] = uuid_digest.hexdigest()
 
-    def backup_files(self):
+    def backup_files(self, tar):
         dirs = ['contract', 'logo', 'proposal']
+        since = None
+        if self.since_datetime:
+            since = time.mktime(self.since_datetime.timetuple())
         for dir in dirs:
             from_path = '%s%s/%s' % (settings.FILE_UPLOAD_DIR,
                                       self.user.get_profile().uuid,
                                       dir)
-            to_path = '%s/%s' % (self.backup_dir, dir)
-            if os.path.exists(from_path):
-                shutil.copytree(from_path, to_path)
+            for path, dirnames, filenames in os.walk(from_path):
+                dirnames.sort()
+                arc_path = 'backup/%s%s' % (dir, path[len(from_path):])
+                if not since:
+                    tar.add(path, arc_path, recursive=False)
+                for filename in sorted(filenames):
+                    file_path = os.path.join(path, filename)
+                    # a file linked to an existing blob keeps the blob mtime,
+                    # the link changes its ctime
+                    if since and os.path.getctime(file_path) < since:
+                        continue
+                    tar.add(file_path, '%s/%s' % (arc_path, filename))
+                    file = open(file_path, 'rb')
+                    try:
+                        self.manifest['files']['%s/%s' % (arc_path, filename)] = file_digest(file)
+                    finally:
+                        file.close()
 
 RESTORE_ACTION_ADD_MISSING = 1
 RESTORE_ACTION_ADD_AND_UPDATE = 2
@@ -199,12 +515,29 @@ RESTORE_ACTION = ((RESTORE_ACTION_ADD_MISSING, _('Only add missing entries')),
                   (RESTORE_ACTION_ADD_AND_UPDATE, _('Add missing entries and update existing ones')),
                   (RESTORE_ACTION_DELETE_ALL_AND_RESTORE, _('Delete all your data and restore this backup')))
 
+# restored models, in order of dependencies
+RESTORE_MODELS = [Address, Contact, Contract, PhoneNumber, Project, Proposal, ProposalRow, Invoice, InvoiceRow, Expense]
+# directories of uploaded files restored from the archive
+RESTORE_FILE_DIRS = ['proposal', 'contract', 'logo']
+
 store = FileSystemStorage(location=settings.FILE_UPLOAD_DIR)
 
+def record_deleted_object(sender, instance, **kwargs):
+    # without a completed or running backup, the next backup is a full one
+    # and has no use of deletions
+    backups = BackupRequest.objects.filter(Q(last_backup_datetime__isnull=False)
+                                           | Q(state=BACKUP_RESTORE_STATE_IN_PROGRESS),
+                                           user=instance.owner_id)
+    if backups.exists():
+        DeletedObject.objects.create(owner_id=instance.owner_id,
+                                     uuid=instance.uuid)
+
+post_delete.connect(record_deleted_object, sender=OwnedObject)
+
 def restore_upload_to_handler(instance, filename):
     return "%s/restore/%s" % (instance.user.get_profile().uuid, unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore'))
 
-class RestoreRequest(models.Model):
+class RestoreRequest(ProgressRequest):
     user = models.OneToOneField(User)
     state = models.IntegerField(choices=BACKUP_RESTORE_STATE, default=BACKUP_RESTORE_STATE_PENDING)
     action = models.IntegerField(choices=RESTORE_ACTION, verbose_name=_('Action'), default=RESTORE_ACTION_ADD_MISSING)
@@ -237,26 +570,34 @@ class RestoreRequest(models.Model):
 
     def restore(self):
         self.state = BACKUP_RESTORE_STATE_IN_PROGRESS
+        self.reset_progress()
         self.save()
 
-        transaction.commit_unless_managed()
-        transaction.enter_transaction_management()
-        transaction.managed(True)
+        self.tar = None
         try:
             self.tar = tarfile.open(self.backup_file.path, 'r:gz')
 
-            # extract data.xml for parsing
-            self.stream = self.tar.extractfile('backup/data.xml')
-            self.restore_objects()
+            # invalid archives are rejected before any write
+            self.validate()
+
+            transaction.commit_unless_managed()
+            transaction.enter_transaction_management()
+            transaction.managed(True)
+            try:
+                # extract data.xml for parsing
+                self.stream = self.tar.extractfile('backup/data.xml')
+                self.restore_objects()
 
-            self.restore_files()
+                self.restore_files()
 
-            transaction.commit()
-            transaction.leave_transaction_management()
+                transaction.commit()
+            except:
+                transaction.rollback()
+                raise
+            finally:
+                transaction.leave_transaction_management()
             self.state = BACKUP_RESTORE_STATE_DONE
         except Exception as e:
-            transaction.rollback()
-            transaction.leave_transaction_management()
             self.state = BACKUP_RESTORE_STATE_ERROR
             self.error_message = e.__unicode__()
             mail_subject = _('Restore failed')
@@ -264,167 +605,418 @@ class RestoreRequest(models.Model):
                                                                                          'message': e}
             mail_admins(mail_subject, mail_message, fail_silently=(not settings.DEBUG))
 
+        self.end_datetime = datetime.datetime.now()
         self.save()
+        close_progress_database()
 
         # close and delete archive
-        self.tar.close()
+        if self.tar:
+            self.tar.close()
         os.remove(self.backup_file.path)
         self.backup_file = None
 
+    def validate(self):
+        """
+        Checks the archive in one pass over data.xml and the files without
+        writing anything: only objects of the restored models, each defined
+        once, references to objects of the archive or, for an incremental
+        backup, of the user, and contents matching the manifest if any.
+        """
+        manifest = None
+        if 'backup/manifest.json' in self.tar.getnames():
+            manifest = simplejson.loads(self.tar.extractfile('backup/manifest.json').read())
+
+        model_name_dict = dict([(model._meta.object_name, model) for model in RESTORE_MODELS])
+        data = self.tar.extractfile('backup/data.xml')
+        self.total_byte_count = self.tar.getmember('backup/data.xml').size
+        uuids = set()
+        missing_uuids = set()
+        country_codes = set()
+        object_counts = {}
+        uuid_digest = hashlib.sha1()
+        root = None
+        since = None
+        depth = 0
+        for event, element in iterparse(data, events=('start', 'end')):
+            if event == 'start':
+                depth = depth + 1
+                if depth == 1:
+                    root = element
+                    if element.tag != 'aemanager':
+                        raise Exception('Invalid backup file')
+                    since = element.get('since')
+                continue
+
+            depth = depth - 1
+            if depth != 1:
+                continue
+
+            uuid = element.get('uuid')
+            if element.tag == 'deleted':
+                pass
+            elif element.tag not in model_name_dict:
+                raise Exception('Unexpected %s in backup' % (element.tag))
+            elif not uuid or uuid in uuids:
+                raise Exception('Invalid uuid %s' % (uuid))
+            else:
+                uuids.add(uuid)
+                missing_uuids.discard(uuid)
+                object_counts[element.tag] = object_counts.get(element.tag, 0) + 1
+                uuid_digest.update('%s\n' % (uuid))
+                for related_element in element.findall('*/object'):
+                    if related_element.get('country_code') is not None:
+                        country_codes.add(related_element.get('country_code'))
+                    elif related_element.get('uuid') not in uuids:
+                        missing_uuids.add(related_element.get('uuid'))
+            root.clear()
+
+        if missing_uuids and since:
+            # unchanged objects referenced by an incremental backup
+            missing_uuids = missing_uuids - set(OwnedObject.objects.filter(owner=self.user,
+                                                                           uuid__in=missing_uuids)
+                                                                   .values_list('uuid', flat=True))
+        if missing_uuids:
+            raise Exception('Reference to a missing object')
+        if country_codes - set(Country.objects.filter(country_code2__in=country_codes)
+                                              .values_list('country_code2', flat=True)):
+            raise Exception('Reference to a missing country')
+
+        # digests are kept for restore_files
+        self.file_digests = {}
+        for member in self.tar:
+            if os.path.dirname(member.name).replace('backup/', '') in RESTORE_FILE_DIRS \
+            and (member.isfile() or member.islnk()):
+                self.file_digests[member.name] = file_digest(self.tar.extractfile(member))
+
+        if manifest:
+            if manifest.get('objects') != object_counts \
+            or manifest.get('uuids') != uuid_digest.hexdigest():
+                raise Exception('Objects do not match backup manifest')
+            if manifest.get('files') != self.file_digests:
+                raise Exception('Files do not match backup manifest')
+
+        self.total_object_count = len(uuids)
+        self.update_progress(force=True)
+
     def restore_objects(self):
-        def get_clean_value(node, model_name, field):
-            value = field.to_python(get_inner_text(node))
-            clean_method_name = 'clean_%s_%s' % (model_name.lower(), node.nodeName)
+        def get_clean_value(element, model_name, field):
+            value = field.to_python(smart_unicode(element.text or ''))
+            clean_method_name = 'clean_%s_%s' % (model_name.lower(), element.tag)
             if hasattr(self, clean_method_name):
                 clean_method = getattr(self, clean_method_name)
                 value = clean_method(value)
             return value
 
-        def get_inner_text(node):
+        def check_objects_exist(elements, klass):
             """
-            Get all the inner text of a DOM node (recursively).
+            Returns the objects to save for elements of klass, None for
+            objects to skip. Existence is checked in one query.
             """
-            # inspired by http://mail.python.org/pipermail/xml-sig/2005-March/011022.html
-            inner_text = []
-            for child in node.childNodes:
-                if child.nodeType == child.TEXT_NODE:
-                    inner_text.append(child.data)
-                elif child.nodeType == child.ELEMENT_NODE:
-                    inner_text.extend(getInnerText(child))
-                else:
-                    pass
-            return u"".join(inner_text)
-
-        def check_object_exists(node, klass):
-            uuid = node.getAttribute('uuid')
-            try:
-                object = klass.objects.get(uuid=uuid)
-                if object.owner <> self.user:
+            uuids = [element.get('uuid') for element in elements]
+            existing_objects = dict([(object.uuid, object) for object in klass.objects.filter(uuid__in=uuids)])
+            objects = []
+            for uuid in uuids:
+                object = existing_objects.get(uuid)
+                if object is None:
+                    # object not in database, can save it
+                    object = klass()
+                    object.uuid = uuid
+                    object.owner = self.user
+                elif object.owner_id <> self.user.id:
                     # import from another account, regenerate uuid to clone object
                     object = klass()
                     object.owner = self.user
+                elif self.action == RESTORE_ACTION_ADD_MISSING:
+                    self.substitution_map[uuid] = object.uuid
+                    object = None
                 else:
-                    if self.action == RESTORE_ACTION_ADD_MISSING:
-                        self.substitution_map[uuid] = object.uuid
-                        object = None
-            except:
-                # object not in database, can save it
-                object = klass()
-                object.uuid = uuid
-                object.owner = self.user
+                    # avoid fetching the owner on save
+                    object.owner = self.user
 
-            if object:
-                self.substitution_map[uuid] = object.uuid
+                if object:
+                    self.substitution_map[uuid] = '%s' % (object.uuid)
+                objects.append(object)
 
-            return object
+            return objects
 
-        def populate(object, node):
-            field_name_list = ['%s' % (field.name) for field in object._meta.local_fields if field.name <> 'ownedobject_ptr']
+        def populate(object, element):
+            field_name_list = ['%s' % (field.name) for field in object._meta.local_fields if field.name not in BACKUP_EXCLUDED_FIELDS]
 
-            for child in node.childNodes:
-                field_name = child.nodeName
+            for child in element:
+                field_name = child.tag
                 if field_name in field_name_list:
-                    if child.getElementsByTagName('None'):
+                    if child.find('None') is not None:
                         value = None
                     else:
                         field = object._meta.get_field(field_name)
                         value = get_clean_value(child, object._meta.object_name, field)
                         if type(field) == ForeignKey or type(field) == OneToOneField:
-                            objects = child.getElementsByTagName('object')
-                            if objects:
+                            related_element = child.find('object')
+                            if related_element is not None:
                                 if field.related.parent_model == Country:
-                                    country_code = objects[0].getAttribute('country_code')
-                                    related_object = Country.objects.get(country_code2=country_code)
+                                    country_code = related_element.get('country_code')
+                                    value = self.country_ids[country_code]
                                 else:
-                                    uuid = objects[0].getAttribute('uuid')
+                                    uuid = related_element.get('uuid')
                                     try:
-                                        real_uuid = self.substitution_map[uuid]
+                                        value = self.ids[get_real_uuid(uuid)]
                                     except:
                                         raise Exception('Reference to a missing object')
-                                    related_object = OwnedObject.objects.get(owner=self.user,
-                                                                             uuid=real_uuid)
                                 field_name = "%s_id" % (field_name)
-                                value = related_object.pk
 
                     setattr(object, field_name, value)
 
-        def populate_m2m(object, node):
+        def get_real_uuid(uuid):
+            # an incremental backup references unchanged objects restored before
+            if self.since and uuid not in self.substitution_map:
+                return uuid
+            return self.substitution_map[uuid]
+
+        def delete_all():
+            for model in self.models:
+                for object in model.objects.filter(owner=self.user):
+                    # do not export address of user profile
+                    if not(type(object) == Address and object.userprofile_set.count()):
+                        object.delete()
+            # invoice ids of the archive are suggested from the first one
+            release_invoice_id(self.user.id)
+
+        def populate_m2m(object, element, created, m2m_data):
+            """
+            Keeps the uuids of related objects, relations are
+            saved when all objects are restored
+            """
             m2m_field_list = ['%s' % (field.name) for field in object._meta.many_to_many]
-            m2m_data = []
 
-            for child in node.childNodes:
-                field_name = child.nodeName
+            for child in element:
+                field_name = child.tag
                 if field_name in m2m_field_list:
-                    field = object._meta.get_field(field_name)
-                    related_model = field.related.model
-                    objects = child.getElementsByTagName('object')
-                    uuids = []
-                    for related_obj in objects:
-                        uuids.append(related_obj.getAttribute('uuid'))
-                    m2m_data.append({'object': object,
-                                     'field_name': field_name,
-                                     'related_model': related_model,
-                                     'uuids': uuids})
-
-            return m2m_data
+                    uuids = [related_element.get('uuid') for related_element in child.findall('object')]
+                    # relations of created objects are empty
+                    if uuids or not created:
+                        m2m_data.append((type(object), object.pk, field_name, uuids, created))
+
+        def restore_batch(elements, klass, m2m_data):
+            for object, element in zip(check_objects_exist(elements, klass), elements):
+                if object:
+                    created = object.pk is None
+                    populate(object, element)
+                    object.save(force_insert=created, user=self.user)
+                    self.ids['%s' % (object.uuid)] = object.pk
+                    populate_m2m(object, element, created, m2m_data)
+                self.update_progress(self.object_count + 1, self.stream.tell())
 
         def do_restore():
             m2m_data = []
-            for event, node in self.event_stream:
-                if event == "START_ELEMENT" and node.nodeName in self.model_name_dict:
-                    self.event_stream.expandNode(node)
-                    object = check_object_exists(node, self.model_name_dict[node.nodeName])
-                    if object:
-                        populate(object, node)
-                        object.save(user=self.user)
-                        m2m_data = m2m_data + populate_m2m(object, node)
-
-            for m2m in m2m_data:
-                uuids = ['%s' % (self.substitution_map[uid]) for uid in m2m['uuids']]
-                related_objects = m2m['related_model'].objects.filter(owner=self.user,
-                                                                      uuid__in=uuids)
-
-                setattr(m2m['object'], m2m['field_name'], related_objects)
-
-        self.models = [Address, Contact, Contract, PhoneNumber, Project, Proposal, ProposalRow, Invoice, InvoiceRow, Expense]
+            deleted_uuids = []
+            batch = []
+            batch_klass = None
+            root = None
+            depth = 0
+            # only elements of objects waiting in batch are kept in memory
+            for event, element in iterparse(self.stream, events=('start', 'end')):
+                if event == 'start':
+                    depth = depth + 1
+                    if depth == 1:
+                        root = element
+                        self.since = element.get('since') or None
+                        if self.action == RESTORE_ACTION_DELETE_ALL_AND_RESTORE and not self.since:
+                            delete_all()
+                    continue
+
+                depth = depth - 1
+                if depth != 1:
+                    continue
+
+                klass = self.model_name_dict.get(element.tag)
+                if batch and (klass != batch_klass or len(batch) >= RESTORE_BATCH_SIZE):
+                    restore_batch(batch, batch_klass, m2m_data)
+                    batch = []
+
+                if element.tag == 'deleted':
+                    deleted_uuids.append(element.get('uuid'))
+                elif klass:
+                    batch.append(element)
+                    batch_klass = klass
+
+                if not batch:
+                    root.clear()
+                elif len(batch) == 1:
+                    # previous elements are processed, only keep the new one
+                    root.clear()
+                    root.append(element)
+            if batch:
+                restore_batch(batch, batch_klass, m2m_data)
+
+            for klass, pk, field_name, uuids, created in m2m_data:
+                uuids = ['%s' % (get_real_uuid(uid)) for uid in uuids]
+                related_model = klass._meta.get_field(field_name).rel.to
+                related_objects = related_model.objects.filter(owner=self.user,
+                                                               uuid__in=uuids)
+                object = klass.objects.get(pk=pk)
+                if created:
+                    getattr(object, field_name).add(*related_objects)
+                else:
+                    setattr(object, field_name, related_objects)
+
+            # objects deleted since the previous backup, archives made before
+            # deletions were checked may also list objects they restore
+            deleted_uuids = [uuid for uuid in deleted_uuids if uuid not in self.substitution_map]
+            if self.action == RESTORE_ACTION_DELETE_ALL_AND_RESTORE and deleted_uuids:
+                for model in self.models:
+                    for object in model.objects.filter(owner=self.user,
+                                                       uuid__in=deleted_uuids):
+                        object.delete()
+
+        self.models = RESTORE_MODELS
         self.model_name_dict = {}
         for model in self.models:
             self.model_name_dict[model._meta.object_name] = model
 
-        self.event_stream = pulldom.parse(self.stream)
         self.substitution_map = {}
-
-        if self.action == RESTORE_ACTION_DELETE_ALL_AND_RESTORE:
-            for model in self.models:
-                for object in model.objects.filter(owner=self.user):
-                    # do not export address of user profile
-                    if not(type(object) == Address and object.userprofile_set.count()):
-                        object.delete()
-        do_restore()
+        self.since = None
+        # uuid -> id of objects of the user, to resolve references without queries
+        self.ids = dict(OwnedObject.objects.filter(owner=self.user).values_list('uuid', 'id'))
+        self.country_ids = dict(Country.objects.values_list('country_code2', 'id'))
+
+        # sales ledger is rebuilt once at the end instead of on each invoice save
+        post_save.disconnect(update_sales_ledger, sender=Invoice)
+        post_delete.disconnect(update_sales_ledger, sender=Invoice)
+        try:
+            with batch_edit():
+                do_restore()
+        finally:
+            post_save.connect(update_sales_ledger, sender=Invoice)
+            post_delete.connect(update_sales_ledger, sender=Invoice)
+        SalesLedgerEntry.objects.rebuild(self.user.id)
 
     def restore_files(self):
-        paths = ['proposal', 'contract', 'logo']
-        if self.action == RESTORE_ACTION_DELETE_ALL_AND_RESTORE:
-            # delete proposal and contract directory
-            for dir_path in paths:
-                target_dir = '%s%s/%s' % (settings.FILE_UPLOAD_DIR,
-                                          self.user.get_profile().uuid,
-                                          dir_path)
-                shutil.rmtree(target_dir, True)
-
+        """
+        Files are linked to the blob of their content when it is already
+        stored, files already referencing the right content are left as is
+        """
+        paths = RESTORE_FILE_DIRS
+        restored_names = set()
         for member in self.tar:
             dir_path = os.path.dirname(member.name).replace('backup/', '')
-            if dir_path in paths:
-                filename = os.path.basename(member.name)
-                target_dir = '%s%s/%s' % (settings.FILE_UPLOAD_DIR,
-                                          self.user.get_profile().uuid,
-                                          dir_path)
-                mkdir_p(target_dir)
-                target_filename = '%s/%s' % (target_dir,
-                                              filename)
-
-                if not(self.action == RESTORE_ACTION_ADD_MISSING and os.path.exists(target_filename)):
-                    target_file = open(target_filename, 'w')
-                    file = self.tar.extractfile(member)
-                    target_file.write(file.read())
-                    target_file.close()
+            if dir_path in paths and (member.isfile() or member.islnk()):
+                name = '%s/%s/%s' % (self.user.get_profile().uuid,
+                                     dir_path,
+                                     os.path.basename(member.name))
+                restored_names.add(name)
+
+                if self.action == RESTORE_ACTION_ADD_MISSING and upload_store.exists(name):
+                    continue
+                digest = self.file_digests[member.name]
+                if upload_store.is_reference(name, digest):
+                    continue
+                upload_store.delete(name)
+                if upload_store.blob_exists(digest):
+                    upload_store.link(digest, name)
+                else:
+                    upload_store.save(name, File(self.tar.extractfile(member)))
+
+        if self.action == RESTORE_ACTION_DELETE_ALL_AND_RESTORE and not self.since:
+            # delete files which aren't in the backup
+            for dir_path in paths:
+                target_dir = '%s/%s' % (self.user.get_profile().uuid,
+                                        dir_path)
+                if not upload_store.exists(target_dir):
+                    continue
+                for filename in upload_store.listdir(target_dir)[1]:
+                    name = '%s/%s' % (target_dir, filename)
+                    if name not in restored_names:
+                        upload_store.delete(name)
+
+def render_invoice_pdf(args):
+    """
+    Renders the pdf of an invoice in a directory and returns its filename
+    """
+    invoice_id, directory = args
+    invoice = Invoice.objects.select_related('owner').get(pk=invoice_id)
+    response = HttpResponse()
+    invoice.to_pdf(invoice.owner, response)
+    filename = invoice.get_pdf_filename()
+    file = open(os.path.join(directory, filename), 'wb')
+    file.write(response.content)
+    file.close()
+    return filename
+
+class InvoiceArchiveRequest(models.Model):
+    user = models.OneToOneField(User)
+    year = models.IntegerField(verbose_name=_('Year'))
+    state = models.IntegerField(choices=BACKUP_RESTORE_STATE, default=BACKUP_RESTORE_STATE_PENDING)
+    creation_datetime = models.DateTimeField()
+    last_state_datetime = models.DateTimeField()
+    error_message = models.CharField(max_length=255, null=True, blank=True)
+
+    def __unicode__(self):
+        return "%s %s %s" % (self.year, self.get_state_display(), self.user)
+
+    def is_done(self):
+        return self.state == BACKUP_RESTORE_STATE_DONE
+
+    def get_archive_dir(self):
+        return '%s%s/invoice_archive' % (settings.FILE_UPLOAD_DIR,
+                                         self.user.get_profile().uuid)
+
+    def get_archive_filename(self):
+        return 'invoices_%d.zip' % (self.year)
+
+    def get_archive_path(self):
+        return '%s/%s' % (self.get_archive_dir(), self.get_archive_filename())
+
+    def get_invoices(self):
+        return Invoice.objects.filter(owner=self.user,
+                                      state__gte=INVOICE_STATE_SENT,
+                                      edition_date__year=self.year).order_by('invoice_id')
+
+    def archive(self):
+        self.state = BACKUP_RESTORE_STATE_IN_PROGRESS
+        self.last_state_datetime = datetime.datetime.now()
+        self.save()
+
+        archive_dir = self.get_archive_dir()
+        work_dir = '%s/work' % (archive_dir)
+        pool = None
+        try:
+            # delete previous archive
+            shutil.rmtree(archive_dir, True)
+            mkdir_p(work_dir)
+
+            tasks = [(invoice_id, work_dir) for invoice_id in self.get_invoices().values_list('id', flat=True)]
+            processes = getattr(settings, 'INVOICE_ARCHIVE_PROCESSES', 1)
+            if processes > 1 and len(tasks) > 1:
+                # forked processes must not share the database connection
+                connection.close()
+                pool = multiprocessing.Pool(processes)
+                filenames = pool.imap(render_invoice_pdf, tasks)
+            else:
+                filenames = itertools.imap(render_invoice_pdf, tasks)
+
+            # pdf files are already compressed, store them as is
+            archive_file = zipfile.ZipFile('%s.tmp' % (self.get_archive_path()), 'w', zipfile.ZIP_STORED)
+            try:
+                for filename in filenames:
+                    path = os.path.join(work_dir, filename)
+                    archive_file.write(path, filename)
+                    os.remove(path)
+            finally:
+                archive_file.close()
+            os.rename('%s.tmp' % (self.get_archive_path()), self.get_archive_path())
+
+            self.state = BACKUP_RESTORE_STATE_DONE
+        except Exception as e:
+            self.state = BACKUP_RESTORE_STATE_ERROR
+            self.error_message = unicode(e)
+            mail_subject = _('Invoice archive failed')
+            mail_message = _('Invoice archive for %(user)s failed with message : %(message)s') % {'user': self.user,
+                                                                                                 'message': e}
+            mail_admins(mail_subject, mail_message, fail_silently=(not settings.DEBUG))
+
+        if pool:
+            pool.terminate()
+            pool.join()
+        shutil.rmtree(work_dir, True)
+        self.last_state_datetime = datetime.datetime.now()
+        self.save()
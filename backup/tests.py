@@ -1,10 +1,13 @@
 from backup.models import BackupRequest, BACKUP_RESTORE_STATE_PENDING, \
     BACKUP_RESTORE_STATE_DONE, RESTORE_ACTION_ADD_MISSING, \
     RestoreRequest, RESTORE_ACTION_ADD_AND_UPDATE, \
-    RESTORE_ACTION_DELETE_ALL_AND_RESTORE, BACKUP_RESTORE_STATE_ERROR
+    RESTORE_ACTION_DELETE_ALL_AND_RESTORE, BACKUP_RESTORE_STATE_ERROR, \
+    InvoiceArchiveRequest, BACKUP_RESTORE_STATE_IN_PROGRESS, claim_request, \
+    get_queue_stats, mkdir_p, recover_stale_requests, get_progress_database
 from django.contrib.auth.models import User
 import hashlib
 import tarfile
+import zipfile
 import shutil
 from django.core.urlresolvers import reverse
 import os
@@ -13,15 +16,40 @@ from django.core.management import call_command
 from project.models import Proposal, Project, PROPOSAL_STATE_ACCEPTED, \
     ROW_CATEGORY_SERVICE, VAT_RATES_19_6
 from accounts.models import Invoice, INVOICE_STATE_PAID, PAYMENT_TYPE_CHECK, \
-    PAYMENT_TYPE_BANK_CARD, INVOICE_STATE_EDITED, InvoiceRow
+    PAYMENT_TYPE_BANK_CARD, INVOICE_STATE_EDITED, InvoiceRow, Expense
 from contact.models import Contact, CONTACT_TYPE_COMPANY, Address
 from autoentrepreneur.models import Subscription, SUBSCRIPTION_STATE_TRIAL
 from django.test.testcases import TransactionTestCase, TestCase
-from core.models import OwnedObject
+from core.models import OwnedObject, DeletedObject
+from core.testutils import capture_queries
 from django.core.exceptions import SuspiciousOperation
+from backup.views import iterate_by_chunks
 from django.core import mail
 from django.utils.translation import ugettext
 import datetime
+from StringIO import StringIO
+from django.db import connection, transaction
+from django.utils import simplejson
+from django.core.files.base import ContentFile
+from project.models import store as upload_store
+import tempfile
+import resource
+import time
+import traceback
+import signal
+from backup.management.commands import backup_worker
+from backup.models import run_request
+
+def run_request_killed_once(args):
+    """
+    Kills the pool process executing it the first time, as the kernel
+    does when running out of memory
+    """
+    marker = '%skilled_worker' % (settings.FILE_UPLOAD_DIR)
+    if not os.path.exists(marker):
+        open(marker, 'w').close()
+        os.kill(os.getpid(), signal.SIGKILL)
+    return run_request(args)
 
 class BackupTest(TransactionTestCase):
     fixtures = ['backup_data']
@@ -62,6 +90,180 @@ class BackupTest(TransactionTestCase):
         self.assertTrue(os.path.exists(filename))
         self.assertNotEquals(os.path.getsize(filename), 0)
 
+    def testBackupArchiveContent(self):
+        contract_dir = '%s%s/contract' % (settings.FILE_UPLOAD_DIR,
+                                          self.user1.get_profile().uuid)
+        os.makedirs(contract_dir)
+        f = open('%s/contract.pdf' % (contract_dir), 'w')
+        f.write('contract content')
+        f.close()
+
+        now = datetime.datetime.now()
+        backup_request = BackupRequest.objects.create(user=self.user1,
+                                                      creation_datetime=now,
+                                                      last_state_datetime=now)
+        backup_request.backup()
+        self.assertEquals(backup_request.state, BACKUP_RESTORE_STATE_DONE)
+
+        backup_dir = '%s%s/backup' % (settings.FILE_UPLOAD_DIR,
+                                      self.user1.get_profile().uuid)
+        # nothing is left besides the archive
+        self.assertEquals(os.listdir(backup_dir), [backup_request.get_backup_filename()])
+
+        tar = tarfile.open('%s/%s' % (backup_dir, backup_request.get_backup_filename()), 'r:gz')
+        self.assertEquals(tar.getnames(), ['backup',
+                                           'backup/data.xml',
+                                           'backup/contract',
+                                           'backup/contract/contract.pdf',
+                                           'backup/manifest.json'])
+        self.assertEquals(tar.extractfile('backup/contract/contract.pdf').read(), 'contract content')
+        data = tar.extractfile('backup/data.xml').read()
+        self.assertTrue(data.startswith('<?xml'))
+        self.assertTrue(data.endswith('</aemanager>'))
+        self.assertEquals(tar.getmember('backup/data.xml').uname, 'aemanager')
+        tar.close()
+
+    def testIncrementalBackup(self):
+        yesterday = datetime.datetime.now() - datetime.timedelta(1)
+        OwnedObject.objects.filter(owner=self.user1).update(modification_datetime=yesterday)
+
+        now = datetime.datetime.now()
+        backup_request = BackupRequest.objects.create(user=self.user1,
+                                                      creation_datetime=now,
+                                                      last_state_datetime=now,
+                                                      incremental=True,
+                                                      last_backup_datetime=now - datetime.timedelta(hours=1))
+
+        p = Proposal.objects.get(owner=self.user1)
+        p.reference = 'modified'
+        p.save()
+        i = Invoice.objects.get(owner=self.user1)
+        i.delete()
+        c = Contact.objects.filter(owner=self.user1)[0]
+
+        backup_request.backup()
+        self.assertEquals(backup_request.state, BACKUP_RESTORE_STATE_DONE)
+        self.assertTrue(backup_request.get_backup_filename().endswith('_incremental.tar.gz'))
+
+        tar = tarfile.open('%s%s/backup/%s' % (settings.FILE_UPLOAD_DIR,
+                                               self.user1.get_profile().uuid,
+                                               backup_request.get_backup_filename()), 'r:gz')
+        data = tar.extractfile('backup/data.xml').read()
+        tar.close()
+        self.assertTrue('since="%s"' % (backup_request.since_datetime.isoformat()) in data)
+        self.assertTrue('<Proposal uuid="%s"' % (p.uuid) in data)
+        self.assertFalse('<Contact uuid="%s"' % (c.uuid) in data)
+        self.assertTrue('<deleted uuid="%s"' % (i.uuid) in data)
+
+    def testDeletionsRecordedOnceBackedUp(self):
+        """
+        Deletions are only needed by incremental backups, following
+        a completed backup
+        """
+        OwnedObject.objects.create(owner=self.user1).delete()
+        self.assertEquals(DeletedObject.objects.filter(owner=self.user1).count(), 0)
+
+        now = datetime.datetime.now()
+        backup_request = BackupRequest.objects.create(user=self.user1,
+                                                      creation_datetime=now,
+                                                      last_state_datetime=now)
+        OwnedObject.objects.create(owner=self.user1).delete()
+        self.assertEquals(DeletedObject.objects.filter(owner=self.user1).count(), 0)
+
+        backup_request.backup()
+        self.assertEquals(backup_request.state, BACKUP_RESTORE_STATE_DONE)
+        i = Invoice.objects.get(owner=self.user1)
+        i.delete()
+        self.assertEquals(DeletedObject.objects.filter(owner=self.user1, uuid=i.uuid).count(), 1)
+
+    def keepArchive(self, backup_request):
+        # each backup replaces the previous archive on the server
+        restore_file = '%s/restore/%s' % (self.user1.get_profile().uuid,
+                                          backup_request.get_backup_filename())
+        mkdir_p(os.path.dirname('%s%s' % (settings.FILE_UPLOAD_DIR, restore_file)))
+        shutil.copyfile('%s%s/backup/%s' % (settings.FILE_UPLOAD_DIR,
+                                            self.user1.get_profile().uuid,
+                                            backup_request.get_backup_filename()),
+                        '%s%s' % (settings.FILE_UPLOAD_DIR, restore_file))
+        return restore_file
+
+    def restoreArchive(self, restore_file):
+        now = datetime.datetime.now()
+        RestoreRequest.objects.filter(user=self.user1).delete()
+        restore_request = RestoreRequest.objects.create(user=self.user1,
+                                                        action=RESTORE_ACTION_DELETE_ALL_AND_RESTORE,
+                                                        creation_datetime=now,
+                                                        last_state_datetime=now,
+                                                        backup_file=restore_file)
+        restore_request.restore()
+        self.assertEquals(restore_request.state, BACKUP_RESTORE_STATE_DONE)
+
+    def testIncrementalRestore(self):
+        keep_archive = self.keepArchive
+        restore = self.restoreArchive
+
+        now = datetime.datetime.now()
+        backup_request = BackupRequest.objects.create(user=self.user1,
+                                                      creation_datetime=now,
+                                                      last_state_datetime=now,
+                                                      incremental=True)
+        contact_count = Contact.objects.filter(owner=self.user1).count()
+        # no previous backup, a full backup is made
+        backup_request.backup()
+        self.assertEquals(backup_request.since_datetime, None)
+        full_backup = keep_archive(backup_request)
+        full_backup_datetime = backup_request.last_backup_datetime
+
+        p = Proposal.objects.get(owner=self.user1)
+        p.reference = 'modified'
+        p.save()
+        i = Invoice.objects.get(owner=self.user1)
+        i.delete()
+
+        backup_request.creation_datetime = datetime.datetime.now()
+        backup_request.backup()
+        self.assertEquals(backup_request.since_datetime, full_backup_datetime)
+        incremental_backup = keep_archive(backup_request)
+
+        restore(full_backup)
+        self.assertEquals(Proposal.objects.get(uuid=p.uuid).reference, 'ref1')
+        self.assertEquals(Invoice.objects.filter(uuid=i.uuid).count(), 1)
+
+        restore(incremental_backup)
+        self.assertEquals(Proposal.objects.get(uuid=p.uuid).reference, 'modified')
+        self.assertEquals(Proposal.objects.get(uuid=p.uuid).project.owner, self.user1)
+        self.assertEquals(Invoice.objects.filter(uuid=i.uuid).count(), 0)
+        self.assertEquals(Contact.objects.filter(owner=self.user1).count(), contact_count)
+
+    def testIncrementalBackupAfterRestore(self):
+        now = datetime.datetime.now()
+        backup_request = BackupRequest.objects.create(user=self.user1,
+                                                      creation_datetime=now,
+                                                      last_state_datetime=now,
+                                                      incremental=True)
+        backup_request.backup()
+        full_backup = self.keepArchive(backup_request)
+        object_count = OwnedObject.objects.filter(owner=self.user1).count()
+        i = Invoice.objects.get(owner=self.user1)
+
+        # objects are deleted then restored with the uuids of the archive
+        self.restoreArchive(full_backup)
+        self.assertEquals(Invoice.objects.filter(uuid=i.uuid).count(), 1)
+
+        backup_request.creation_datetime = datetime.datetime.now()
+        backup_request.backup()
+        self.assertEquals(backup_request.state, BACKUP_RESTORE_STATE_DONE)
+        incremental_backup = self.keepArchive(backup_request)
+        tar = tarfile.open('%s%s' % (settings.FILE_UPLOAD_DIR, incremental_backup), 'r:gz')
+        data = tar.extractfile('backup/data.xml').read()
+        tar.close()
+        self.assertTrue('<Invoice uuid="%s"' % (str(i.uuid)) in data)
+        self.assertFalse('<deleted uuid="%s"' % (str(i.uuid)) in data)
+
+        self.restoreArchive(incremental_backup)
+        self.assertEquals(Invoice.objects.filter(uuid=i.uuid).count(), 1)
+        self.assertEquals(OwnedObject.objects.filter(owner=self.user1).count(), object_count)
+
     def testRestoreAddMissing(self):
         response = self.client.post(reverse('backup'),
                                     {'backup_or_restore': 'backup'})
@@ -216,6 +418,9 @@ class BackupTest(TransactionTestCase):
                                    address=a,
                                    comment='new comment',
                                    owner=self.user1)
+        # invoice ids reserved after the backup -> should be suggested again
+        Invoice.objects.allocate_invoice_id(self.user1)
+        Invoice.objects.allocate_invoice_id(self.user1)
 
         backup_file = '%s%s/backup/backup_%s.tar.gz' % (settings.FILE_UPLOAD_DIR,
                                                         self.user1.get_profile().uuid,
@@ -248,6 +453,7 @@ class BackupTest(TransactionTestCase):
         self.assertEquals(Invoice.objects.filter(owner=self.user1).count(), 1)
         self.assertEquals(Invoice.objects.filter(owner=self.user1,
                                                  uuid=i.uuid).count(), 1)
+        self.assertEquals(Invoice.objects.get_next_invoice_id(self.user1), i.invoice_id + 1)
 
         self.assertEquals(Contact.objects.filter(pk=c.id).count(), 0)
 
@@ -330,6 +536,62 @@ class BackupTest(TransactionTestCase):
         self.assertEquals(len(mail.outbox), 1)
         self.assertEquals(mail.outbox[0].subject, ugettext("%sRestore failed") % (settings.EMAIL_SUBJECT_PREFIX))
 
+    def testValidationBeforeWrites(self):
+        """
+        invalid archives are rejected without writing user data
+        """
+        def restore(restore_file):
+            now = datetime.datetime.now()
+            RestoreRequest.objects.filter(user=self.user1).delete()
+            restore_request = RestoreRequest.objects.create(user=self.user1,
+                                                            action=RESTORE_ACTION_DELETE_ALL_AND_RESTORE,
+                                                            creation_datetime=now,
+                                                            last_state_datetime=now,
+                                                            backup_file=restore_file)
+            with capture_queries() as queries:
+                restore_request.restore()
+            writes = [query['sql'] for query in queries
+                      if query['sql'].split()[0] in ['INSERT', 'UPDATE', 'DELETE']
+                      and 'backup_restorerequest' not in query['sql']]
+            self.assertEquals(writes, [])
+            self.assertEquals(restore_request.state, BACKUP_RESTORE_STATE_ERROR)
+            return restore_request.error_message
+
+        uuid = self.user1.get_profile().uuid
+        restore_file = '%s/restore/backup_injected_user.tar.gz' % (uuid)
+        mkdir_p(os.path.dirname('%s%s' % (settings.FILE_UPLOAD_DIR, restore_file)))
+        shutil.copyfile('%s/backup/fixtures/backup_injected_user.tar.gz' % (settings.BASE_PATH),
+                        '%s%s' % (settings.FILE_UPLOAD_DIR, restore_file))
+        self.assertEquals(restore(restore_file), 'Unexpected User in backup')
+
+        now = datetime.datetime.now()
+        backup_request = BackupRequest.objects.create(user=self.user1,
+                                                      creation_datetime=now,
+                                                      last_state_datetime=now)
+        backup_request.backup()
+        backup = tarfile.open('%s%s/backup/%s' % (settings.FILE_UPLOAD_DIR,
+                                                  uuid,
+                                                  backup_request.get_backup_filename()), 'r:gz')
+        data = backup.extractfile('backup/data.xml').read()
+        manifest = simplejson.loads(backup.extractfile('backup/manifest.json').read())
+        backup.close()
+        self.assertEquals(manifest['objects']['Expense'], Expense.objects.filter(owner=self.user1).count())
+
+        # an expense removed from data but still in the manifest
+        expense_uuid = str(Expense.objects.filter(owner=self.user1)[0].uuid)
+        start = data.index('<Expense uuid="%s"' % (expense_uuid))
+        end = data.index('</Expense>', start) + len('</Expense>')
+        restore_file = '%s/restore/backup_tampered.tar.gz' % (uuid)
+        tampered = tarfile.open('%s%s' % (settings.FILE_UPLOAD_DIR, restore_file), 'w:gz')
+        for name, content in [('backup/data.xml', data[:start] + data[end:]),
+                              ('backup/manifest.json', simplejson.dumps(manifest))]:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tampered.addfile(info, StringIO(content))
+        tampered.close()
+        self.assertEquals(restore(restore_file), 'Objects do not match backup manifest')
+        self.assertEquals(Expense.objects.filter(owner=self.user1).count(), manifest['objects']['Expense'])
+
     def testUuidFromOtherCreateNewObject(self):
         backup_file = '%s/backup/fixtures/backup_from_other_user.tar.gz' % (settings.BASE_PATH)
         restore_file = '%s%s/restore/backup_from_other_user.tar.gz' % (settings.FILE_UPLOAD_DIR,
@@ -520,6 +782,51 @@ class BackupTest(TransactionTestCase):
 
         self.assertEquals(backup_digest, new_backup_digest)
 
+    def testRestoreLinksFiles(self):
+        """
+        files with the same content are stored once in the backup, and
+        restoring the same backup again doesn't rewrite them
+        """
+        uuid = self.user1.get_profile().uuid
+        contract_name = upload_store.save('%s/contract/contract.txt' % (uuid), ContentFile('contract'))
+        proposal_name = upload_store.save('%s/proposal/contract.txt' % (uuid), ContentFile('contract'))
+        digest = upload_store.get_digest(contract_name)
+        self.assertEquals(upload_store.get_reference_count(digest), 2)
+
+        now = datetime.datetime.now()
+        backup_request = BackupRequest.objects.create(user=self.user1,
+                                                      creation_datetime=now,
+                                                      last_state_datetime=now)
+        backup_request.backup()
+        backup_file = '%s%s/backup/%s' % (settings.FILE_UPLOAD_DIR,
+                                          uuid,
+                                          backup_request.get_backup_filename())
+        backup = tarfile.open(backup_file, 'r:gz')
+        self.assertEquals(len([member for member in backup if member.islnk()]), 1)
+        backup.close()
+
+        upload_store.save('%s/contract/added.txt' % (uuid), ContentFile('added'))
+        upload_store.delete(proposal_name)
+        inodes = []
+        for i in range(2):
+            restore_file = '%s/restore/%s' % (uuid, backup_request.get_backup_filename())
+            mkdir_p(os.path.dirname(upload_store.path(restore_file)))
+            shutil.copyfile(backup_file, upload_store.path(restore_file))
+            RestoreRequest.objects.filter(user=self.user1).delete()
+            restore_request = RestoreRequest.objects.create(user=self.user1,
+                                                            action=RESTORE_ACTION_DELETE_ALL_AND_RESTORE,
+                                                            creation_datetime=now,
+                                                            last_state_datetime=now,
+                                                            backup_file=restore_file)
+            restore_request.restore()
+            self.assertEquals(restore_request.state, BACKUP_RESTORE_STATE_DONE)
+            self.assertEquals(upload_store.listdir('%s/contract' % (uuid))[1], ['contract.txt'])
+            self.assertTrue(upload_store.is_reference(proposal_name, digest))
+            self.assertEquals(upload_store.get_reference_count(digest), 2)
+            inodes.append(os.stat(upload_store.path(contract_name)).st_ino)
+        self.assertFalse(upload_store.blob_exists(hashlib.sha1('added').hexdigest()))
+        self.assertEquals(inodes[0], inodes[1])
+
     def testCantRestoreIfTrial(self):
         sub = Subscription.objects.get(owner__username='test1')
         sub.state = SUBSCRIPTION_STATE_TRIAL
@@ -677,6 +984,317 @@ class BackupTest(TransactionTestCase):
         self.assertEquals(InvoiceRow.objects.filter(invoice__uuid=invoice_uuid, proposal=None, vat_rate=None).count(), 1)
         self.assertEquals(InvoiceRow.objects.filter(invoice__uuid=invoice_uuid, proposal=None, vat_rate=VAT_RATES_19_6).count(), 1)
 
+    def testBackupQueryCount(self):
+        """
+        Related objects are resolved from preloaded uuids, the number
+        of queries doesn't depend on the number of objects
+        """
+        def backup_queries():
+            backup_request = BackupRequest(user=self.user1)
+            backup_request.stream = StringIO()
+            with capture_queries() as queries:
+                backup_request.backup_objects()
+            return len(queries), backup_request.stream.getvalue().decode('utf-8')
+
+        query_count, content = backup_queries()
+
+        contact = Contact.objects.filter(owner=self.user1)[0]
+        for i in range(10):
+            address = Address.objects.create(street='street %d' % (i),
+                                             owner=self.user1)
+            related_contact = Contact.objects.create(contact_type=CONTACT_TYPE_COMPANY,
+                                                     name='Contact %d' % (i),
+                                                     address=address,
+                                                     owner=self.user1)
+            contact.contacts.add(related_contact)
+
+        self.assertEquals(backup_queries()[0], query_count)
+        self.assertFalse(self.user1.get_profile().address.uuid in content)
+        content = backup_queries()[1]
+        for related_contact in contact.contacts.all():
+            self.assertTrue('<object uuid="%s"></object>' % (related_contact.uuid) in content)
+
+    def testRestoreQueryCount(self):
+        """
+        References are resolved from preloaded uuids and invoice
+        amounts are computed once, a restored row only costs its save
+        """
+        def restore_queries():
+            backup_request = BackupRequest(user=self.user1)
+            backup_request.stream = StringIO()
+            backup_request.backup_objects()
+            restore_request = RestoreRequest(user=self.user1,
+                                             action=RESTORE_ACTION_ADD_AND_UPDATE)
+            restore_request.stream = StringIO(backup_request.stream.getvalue())
+            with capture_queries() as queries:
+                restore_request.restore_objects()
+            return len(queries)
+
+        query_count = restore_queries()
+
+        invoice = Invoice.objects.get(owner=self.user1)
+        invoice_amount = invoice.amount
+        for i in range(10):
+            InvoiceRow.objects.create(proposal=None,
+                                      vat_rate=None,
+                                      invoice=invoice,
+                                      label='Row %d' % (i),
+                                      category=ROW_CATEGORY_SERVICE,
+                                      quantity=1,
+                                      unit_price='10',
+                                      balance_payments=False,
+                                      owner=self.user1)
+        InvoiceRow.objects.filter(invoice=invoice).update(amount=0)
+
+        # select and update of the row and its parent table
+        self.assertTrue(restore_queries() - query_count <= 10 * 4)
+        self.assertEquals(Invoice.objects.get(pk=invoice.pk).amount, invoice_amount + 100)
+
+    def testLargeRestore(self):
+        """
+        Restore of a 50k objects backup, elements are parsed one by one
+        and memory doesn't grow with the size of the backup. Takes several
+        minutes, only run when AEMANAGER_BENCHMARKS is set
+        """
+        if not os.environ.get('AEMANAGER_BENCHMARKS'):
+            return
+        count = 50000 / 4
+        backup_file = tempfile.TemporaryFile()
+        backup_file.write('<?xml version="1.0" encoding="utf-8"?>\n<aemanager version="1.5.5">\n')
+        for i in range(count):
+            backup_file.write('<Address uuid="a-%(i)d"><street>%(i)d rue de la paix</street><zipcode>75002</zipcode>'
+                              '<city>Paris</city><country><object country_code="FR"></object></country></Address>\n' % {'i': i})
+        for i in range(count):
+            backup_file.write('<Contact uuid="c-%(i)d"><contact_type>2</contact_type><name>Customer %(i)d</name>'
+                              '<firstname></firstname><function></function><company_id></company_id><legal_form></legal_form>'
+                              '<representative></representative><representative_function></representative_function><email></email>'
+                              '<address><object uuid="a-%(i)d"></object></address><comment></comment>'
+                              '<contacts><object uuid="c-%(previous)d"></object></contacts></Contact>\n' % {'i': i, 'previous': max(i - 1, 0)})
+        for i in range(count):
+            backup_file.write('<Invoice uuid="i-%(i)d"><customer><object uuid="c-%(i)d"></object></customer>'
+                              '<invoice_id>%(id)d</invoice_id><state>1</state><amount>0</amount><edition_date>2011-04-07</edition_date>'
+                              '<payment_date>2011-05-07</payment_date><payment_type><None></None></payment_type><paid_date><None></None></paid_date>'
+                              '<execution_begin_date><None></None></execution_begin_date><execution_end_date><None></None></execution_end_date>'
+                              '<penalty_date><None></None></penalty_date><penalty_rate><None></None></penalty_rate>'
+                              '<discount_conditions><None></None></discount_conditions><footer_note><None></None></footer_note></Invoice>\n' % {'i': i, 'id': i + 1})
+        for i in range(count):
+            backup_file.write('<InvoiceRow uuid="r-%(i)d"><label>Day of work</label><category>1</category><quantity>2.00</quantity>'
+                              '<unit_price>300.00</unit_price><amount>600.00</amount><vat_rate><None></None></vat_rate><detail><None></None></detail>'
+                              '<invoice><object uuid="i-%(i)d"></object></invoice><proposal><None></None></proposal>'
+                              '<balance_payments>False</balance_payments></InvoiceRow>\n' % {'i': i})
+        backup_file.write('</aemanager>')
+        backup_file.seek(0)
+
+        # ru_maxrss is the peak of the whole process, memory used by previous
+        # tests would hide the one used by the restore. The restore runs in
+        # a forked process whose peak starts at its size before the restore.
+        connection.close()
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if not pid:
+            os.close(read_fd)
+            status = 1
+            try:
+                restore_request = RestoreRequest(user=self.user1,
+                                                 action=RESTORE_ACTION_DELETE_ALL_AND_RESTORE)
+                restore_request.stream = backup_file
+                max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                start = time.time()
+                restore_request.restore_objects()
+                duration = time.time() - start
+                max_rss_increase = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - max_rss
+                transaction.commit_unless_managed()
+                os.write(write_fd, '%d %d' % (duration, max_rss_increase))
+                status = 0
+            except:
+                traceback.print_exc()
+            connection.close()
+            os._exit(status)
+        os.close(write_fd)
+        result = os.read(read_fd, 100)
+        os.close(read_fd)
+        os.waitpid(pid, 0)
+        self.assertTrue(result, 'restore failed in child process')
+        duration, max_rss_increase = [int(value) for value in result.split()]
+
+        for model in [Address, Contact, Invoice, InvoiceRow]:
+            self.assertEquals(model.objects.filter(owner=self.user1, uuid__in=['a-0', 'c-0', 'i-0', 'r-0']).count(), 1)
+        # profile address and subscription are kept
+        self.assertEquals(OwnedObject.objects.filter(owner=self.user1).count(), 4 * count + 2)
+        self.assertEquals(Invoice.objects.get(owner=self.user1, uuid='i-%d' % (count - 1)).amount, 600)
+        self.assertEquals(Contact.objects.get(uuid='c-%d' % (count - 1)).contacts.get().uuid, 'c-%d' % (count - 2))
+        self.assertTrue(duration < 900)
+        # in kilobytes, mostly uuid maps used to resolve references
+        self.assertTrue(max_rss_increase < 50 * 1024)
+
+    def testProgress(self):
+        now = datetime.datetime.now()
+        backup_request = BackupRequest.objects.create(user=self.user1,
+                                                      creation_datetime=now,
+                                                      last_state_datetime=now)
+        response = self.client.get(reverse('backup_progress'))
+        progress = simplejson.loads(response.content)
+        self.assertEquals(progress['backup']['state'], BACKUP_RESTORE_STATE_PENDING)
+        self.assertEquals(progress['backup']['queue_position'], 0)
+        self.assertEquals(progress['restore'], None)
+
+        backup_request.backup()
+        backup_request = BackupRequest.objects.get(pk=backup_request.id)
+        self.assertTrue(backup_request.object_count > 0)
+        self.assertEquals(backup_request.object_count, backup_request.total_object_count)
+        self.assertEquals(backup_request.byte_count,
+                          os.path.getsize('%s%s/backup/%s' % (settings.FILE_UPLOAD_DIR,
+                                                              self.user1.get_profile().uuid,
+                                                              backup_request.get_backup_filename())))
+        self.assertTrue(backup_request.end_datetime >= backup_request.start_datetime)
+        self.assertEquals(backup_request.get_eta(), None)
+
+        restore_file = '%s/restore/%s' % (self.user1.get_profile().uuid,
+                                          backup_request.get_backup_filename())
+        mkdir_p(os.path.dirname('%s%s' % (settings.FILE_UPLOAD_DIR, restore_file)))
+        shutil.copyfile('%s%s/backup/%s' % (settings.FILE_UPLOAD_DIR,
+                                            self.user1.get_profile().uuid,
+                                            backup_request.get_backup_filename()),
+                        '%s%s' % (settings.FILE_UPLOAD_DIR, restore_file))
+        restore_request = RestoreRequest.objects.create(user=self.user1,
+                                                        action=RESTORE_ACTION_ADD_MISSING,
+                                                        creation_datetime=now,
+                                                        last_state_datetime=now,
+                                                        backup_file=restore_file)
+        restore_request.restore()
+        restore_request = RestoreRequest.objects.get(pk=restore_request.id)
+        self.assertEquals(restore_request.state, BACKUP_RESTORE_STATE_DONE)
+        self.assertEquals(restore_request.object_count, backup_request.object_count)
+        self.assertTrue(restore_request.total_byte_count > 0)
+
+        response = self.client.get(reverse('backup_progress'))
+        progress = simplejson.loads(response.content)
+        self.assertEquals(progress['restore']['object_count'], restore_request.object_count)
+        self.assertFalse(progress['restore']['pending'])
+
+    def testProgressDatabase(self):
+        databases = settings.DATABASES
+        try:
+            settings.DATABASES = {'default': databases['default']}
+            self.assertEquals(get_progress_database(), 'default')
+            settings.DATABASES = dict(databases, backup_progress=databases['default'])
+            self.assertEquals(get_progress_database(), 'backup_progress')
+        finally:
+            settings.DATABASES = databases
+
+    def testProgressThrottling(self):
+        now = datetime.datetime.now()
+        backup_request = BackupRequest.objects.create(user=self.user1,
+                                                      creation_datetime=now,
+                                                      last_state_datetime=now)
+        backup_request.reset_progress()
+        backup_request.update_progress(1, force=True)
+        backup_request.update_progress(2)
+        self.assertEquals(BackupRequest.objects.get(pk=backup_request.id).object_count, 1)
+        backup_request._progress_save_time = 0
+        backup_request.update_progress(3)
+        self.assertEquals(BackupRequest.objects.get(pk=backup_request.id).object_count, 3)
+
+    def testClaimRequest(self):
+        now = datetime.datetime.now()
+        backup_request = BackupRequest.objects.create(user=self.user1,
+                                                      creation_datetime=now,
+                                                      last_state_datetime=now)
+        other_worker_request = BackupRequest.objects.get(pk=backup_request.id)
+        self.assertTrue(claim_request(backup_request))
+        self.assertEquals(backup_request.state, BACKUP_RESTORE_STATE_IN_PROGRESS)
+        self.assertFalse(claim_request(other_worker_request))
+        self.assertEquals(BackupRequest.objects.get(pk=backup_request.id).state, BACKUP_RESTORE_STATE_IN_PROGRESS)
+
+    def testStaleRequestHeartbeat(self):
+        now = datetime.datetime.now()
+        started = now - datetime.timedelta(hours=2)
+        running_request = BackupRequest.objects.create(user=self.user1,
+                                                       state=BACKUP_RESTORE_STATE_IN_PROGRESS,
+                                                       creation_datetime=started,
+                                                       last_state_datetime=started)
+        BackupRequest.objects.create(user=self.user2,
+                                     state=BACKUP_RESTORE_STATE_IN_PROGRESS,
+                                     creation_datetime=started,
+                                     last_state_datetime=started)
+        running_request.update_progress(10, force=True)
+        # the date of the backup snapshot isn't changed by the heartbeat
+        self.assertEquals(running_request.last_state_datetime, started)
+
+        self.assertEquals(recover_stale_requests(BackupRequest, 60), [BackupRequest.objects.get(user=self.user2).id])
+        self.assertEquals(BackupRequest.objects.get(pk=running_request.id).state, BACKUP_RESTORE_STATE_IN_PROGRESS)
+        self.assertEquals(BackupRequest.objects.get(user=self.user2).state, BACKUP_RESTORE_STATE_PENDING)
+
+    def testBackupWorker(self):
+        now = datetime.datetime.now()
+        BackupRequest.objects.create(user=self.user1,
+                                     creation_datetime=now,
+                                     last_state_datetime=now)
+        # left in progress by a crashed worker
+        BackupRequest.objects.create(user=self.user2,
+                                     state=BACKUP_RESTORE_STATE_IN_PROGRESS,
+                                     creation_datetime=now - datetime.timedelta(hours=2),
+                                     last_state_datetime=now - datetime.timedelta(hours=2))
+        self.assertEquals(get_queue_stats(BackupRequest)['pending'], 1)
+        self.assertEquals(get_queue_stats(BackupRequest)['in_progress'], 1)
+
+        call_command('backup_worker', once=True, processes=2, interval=0, stale_timeout=60)
+
+        self.assertEquals(BackupRequest.objects.get(user=self.user1).state, BACKUP_RESTORE_STATE_DONE)
+        self.assertEquals(BackupRequest.objects.get(user=self.user2).state, BACKUP_RESTORE_STATE_DONE)
+        self.assertEquals(get_queue_stats(BackupRequest), {'pending': 0,
+                                                           'in_progress': 0,
+                                                           'oldest_pending_wait': 0})
+
+    def testBackupWorkerProcessKilled(self):
+        """
+        A request whose pool process was killed goes stale and is
+        executed again
+        """
+        now = datetime.datetime.now()
+        BackupRequest.objects.create(user=self.user1,
+                                     creation_datetime=now,
+                                     last_state_datetime=now)
+        try:
+            backup_worker.run_request = run_request_killed_once
+            # 3 seconds without progress
+            call_command('backup_worker', once=True, processes=2, interval=1, stale_timeout=0.05)
+        finally:
+            backup_worker.run_request = run_request
+
+        self.assertTrue(os.path.exists('%skilled_worker' % (settings.FILE_UPLOAD_DIR)))
+        self.assertEquals(BackupRequest.objects.get(user=self.user1).state, BACKUP_RESTORE_STATE_DONE)
+
+    def testInvoiceArchive(self):
+        # logo of the fixture isn't shipped with uploaded files
+        profile = self.user1.get_profile()
+        profile.logo_file = ''
+        profile.save()
+        now = datetime.datetime.now()
+        InvoiceArchiveRequest.objects.create(user=self.user1,
+                                             year=2011,
+                                             creation_datetime=now,
+                                             last_state_datetime=now)
+
+        processes = getattr(settings, 'INVOICE_ARCHIVE_PROCESSES', None)
+        try:
+            settings.INVOICE_ARCHIVE_PROCESSES = 1
+            call_command('archive_invoices')
+        finally:
+            if processes is None:
+                del settings.INVOICE_ARCHIVE_PROCESSES
+            else:
+                settings.INVOICE_ARCHIVE_PROCESSES = processes
+
+        invoice_archive_request = InvoiceArchiveRequest.objects.get(user=self.user1)
+        self.assertEquals(invoice_archive_request.state, BACKUP_RESTORE_STATE_DONE)
+        archive = zipfile.ZipFile(invoice_archive_request.get_archive_path())
+        self.assertEquals(archive.namelist(), ['invoice_1.pdf'])
+        archive.close()
+
+        response = self.client.get(reverse('invoice_archive_download'))
+        self.assertEquals(response['X-Sendfile'], invoice_archive_request.get_archive_path())
+
 class CsvExportTest(TestCase):
     fixtures = ['test_users', 'test_contacts', 'test_projects']
 
@@ -767,3 +1385,62 @@ class CsvExportTest(TestCase):
                                    {'end_date': datetime.date(2010, 2, 1)})
         expected_response = "Reference,Customer,Address,State,Amount,Edition date,Payment date,Payment type,Paid date,Execution begin date,Execution end date,Penalty date,Penalty rate,Discount conditions\r\n2,Contact 1,\",  , None\",Paid,200.00,2010-01-31,2010-02-28,Check,None,2010-01-01,2010-01-07,2010-03-08,1.50,Nothing\r\n"
         self.assertEquals(response.content, expected_response)
+
+    def testExportInvoiceRows(self):
+        InvoiceRow.objects.create(proposal=self.proposal1,
+                                  invoice=self.invoice1_1,
+                                  label='Day of work',
+                                  category=ROW_CATEGORY_SERVICE,
+                                  quantity=10,
+                                  unit_price='10',
+                                  balance_payments=False,
+                                  owner_id=1)
+        response = self.client.get(reverse('csv_export'),
+                                   {'data': 'invoice_rows'})
+        expected_response = "Reference,Customer,Edition date,State,Proposal,Label,Category,Quantity,Unit price,Amount,Vat,Balance payments\r\n1,Contact 1,2010-08-31,Paid,crt1234,Day of work,Service,10.00,10.00,100.00,None,False\r\n"
+        self.assertEquals(response.content, expected_response)
+
+    def testExportVat(self):
+        profile = User.objects.get(pk=1).get_profile()
+        profile.vat_number = 'FR010123456789123'
+        profile.save()
+        InvoiceRow.objects.create(proposal=self.proposal1,
+                                  invoice=self.invoice1_1,
+                                  label='Day of work',
+                                  category=ROW_CATEGORY_SERVICE,
+                                  quantity=10,
+                                  unit_price='10',
+                                  vat_rate=VAT_RATES_19_6,
+                                  balance_payments=False,
+                                  owner_id=1)
+        response = self.client.get(reverse('csv_export'))
+        expected_response = "Reference,Customer,Address,State,Amount,Edition date,Payment date,Payment type,Paid date,Execution begin date,Execution end date,Penalty date,Penalty rate,Discount conditions,VAT\r\n1,Contact 1,\",  , None\",Paid,100.00,2010-08-31,2010-09-30,Check,None,2010-08-01,2010-08-07,2010-10-08,1.50,Nothing,19.600\r\n"
+        self.assertEquals(response.content, expected_response)
+
+    def testExportExpenses(self):
+        Expense.objects.create(date=datetime.date(2010, 3, 1),
+                               reference='ABCD',
+                               supplier='Supplier',
+                               amount='100.0',
+                               payment_type=PAYMENT_TYPE_CHECK,
+                               description='First expense',
+                               owner_id=1)
+        response = self.client.get(reverse('csv_export'),
+                                   {'data': 'expenses',
+                                    'begin_date': datetime.date(2010, 1, 1)})
+        expected_response = "Date,Reference,Supplier,Description,Amount,Payment type\r\n2010-03-01,ABCD,Supplier,First expense,100.00,Check\r\n"
+        self.assertEquals(response.content, expected_response)
+
+    def testIterateByChunks(self):
+        for i in range(2, 6):
+            Invoice.objects.create(customer_id=self.proposal1.project.customer_id,
+                                   invoice_id=i,
+                                   state=INVOICE_STATE_PAID,
+                                   amount='100',
+                                   edition_date=datetime.date(2010, 8, 31),
+                                   payment_date=datetime.date(2010, 9, 30),
+                                   payment_type=PAYMENT_TYPE_CHECK,
+                                   owner_id=1)
+        invoices = Invoice.objects.filter(owner=1)
+        self.assertEquals([invoice.invoice_id for invoice in iterate_by_chunks(invoices, 'invoice_id', chunk_size=2)],
+                          [1, 2, 3, 4, 5])
@@ -4,9 +4,15 @@ urlpatterns = patterns('backup.views',
     url(regex=r'^$',
         view='backup',
         name='backup'),
+    url(regex=r'^progress/$',
+        view='backup_progress',
+        name='backup_progress'),
     url(regex=r'^download/$',
         view='backup_download',
         name='backup_download'),
+    url(regex=r'^invoice_archive/download/$',
+        view='invoice_archive_download',
+        name='invoice_archive_download'),
     url(regex=r'^csv/$',
         view='csv_export',
         name='csv_export'),
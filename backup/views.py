@@ -3,9 +3,11 @@ from autoentrepreneur.decorators import subscription_required
 from django.shortcuts import render_to_response, redirect
 from django.template.context import RequestContext
 from django.utils.translation import ugettext_lazy as _, ugettext
-from backup.forms import BackupForm, RestoreForm, CSVForm
+from backup.forms import BackupForm, RestoreForm, CSVForm, InvoiceArchiveForm, CSV_EXPORT_INVOICES, \
+    CSV_EXPORT_INVOICE_ROWS, CSV_EXPORT_EXPENSES, CSV_EXPORT_PROPOSALS
 from backup.models import BACKUP_RESTORE_STATE_PENDING, \
-    BACKUP_RESTORE_STATE_IN_PROGRESS, BackupRequest, RestoreRequest
+    BACKUP_RESTORE_STATE_IN_PROGRESS, BackupRequest, RestoreRequest, \
+    InvoiceArchiveRequest
 import datetime
 from django.core.urlresolvers import reverse
 from django.db.transaction import commit_on_success
@@ -13,9 +15,13 @@ from django.contrib import messages
 import os
 from django.http import HttpResponseNotFound, HttpResponse
 from django.utils.encoding import smart_str
+from django.utils import simplejson
+from cStringIO import StringIO
+import itertools
 from django.conf import settings
 import unicodecsv
-from accounts.models import Invoice
+from accounts.models import Invoice, InvoiceRow, Expense
+from project.models import Proposal
 from autoentrepreneur.models import SUBSCRIPTION_STATE_TRIAL
 
 @settings_required
@@ -38,6 +44,13 @@ def backup(request):
     except:
         pass
 
+    invoice_archive_request = None
+    try:
+        invoice_archive_request = request.user.invoicearchiverequest
+    except:
+        pass
+    invoice_archive_pending = invoice_archive_request and invoice_archive_request.state <= BACKUP_RESTORE_STATE_IN_PROGRESS
+
     if (backup_request and backup_request.state <= BACKUP_RESTORE_STATE_IN_PROGRESS) \
     or (restore_request and restore_request.state <= BACKUP_RESTORE_STATE_IN_PROGRESS):
         action_pending = True
@@ -45,6 +58,8 @@ def backup(request):
     backup_form = BackupForm(instance=backup_request)
     restore_form = RestoreForm(instance=restore_request)
     csv_form = CSVForm()
+    first_year = request.user.get_profile().creation_date.year
+    invoice_archive_form = InvoiceArchiveForm(first_year, instance=invoice_archive_request)
 
     if request.method == 'POST':
         if request.POST.get('backup_or_restore') == 'backup':
@@ -88,6 +103,21 @@ def backup(request):
                         position = RestoreRequest.objects.filter(state__lte=BACKUP_RESTORE_STATE_IN_PROGRESS).count()
                         messages.info(request, _("Your restore has been scheduled successfully. There are %i other restores before yours.") % (position - 1))
                         return redirect(reverse('backup'))
+        elif request.POST.get('backup_or_restore') == 'invoice_archive':
+            invoice_archive_form = InvoiceArchiveForm(first_year, request.POST, instance=invoice_archive_request)
+            if invoice_archive_form.is_valid():
+                if invoice_archive_pending:
+                    messages.error(request, _("An invoice archive is already scheduled"))
+                else:
+                    invoice_archive_request = invoice_archive_form.save(commit=False)
+                    invoice_archive_request.user = request.user
+                    invoice_archive_request.state = BACKUP_RESTORE_STATE_PENDING
+                    invoice_archive_request.error_message = None
+                    invoice_archive_request.creation_datetime = datetime.datetime.now()
+                    invoice_archive_request.last_state_datetime = invoice_archive_request.creation_datetime
+                    invoice_archive_request.save()
+                    messages.info(request, _("Your invoice archive has been scheduled successfully."))
+                    return redirect(reverse('backup'))
         else:
             messages.error(request, _("Form data have been tempered"))
 
@@ -98,6 +128,9 @@ def backup(request):
                'backup_form': backup_form,
                'restore_form': restore_form,
                'csv_form': csv_form,
+               'invoice_archive_request': invoice_archive_request,
+               'invoice_archive_form': invoice_archive_form,
+               'invoice_archive_pending': invoice_archive_pending,
                'action_pending': action_pending,
                'cant_restore': subscription.state == SUBSCRIPTION_STATE_TRIAL
                }
@@ -105,6 +138,20 @@ def backup(request):
                               context,
                               context_instance=RequestContext(request))
 
+@settings_required
+def backup_progress(request):
+    """
+    Progress of backup and restore of the user, polled by the backup page
+    """
+    data = {}
+    for key, model in [('backup', BackupRequest), ('restore', RestoreRequest)]:
+        data[key] = None
+        try:
+            data[key] = model.objects.get(user=request.user).get_progress()
+        except model.DoesNotExist:
+            pass
+    return HttpResponse(simplejson.dumps(data), mimetype='application/javascript')
+
 @settings_required
 def backup_download(request):
     try:
@@ -119,37 +166,147 @@ def backup_download(request):
     response["X-Sendfile"] = "%s%s/%s/%s" % (settings.FILE_UPLOAD_DIR, request.user.get_profile().uuid, 'backup', backup_request.get_backup_filename())
     return response
 
+@settings_required
+def invoice_archive_download(request):
+    try:
+        invoice_archive_request = request.user.invoicearchiverequest
+    except:
+        return HttpResponseNotFound()
+
+    if not invoice_archive_request.is_done():
+        return HttpResponseNotFound()
+
+    response = HttpResponse(mimetype='application/force-download')
+    response['Content-Disposition'] = 'attachment;filename="%s"'\
+                                    % smart_str(invoice_archive_request.get_archive_filename())
+
+    response["X-Sendfile"] = invoice_archive_request.get_archive_path()
+    return response
+
+CSV_EXPORT_CHUNK_SIZE = 500
+
+def iterate_chunks(queryset, key='pk', chunk_size=CSV_EXPORT_CHUNK_SIZE):
+    """
+    Iterates over lists of chunk_size objects of queryset ordered by key,
+    which must be unique, fetching one list per query so that large
+    exports are never loaded in memory at once
+    """
+    last_value = None
+    while True:
+        chunk = queryset.order_by(key)
+        if last_value is not None:
+            chunk = chunk.filter(**{'%s__gt' % (key): last_value})
+        chunk = list(chunk[:chunk_size])
+        yield chunk
+        if len(chunk) < chunk_size:
+            break
+        last_value = getattr(chunk[-1], key)
+
+def iterate_by_chunks(queryset, key='pk', chunk_size=CSV_EXPORT_CHUNK_SIZE):
+    for chunk in iterate_chunks(queryset, key, chunk_size):
+        for obj in chunk:
+            yield obj
+
+def csv_stream(header, rows):
+    """
+    Yields csv lines as soon as rows are produced
+    """
+    buffer = StringIO()
+    writer = unicodecsv.writer(buffer, encoding='utf-8')
+    for row in itertools.chain([header], rows):
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+def invoice_csv_rows(invoices, with_vat=False):
+    for chunk in iterate_chunks(invoices, 'invoice_id'):
+        if with_vat:
+            vat_totals = Invoice.objects.get_vat_totals(chunk)
+        for invoice in chunk:
+            customer = invoice.customer
+            address = customer and customer.address
+            row = [invoice.invoice_id, customer, address, invoice.get_state_display(), invoice.amount,
+                   invoice.edition_date, invoice.payment_date, invoice.get_payment_type_display(),
+                   invoice.paid_date, invoice.execution_begin_date, invoice.execution_end_date,
+                   invoice.penalty_date, invoice.penalty_rate, invoice.discount_conditions]
+            if with_vat:
+                row.append(vat_totals.get_vat([invoice.id]))
+            yield row
+
+def invoice_csv_rows_with_vat(invoices):
+    return invoice_csv_rows(invoices, with_vat=True)
+
+def invoice_row_csv_rows(invoice_rows):
+    for invoice_row in iterate_by_chunks(invoice_rows):
+        invoice = invoice_row.invoice
+        proposal_reference = None
+        if invoice_row.proposal:
+            proposal_reference = invoice_row.proposal.reference
+        yield [invoice.invoice_id, invoice.customer, invoice.edition_date, invoice.get_state_display(),
+               proposal_reference, invoice_row.label, invoice_row.get_category_display(),
+               invoice_row.quantity, invoice_row.unit_price, invoice_row.amount, invoice_row.vat_rate,
+               invoice_row.balance_payments]
+
+def expense_csv_rows(expenses):
+    for expense in iterate_by_chunks(expenses):
+        yield [expense.date, expense.reference, expense.supplier, expense.description,
+               expense.amount, expense.get_payment_type_display()]
+
+def proposal_csv_rows(proposals):
+    for proposal in iterate_by_chunks(proposals):
+        yield [proposal.reference, proposal.project, proposal.project.customer, proposal.get_state_display(),
+               proposal.amount, proposal.begin_date, proposal.end_date, proposal.update_date,
+               proposal.expiration_date]
+
 @settings_required
 def csv_export(request):
     form = CSVForm(request.GET)
     if form.is_valid():
         begin_date = form.cleaned_data.get('begin_date')
         end_date = form.cleaned_data.get('end_date')
+        data = form.cleaned_data.get('data') or CSV_EXPORT_INVOICES
 
-        response = HttpResponse(mimetype='text/csv')
-        response['Content-Disposition'] = 'attachment; filename=export.csv'
-
-        writer = unicodecsv.writer(response, encoding='utf-8')
-
-        row = [ugettext('Reference'), ugettext('Customer'), ugettext('Address'), ugettext('State'), ugettext('Amount'),
-               ugettext('Edition date'), ugettext('Payment date'), ugettext('Payment type'),
-               ugettext('Paid date'), ugettext('Execution begin date'), ugettext('Execution end date'),
-               ugettext('Penalty date'), ugettext('Penalty rate'), ugettext('Discount conditions')]
-        writer.writerow(row)
+        if data == CSV_EXPORT_INVOICE_ROWS:
+            objects = InvoiceRow.objects.filter(owner=request.user).select_related('invoice__customer', 'proposal')
+            date_field = 'invoice__edition_date'
+            header = [ugettext('Reference'), ugettext('Customer'), ugettext('Edition date'), ugettext('State'),
+                      ugettext('Proposal'), ugettext('Label'), ugettext('Category'),
+                      ugettext('Quantity'), ugettext('Unit price'), ugettext('Amount'), ugettext('Vat'),
+                      ugettext('Balance payments')]
+            rows = invoice_row_csv_rows
+        elif data == CSV_EXPORT_EXPENSES:
+            objects = Expense.objects.filter(owner=request.user)
+            date_field = 'date'
+            header = [ugettext('Date'), ugettext('Reference'), ugettext('Supplier'), ugettext('Description'),
+                      ugettext('Amount'), ugettext('Payment type')]
+            rows = expense_csv_rows
+        elif data == CSV_EXPORT_PROPOSALS:
+            objects = Proposal.objects.filter(owner=request.user).select_related('project__customer')
+            date_field = 'update_date'
+            header = [ugettext('Reference'), ugettext('Project'), ugettext('Customer'), ugettext('State'),
+                      ugettext('Amount'), ugettext('Begin date'), ugettext('End date'), ugettext('Update date'),
+                      ugettext('Expiration date')]
+            rows = proposal_csv_rows
+        else:
+            objects = Invoice.objects.filter(owner=request.user).select_related('customer__address__country')
+            date_field = 'edition_date'
+            header = [ugettext('Reference'), ugettext('Customer'), ugettext('Address'), ugettext('State'), ugettext('Amount'),
+                      ugettext('Edition date'), ugettext('Payment date'), ugettext('Payment type'),
+                      ugettext('Paid date'), ugettext('Execution begin date'), ugettext('Execution end date'),
+                      ugettext('Penalty date'), ugettext('Penalty rate'), ugettext('Discount conditions')]
+            rows = invoice_csv_rows
+            if request.user.get_profile().vat_number:
+                header.append(ugettext('VAT'))
+                rows = invoice_csv_rows_with_vat
 
-        invoices = Invoice.objects.filter(owner=request.user)
         if begin_date:
-            invoices = invoices.filter(edition_date__gte=begin_date)
+            objects = objects.filter(**{'%s__gte' % (date_field): begin_date})
         if end_date:
-            invoices = invoices.filter(edition_date__lte=end_date)
-
-        for invoice in invoices:
-            row = [invoice.invoice_id, invoice.customer, invoice.customer.address, invoice.get_state_display(), invoice.amount,
-                   invoice.edition_date, invoice.payment_date, invoice.get_payment_type_display(),
-                   invoice.paid_date, invoice.execution_begin_date, invoice.execution_end_date,
-                   invoice.penalty_date, invoice.penalty_rate, invoice.discount_conditions]
-            writer.writerow(row)
+            objects = objects.filter(**{'%s__lte' % (date_field): end_date})
 
+        response = HttpResponse(csv_stream(header, rows(objects)), mimetype='text/csv')
+        response['Content-Disposition'] = 'attachment; filename=%s.csv' % (data)
         return response
     else:
         messages.error(request, _('Export dates are invalid'))
@@ -8,6 +8,15 @@ from django.contrib.auth.decorators import login_required
 from django.utils.functional import wraps
 from django.utils.decorators import available_attrs
 from django.conf import settings
+from autoentrepreneur.models import get_access_state
+
+def get_request_access_state(request):
+    """
+    access state of the logged user, computed once per request
+    """
+    if not hasattr(request, '_access_state'):
+        request._access_state = get_access_state(request.user)
+    return request._access_state
 
 def settings_required(view_func, redirect_field_name=REDIRECT_FIELD_NAME):
     """
@@ -15,7 +24,7 @@ def settings_required(view_func, redirect_field_name=REDIRECT_FIELD_NAME):
     values are not set, use login_required.
     """
     def decorator(request, *args, **kwargs):
-        if request.user.get_profile().settings_defined():
+        if get_request_access_state(request)['settings_defined']:
             return view_func(request, *args, **kwargs)
         messages.info(request, _('You need to fill these informations to continue'))
         return HttpResponseRedirect(reverse('settings_edit'))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from autoentrepreneur.models import UserProfile, store
+
+class Command(BaseCommand):
+    help = 'Store uploaded files saved before content deduplication as blobs'
+
+    def handle(self, *args, **options):
+        i = 0
+        for uuid in UserProfile.objects.values_list('uuid', flat=True).iterator():
+            for dir in ['contract', 'logo', 'proposal']:
+                name = '%s/%s' % (uuid, dir)
+                if not store.exists(name):
+                    continue
+                for filename in store.listdir(name)[1]:
+                    store.deduplicate('%s/%s' % (name, filename))
+                    i = i + 1
+
+        print "%i file(s) deduplicated" % (i)
@@ -1,8 +1,7 @@
 # coding=utf-8
 
-import shutil
 from django.core.management.base import BaseCommand
-from autoentrepreneur.models import UserProfile, \
+from autoentrepreneur.models import UserProfile, store, \
     AUTOENTREPRENEUR_ACTIVITY_LIBERAL_BNC, \
     AUTOENTREPRENEUR_PROFESSIONAL_CATEGORY_LIBERAL, \
     AUTOENTREPRENEUR_PAYMENT_OPTION_QUATERLY
@@ -30,9 +29,7 @@ class Command(BaseCommand):
             self.stderr.write("Demo is set to False\n")
 
         for profile in UserProfile.objects.all():
-            shutil.rmtree('%s%s' % (settings.FILE_UPLOAD_DIR,
-                                    profile.uuid),
-                                    True)
+            store.delete_directory(profile.uuid)
             profile.user.delete()
 
         # reset sql sequence
@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 import uuid
 from django.db import models
+from django.db.models.signals import post_delete
 from django.contrib.auth.models import User
 
 class OwnedObject(models.Model):
     owner = models.ForeignKey(User)
     uuid = models.CharField(max_length=36, unique=True, default=uuid.uuid4)
+    modification_datetime = models.DateTimeField(auto_now=True, null=True)
 
     def save(self, force_insert=False, force_update=False, using=None, user=None):
         if user:
@@ -22,3 +24,19 @@ class OwnedObject(models.Model):
             self.uuid = uuid.uuid4()
 
         super(OwnedObject, self).save(force_insert, force_update, using)
+
+class DeletedObject(models.Model):
+    """
+    Keeps the uuid of deleted owned objects so that incremental backups
+    can tell which objects have to be deleted on restore. Recorded by
+    backup for owners who can make an incremental backup
+    """
+    owner = models.ForeignKey(User)
+    uuid = models.CharField(max_length=36)
+    deletion_datetime = models.DateTimeField(auto_now_add=True, db_index=True)
+
+def delete_deleted_objects(sender, instance, **kwargs):
+    # objects of a deleted user are recorded while the user is deleted
+    DeletedObject.objects.filter(owner=instance.id).delete()
+
+post_delete.connect(delete_deleted_objects, sender=User)
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Content addressed storage of uploaded files.
+
+Each distinct content is written once under BLOB_DIR, named by the sha1 of
+its bytes, and every file using it is a hard link to this blob. Files keep
+their usual path under the upload dir of their owner, so downloads and
+backups don't have to know about blobs. The link count of a blob minus one
+is its number of references and a blob is removed with its last reference.
+"""
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+
+BLOB_DIR = 'blobs'
+
+def file_digest(file):
+    digest = hashlib.sha1()
+    for chunk in iter(lambda: file.read(64 * 1024), ''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+class DeduplicatedStorage(FileSystemStorage):
+    def blob_path(self, digest):
+        return os.path.join(self.location, BLOB_DIR, digest[:2], digest)
+
+    def blob_exists(self, digest):
+        return os.path.exists(self.blob_path(digest))
+
+    def get_reference_count(self, digest):
+        try:
+            return os.stat(self.blob_path(digest)).st_nlink - 1
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return 0
+            raise
+
+    def get_digest(self, name):
+        """
+        Digest of the blob referenced by name, None if the file
+        hasn't been stored as a blob
+        """
+        full_path = self.path(name)
+        if os.stat(full_path).st_nlink < 2:
+            return None
+        file = open(full_path, 'rb')
+        try:
+            digest = file_digest(file)
+        finally:
+            file.close()
+        if self.is_reference(name, digest):
+            return digest
+        return None
+
+    def is_reference(self, name, digest):
+        full_path = self.path(name)
+        blob_path = self.blob_path(digest)
+        return os.path.exists(full_path) \
+            and os.path.exists(blob_path) \
+            and os.path.samefile(full_path, blob_path)
+
+    def _save(self, name, content):
+        blob_dir = os.path.join(self.location, BLOB_DIR)
+        if not os.path.exists(blob_dir):
+            os.makedirs(blob_dir)
+
+        # content is written in the blob dir so that it can be renamed to its blob
+        fd, temp_path = tempfile.mkstemp(dir=blob_dir)
+        digest = hashlib.sha1()
+        try:
+            for chunk in content.chunks():
+                digest.update(chunk)
+                os.write(fd, chunk)
+        finally:
+            os.close(fd)
+        digest = digest.hexdigest()
+
+        blob_path = self.blob_path(digest)
+        if os.path.exists(blob_path):
+            os.remove(temp_path)
+        else:
+            if not os.path.exists(os.path.dirname(blob_path)):
+                os.makedirs(os.path.dirname(blob_path))
+            if settings.FILE_UPLOAD_PERMISSIONS is not None:
+                os.chmod(temp_path, settings.FILE_UPLOAD_PERMISSIONS)
+            os.rename(temp_path, blob_path)
+
+        return self.link(digest, name)
+
+    def link(self, digest, name):
+        """
+        Makes name a reference to an existing blob and returns the name
+        actually used, which differs from the one asked if it is taken
+        """
+        full_path = self.path(name)
+        directory = os.path.dirname(full_path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        while True:
+            try:
+                os.link(self.blob_path(digest), full_path)
+            except OSError, e:
+                if e.errno == errno.EEXIST:
+                    name = self.get_available_name(name)
+                    full_path = self.path(name)
+                else:
+                    raise
+            else:
+                break
+
+        return name
+
+    def delete(self, name):
+        digest = None
+        if self.exists(name):
+            digest = self.get_digest(name)
+        super(DeduplicatedStorage, self).delete(name)
+        if digest and self.get_reference_count(digest) == 0:
+            try:
+                os.remove(self.blob_path(digest))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def delete_directory(self, name):
+        """
+        Deletes a directory and releases the blobs of its files
+        """
+        directory = self.path(name)
+        for path, dirnames, filenames in os.walk(directory):
+            for filename in filenames:
+                self.delete(os.path.relpath(os.path.join(path, filename), self.location))
+        shutil.rmtree(directory, True)
+
+    def deduplicate(self, name):
+        """
+        Turns a file saved before this storage was used into a reference
+        to the blob of its content
+        """
+        if self.get_digest(name):
+            return
+        full_path = self.path(name)
+        file = open(full_path, 'rb')
+        try:
+            digest = file_digest(file)
+        finally:
+            file.close()
+
+        blob_path = self.blob_path(digest)
+        if not os.path.exists(blob_path):
+            if not os.path.exists(os.path.dirname(blob_path)):
+                os.makedirs(os.path.dirname(blob_path))
+            # the file becomes the blob, nothing is copied
+            os.link(full_path, blob_path)
+        else:
+            temp_path = '%s.%s' % (full_path, digest)
+            os.link(blob_path, temp_path)
+            os.rename(temp_path, full_path)
@@ -6,14 +6,22 @@ import autoentrepreneur
 import accounts
 import core.views
 from autoentrepreneur.models import AUTOENTREPRENEUR_PROFESSIONAL_CATEGORY_LIBERAL, \
-    Subscription, SUBSCRIPTION_STATE_PAID, SUBSCRIPTION_STATE_FREE, UserProfile
+    Subscription, SUBSCRIPTION_STATE_PAID, SUBSCRIPTION_STATE_FREE, UserProfile, \
+    SalesLimit
 import datetime
 from registration.models import RegistrationProfile
 from django.test import TestCase
-from core.models import OwnedObject
+from core.models import OwnedObject, DeletedObject
+from backup.models import BackupRequest
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate
 from django.core.urlresolvers import reverse
+from django.core.files.base import ContentFile
+from core.storage import DeduplicatedStorage, BLOB_DIR
+import hashlib
+import os
+import shutil
+import tempfile
 from accounts.models import Invoice, INVOICE_STATE_EDITED, \
     PAYMENT_TYPE_CHECK, INVOICE_STATE_PAID, InvoiceRow, INVOICE_STATE_SENT
 
@@ -39,6 +47,27 @@ class PermissionTest(TestCase):
         ownedObject2.save(user=admin)
         self.assertEqual(ownedObject2.owner, admin)
 
+    def test_delete_owned_object(self):
+        """
+        Tests that deleting an object keeps its uuid
+        until its owner is deleted
+        """
+        user = User.objects.create_user('test_user', 'test@example.com', 'test')
+        now = datetime.datetime.now()
+        BackupRequest.objects.create(user=user,
+                                     creation_datetime=now,
+                                     last_state_datetime=now,
+                                     last_backup_datetime=now)
+        ownedObject = OwnedObject()
+        ownedObject.save(user=user)
+        self.assertNotEqual(ownedObject.modification_datetime, None)
+        uuid = ownedObject.uuid
+        ownedObject.delete()
+        self.assertEqual(DeletedObject.objects.filter(owner=user, uuid=uuid).count(), 1)
+
+        user.delete()
+        self.assertEqual(DeletedObject.objects.count(), 0)
+
 class ChangePasswordTest(TestCase):
     def setUp(self):
         self.user = User.objects.create_user('test_user', 'test@example.com', 'test')
@@ -168,6 +197,20 @@ class DashboardTest(TestCase):
         response = self.client.get(reverse('index'))
         self.assertEqual(response.context['sales']['remaining'], -1)
 
+    def testSalesSummary(self):
+        """
+        Tests sales summary matches figures computed one by one
+        """
+        user = User.objects.get(username='test')
+        today = datetimestub.DatetimeStub.date.today()
+        summary = Invoice.objects.get_sales_summary(owner=user, reference_date=today)
+        self.assertEqual(summary.paid, Invoice.objects.get_paid_sales(owner=user, reference_date=today))
+        self.assertEqual(summary.paid_previous_year, Invoice.objects.get_paid_sales(owner=user, reference_date=datetime.date(today.year - 1, 12, 31)))
+        self.assertEqual(summary.waiting, Invoice.objects.get_waiting_payments(owner=user))
+        self.assertEqual(summary.to_be_invoiced, Invoice.objects.get_to_be_invoiced(owner=user))
+        self.assertEqual(summary.first_invoice_paid_date, Invoice.objects.get_first_invoice_paid_date(owner=user))
+        self.assertEqual(summary.total, 7250)
+
     def testLimit(self):
         """
         Tests computation of sales limit
@@ -463,6 +506,7 @@ class DashboardProductActivityTest(TestCase):
         autoentrepreneur.models.datetime = datetime
         accounts.models.datetime = datetime
         core.views.datetime = datetime
+        SalesLimit.objects.clear_cache()
 
     def testServicePaid(self):
         response = self.client.get(reverse('index'))
@@ -489,6 +533,16 @@ class DashboardProductActivityTest(TestCase):
         self.assertEqual(response.context['sales']['remaining'], 81250)
         self.assertEqual(response.context['sales']['service_remaining'], 32440)
 
+    def testServiceSalesSummary(self):
+        user = User.objects.get(username='test')
+        today = datetimestub.DatetimeStub.date.today()
+        summary = Invoice.objects.get_sales_summary(owner=user, reference_date=today)
+        self.assertEqual(summary.service_paid, Invoice.objects.get_paid_service_sales(owner=user, year=today.year))
+        self.assertEqual(summary.service_paid_previous_year, Invoice.objects.get_paid_service_sales(owner=user, year=today.year - 1))
+        self.assertEqual(summary.service_waiting, Invoice.objects.get_waiting_service_payments(owner=user))
+        self.assertEqual(summary.service_to_be_invoiced, Invoice.objects.get_service_to_be_invoiced(owner=user))
+        self.assertEqual(summary.service_total, 160)
+
     def testServiceLimit(self):
         response = self.client.get(reverse('index'))
         self.assertEqual(response.context['sales']['limit'], 81500)
@@ -1305,3 +1359,46 @@ class AdminDashboardTest(TestCase):
         self.assertEquals(users[3]['value'], 3) # expired users
         self.assertEquals(users[4]['value'], 4) # active users
         self.assertEquals(users[5]['value'], 1) # subscribed users
+
+class DeduplicatedStorageTest(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.store = DeduplicatedStorage(location=self.location)
+
+    def tearDown(self):
+        shutil.rmtree(self.location, True)
+
+    def testSameContentStoredOnce(self):
+        name1 = self.store.save('user1/contract/contract.txt', ContentFile('content'))
+        name2 = self.store.save('user2/contract/other.txt', ContentFile('content'))
+        name3 = self.store.save('user2/contract/other.txt', ContentFile('other content'))
+        self.assertEquals(name3, 'user2/contract/other_1.txt')
+        digest = self.store.get_digest(name1)
+        self.assertEquals(digest, hashlib.sha1('content').hexdigest())
+        self.assertTrue(os.path.samefile(self.store.path(name1), self.store.path(name2)))
+        self.assertEquals(self.store.get_reference_count(digest), 2)
+        self.assertEquals(self.store.open(name2).read(), 'content')
+
+        self.store.delete(name1)
+        self.assertEquals(self.store.get_reference_count(digest), 1)
+        self.assertTrue(self.store.blob_exists(digest))
+        self.store.delete_directory('user2')
+        self.assertFalse(self.store.exists('user2'))
+        self.assertFalse(self.store.blob_exists(digest))
+        self.assertEquals(os.listdir(os.path.join(self.location, BLOB_DIR, digest[:2])), [])
+
+    def testDeduplicate(self):
+        for name in ['user1/logo/logo.png', 'user2/logo/logo.png']:
+            os.makedirs(os.path.dirname(self.store.path(name)))
+            file = open(self.store.path(name), 'wb')
+            file.write('logo')
+            file.close()
+        self.assertEquals(self.store.get_digest('user1/logo/logo.png'), None)
+
+        self.store.deduplicate('user1/logo/logo.png')
+        self.store.deduplicate('user2/logo/logo.png')
+        self.store.deduplicate('user2/logo/logo.png')
+        digest = hashlib.sha1('logo').hexdigest()
+        self.assertEquals(self.store.get_reference_count(digest), 2)
+        self.assertTrue(self.store.is_reference('user2/logo/logo.png', digest))
+        self.assertEquals(self.store.open('user2/logo/logo.png').read(), 'logo')
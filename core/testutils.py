@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.db import connection
+
+class capture_queries(object):
+    """
+    Gives the list of queries executed within the block, recorded with
+    settings.DEBUG enabled. DEBUG is restored when leaving the block.
+    A request made by the test client clears queries made before it
+    """
+    def __enter__(self):
+        self.debug = settings.DEBUG
+        settings.DEBUG = True
+        connection.queries = []
+        self.queries = []
+        return self.queries
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        settings.DEBUG = self.debug
+        self.queries.extend(connection.queries)
+        return False
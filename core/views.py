@@ -13,13 +13,14 @@ from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.utils import simplejson
 from accounts.models import Expense, Invoice, INVOICE_STATE_PAID, \
-    PAYMENT_TYPE_BANK_CARD, InvoiceRow
+    PAYMENT_TYPE_BANK_CARD, InvoiceRow, SalesLedgerEntry
 from core.decorators import settings_required, disabled_for_demo
 from autoentrepreneur.models import AUTOENTREPRENEUR_ACTIVITY_PRODUCT_SALE_BIC, \
     Subscription, SUBSCRIPTION_STATE_NOT_PAID, SUBSCRIPTION_STATE_PAID, \
     SUBSCRIPTION_STATE_TRIAL, UserProfile
 from project.models import Proposal, Project, PROJECT_STATE_FINISHED, \
-    PROPOSAL_STATE_BALANCED, ROW_CATEGORY_SERVICE, ProposalRow, VAT_RATES_19_6
+    PROPOSAL_STATE_BALANCED, ROW_CATEGORY_SERVICE, ProposalRow, VAT_RATES_19_6, \
+    batch_edit
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.models import User
 from autoentrepreneur.decorators import subscription_required
@@ -81,29 +82,29 @@ def index(request):
     service_limit_previous_year = 0
     service_remaining = 0
 
-    paid = Invoice.objects.get_paid_sales(owner=user)
+    summary = Invoice.objects.get_sales_summary(owner=user, reference_date=today)
+    paid = summary.paid
 
     if not first_year:
-        paid_previous_year = Invoice.objects.get_paid_sales(owner=user,
-                                                            reference_date=datetime.date(one_year_back.year, 12, 31))
-    waiting = Invoice.objects.get_waiting_payments(owner=user)
-    to_be_invoiced = Invoice.objects.get_to_be_invoiced(owner=user)
+        paid_previous_year = summary.paid_previous_year
+    waiting = summary.waiting
+    to_be_invoiced = summary.to_be_invoiced
     limit = profile.get_sales_limit()
     remaining = limit - paid - waiting - to_be_invoiced
     sales_limit = profile.get_sales_limit()
     sales_limit2 = profile.get_sales_limit2()
 
-    if user.get_profile().activity == AUTOENTREPRENEUR_ACTIVITY_PRODUCT_SALE_BIC:
-        service_waiting = Invoice.objects.get_waiting_service_payments(owner=user)
-        service_to_be_invoiced = Invoice.objects.get_service_to_be_invoiced(owner=user)
+    if profile.activity == AUTOENTREPRENEUR_ACTIVITY_PRODUCT_SALE_BIC:
+        service_waiting = summary.service_waiting
+        service_to_be_invoiced = summary.service_to_be_invoiced
         service_limit = profile.get_service_sales_limit()
-        service_paid = Invoice.objects.get_paid_service_sales(owner=user)
+        service_paid = summary.service_paid
         service_remaining = service_limit - service_paid - service_waiting - service_to_be_invoiced
     if not first_year:
         limit_previous_year = profile.get_sales_limit(year=one_year_back.year)
-        if user.get_profile().activity == AUTOENTREPRENEUR_ACTIVITY_PRODUCT_SALE_BIC:
+        if profile.activity == AUTOENTREPRENEUR_ACTIVITY_PRODUCT_SALE_BIC:
             service_limit_previous_year = profile.get_service_sales_limit(year=one_year_back.year)
-            service_paid_previous_year = Invoice.objects.get_paid_service_sales(owner=user, year=one_year_back.year)
+            service_paid_previous_year = summary.service_paid_previous_year
 
     if not first_year and paid_previous_year > limit_previous_year:
         messages.warning(request, _('You will leave the Auto-entrepreneur status at the end of the current year.'))
@@ -140,7 +141,7 @@ def index(request):
     duration = Proposal.objects.get_potential_duration(owner=user)
     proposals_to_send = Proposal.objects.get_proposals_to_send(owner=user)
 
-    min_date = Invoice.objects.get_first_invoice_paid_date(owner=user)
+    min_date = summary.first_invoice_paid_date
     if not min_date:
         chart_begin_date = today
     elif min_date < one_year_back:
@@ -215,7 +216,7 @@ def index(request):
              'service_waiting': service_waiting,
              'to_be_invoiced': to_be_invoiced,
              'service_to_be_invoiced': service_to_be_invoiced,
-             'total': paid + waiting + to_be_invoiced,
+             'total': summary.total,
              'service_total': service_paid + service_waiting + service_to_be_invoiced,
              'limit': limit,
              'service_limit': service_limit,
@@ -248,12 +249,15 @@ def index(request):
                  'average_unit_price': average_unit_price,
                  'proposals_to_send': proposals_to_send}
 
-    taxes = profile.get_tax_data(today)
-    if taxes['period_begin'] == profile.creation_date:
-        previous_taxes = None
-    else:
-        previous_taxes = profile.get_tax_data(taxes['period_begin'] - datetime.timedelta(1))
-    next_taxes = profile.get_tax_data(taxes['tax_due_date'] + datetime.timedelta(1))
+    period_begin, period_end = profile.get_period_for_tax(today)
+    reference_dates = [today, profile.get_pay_date(period_end) + datetime.timedelta(1)]
+    if period_begin != profile.creation_date:
+        reference_dates.append(period_begin - datetime.timedelta(1))
+    tax_data = profile.get_tax_data_for_dates(reference_dates)
+    taxes, next_taxes = tax_data[0], tax_data[1]
+    previous_taxes = None
+    if len(tax_data) > 2:
+        previous_taxes = tax_data[2]
 
     charts = {'sales_progression':simplejson.dumps(sales_progression),
               'waiting_progression':simplejson.dumps(waiting_progression),
@@ -301,8 +305,7 @@ def settings_edit(request):
             if request.FILES:
                 try:
                     if old_image:
-                        if os.path.exists(old_image.path):
-                            os.remove(old_image.path)
+                        old_image.storage.delete(old_image.name)
                 except:
                     pass
             userform.save()
@@ -351,8 +354,7 @@ def logo_delete(request):
         profile = request.user.get_profile()
         try:
             if profile.logo_file:
-                if os.path.exists(profile.logo_file.path):
-                    os.remove(profile.logo_file.path)
+                profile.logo_file.storage.delete(profile.logo_file.name)
                 profile.logo_file = ""
                 profile.save()
             response['error'] = 'ok'
@@ -514,38 +516,40 @@ def paypal_ipn(request):
             if provider.get_profile().vat_number:
                 unit_price = Decimal(unit_price) / Decimal('1.196')
 
-            proposal_row = ProposalRow.objects.create(proposal=proposal,
-                                                      label=item_name,
-                                                      category=ROW_CATEGORY_SERVICE,
-                                                      quantity=1,
-                                                      unit_price='%s' % unit_price,
-                                                      owner=provider)
-
-            # finally create invoice
-            invoice = Invoice.objects.create(customer=customer,
-                                             invoice_id=Invoice.objects.get_next_invoice_id(provider),
-                                             state=INVOICE_STATE_PAID,
-                                             amount=payment_amount,
-                                             edition_date=datetime.date.today(),
-                                             payment_date=datetime.date.today(),
-                                             paid_date=datetime.date.today(),
-                                             payment_type=PAYMENT_TYPE_BANK_CARD,
-                                             execution_begin_date=begin_date,
-                                             execution_end_date=subscription.expiration_date,
-                                             penalty_date=None,
-                                             penalty_rate=None,
-                                             discount_conditions=None,
-                                             owner=provider)
-
-            invoice_row = InvoiceRow.objects.create(proposal=proposal,
-                                                    invoice=invoice,
-                                                    label=item_name,
-                                                    category=ROW_CATEGORY_SERVICE,
-                                                    quantity=1,
-                                                    unit_price=payment_amount,
-                                                    balance_payments=True,
-                                                    vat_rate=VAT_RATES_19_6,
-                                                    owner=provider)
+            # amounts of proposal and invoice are computed once from their rows
+            with batch_edit():
+                proposal_row = ProposalRow.objects.create(proposal=proposal,
+                                                          label=item_name,
+                                                          category=ROW_CATEGORY_SERVICE,
+                                                          quantity=1,
+                                                          unit_price='%s' % unit_price,
+                                                          owner=provider)
+
+                # finally create invoice
+                invoice = Invoice.objects.create(customer=customer,
+                                                 invoice_id=Invoice.objects.allocate_invoice_id(provider),
+                                                 state=INVOICE_STATE_PAID,
+                                                 amount=payment_amount,
+                                                 edition_date=datetime.date.today(),
+                                                 payment_date=datetime.date.today(),
+                                                 paid_date=datetime.date.today(),
+                                                 payment_type=PAYMENT_TYPE_BANK_CARD,
+                                                 execution_begin_date=begin_date,
+                                                 execution_end_date=subscription.expiration_date,
+                                                 penalty_date=None,
+                                                 penalty_rate=None,
+                                                 discount_conditions=None,
+                                                 owner=provider)
+
+                invoice_row = InvoiceRow.objects.create(proposal=proposal,
+                                                        invoice=invoice,
+                                                        label=item_name,
+                                                        category=ROW_CATEGORY_SERVICE,
+                                                        quantity=1,
+                                                        unit_price=payment_amount,
+                                                        balance_payments=True,
+                                                        vat_rate=VAT_RATES_19_6,
+                                                        owner=provider)
             # create expense for paypal fee
             expense = Expense.objects.create(date=datetime.date.today(),
                                              reference=transaction_id,
@@ -716,6 +720,11 @@ def admin_dashboard(request):
                  'value': Invoice.objects.count()})
     data.append({'label':_('Users having invoices'),
                  'value': Invoice.objects.values('owner').distinct().order_by().count()})
+    data.append({'label':_('Paid sales this year'),
+                 'value': SalesLedgerEntry.objects.get_paid_sales(begin_date=datetime.date(datetime.date.today().year, 1, 1),
+                                                                  end_date=datetime.date.today())})
+    data.append({'label':_('Unpaid invoices, drafts included'),
+                 'value': SalesLedgerEntry.objects.get_waiting_sales()})
 
     context = {'users': users,
                'activity': activity,
@@ -1,26 +1,41 @@
-## {{{ http://code.activestate.com/recipes/576832/ (r2)
+## based on http://code.activestate.com/recipes/576832/ (r2)
 from reportlab.pdfgen import canvas
 from reportlab.lib.units import inch, mm
 
+PAGE_COUNT_FORM = 'page_count'
+
 class NumberedCanvas(canvas.Canvas):
+    """
+    Canvas adding "Page x/y" at the bottom of each page.
+    The page count is drawn in a form referenced by every page and
+    defined when saving, so pages don't have to be kept until the end.
+    """
     def __init__(self, *args, **kwargs):
         canvas.Canvas.__init__(self, *args, **kwargs)
-        self._saved_page_states = []
+        self._page_count = 0
 
     def showPage(self):
-        self._saved_page_states.append(dict(self.__dict__))
-        self._startPage()
+        self._page_count = self._page_count + 1
+        self.draw_page_number()
+        canvas.Canvas.showPage(self)
 
     def save(self):
-        """add page info to each page (page x of y)"""
-        num_pages = len(self._saved_page_states)
-        for state in self._saved_page_states:
-            self.__dict__.update(state)
-            self.draw_page_number(num_pages)
-            canvas.Canvas.showPage(self)
+        """add page count to the pages (page x of y)"""
+        if len(self._code):
+            self.showPage()
+        self.beginForm(PAGE_COUNT_FORM)
+        self.setFont('Times-Roman', 10)
+        self.drawString(0, 0, "%d" % (self._page_count))
+        self.endForm()
         canvas.Canvas.save(self)
 
-    def draw_page_number(self, page_count):
+    def draw_page_number(self):
         self.setFont('Times-Roman', 10)
-        self.drawRightString(200 * mm, 0.25 * inch,
-            "Page %d/%d" % (self._pageNumber, page_count))
+        # room is reserved for up to 99 pages, count is left aligned
+        x = 200 * mm - self.stringWidth("Page 99/99", 'Times-Roman', 10)
+        text = "Page %d/" % (self._pageNumber)
+        self.drawString(x, 0.25 * inch, text)
+        self.saveState()
+        self.translate(x + self.stringWidth(text, 'Times-Roman', 10), 0.25 * inch)
+        self.doForm(PAGE_COUNT_FORM)
+        self.restoreState()
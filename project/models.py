@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import unicodedata
+import threading
 from reportlab.platypus import Paragraph
 from reportlab.lib.units import inch
 from reportlab.platypus import Table, TableStyle, Spacer
@@ -16,11 +17,12 @@ from django.db.models.aggregates import Sum
 from core.templatetags.htmltags import to_html
 from django.conf import settings
 import ho.pisa as pisa
-from django.core.files.storage import FileSystemStorage
+from core.storage import DeduplicatedStorage
 from django.db.models.query_utils import Q
+from django.db.models.expressions import F
 from project.utils.pdf import ProposalTemplate
 
-store = FileSystemStorage(location=settings.FILE_UPLOAD_DIR)
+store = DeduplicatedStorage(location=settings.FILE_UPLOAD_DIR)
 
 def contract_upload_to_handler(instance, filename):
         return "%s/contract/%s" % (instance.owner.get_profile().uuid, unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore'))
@@ -175,6 +177,9 @@ class ProposalManager(models.Manager):
 def proposal_upload_to_handler(instance, filename):
         return "%s/proposal/%s" % (instance.owner.get_profile().uuid, unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore'))
 
+# fields of proposals maintained from invoice rows
+PROPOSAL_INVOICING_FIELDS = ['invoiced_amount', 'balanced', 'balanced_by_sent_invoice']
+
 class Proposal(OwnedObject):
     project = models.ForeignKey(Project)
     reference = models.CharField(max_length=20, blank=True, null=True, verbose_name=_('Reference'))
@@ -190,12 +195,31 @@ class Proposal(OwnedObject):
     payment_delay_type_other = models.IntegerField(choices=PAYMENT_DELAY_TYPE_OTHER, blank=True, null=True)
     contract_file = models.FileField(upload_to=proposal_upload_to_handler, null=True, blank=True, storage=store, verbose_name=_('Uploaded contract'), help_text=_('max. %(FILE_MAX_SIZE)s') % {'FILE_MAX_SIZE': settings.FILE_MAX_SIZE})
     footer_note = models.CharField(max_length=90, blank=True, null=True, verbose_name=_('Footer note'))
+    # maintained from invoice rows by accounts, checked by command check_invoiced_amounts
+    invoiced_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0, editable=False)
+    balanced = models.BooleanField(default=False, editable=False)
+    balanced_by_sent_invoice = models.BooleanField(default=False, editable=False)
 
     objects = ProposalManager()
 
     class Meta:
         ordering = ['begin_date', 'update_date']
 
+    def save(self, force_insert=False, force_update=False, using=None, user=None):
+        # only invoice rows write these fields, a proposal loaded before its
+        # rows changed must not overwrite them: the update keeps the values
+        # of the database
+        invoicing_values = []
+        if self.pk and self._state.db and not force_insert:
+            for field_name in PROPOSAL_INVOICING_FIELDS:
+                invoicing_values.append((field_name, getattr(self, field_name)))
+                setattr(self, field_name, F(field_name))
+        try:
+            super(Proposal, self).save(force_insert, force_update, using, user)
+        finally:
+            for field_name, value in invoicing_values:
+                setattr(self, field_name, value)
+
     def __unicode__(self):
         if self.begin_date and self.end_date:
             return _('Proposal %(reference)s from %(begin_date)s to %(end_date)s for %(project)s') % {'reference': self.reference,
@@ -221,16 +245,13 @@ class Proposal(OwnedObject):
         return ()
 
     def get_remaining_to_invoice(self, exclude_invoice=None):
-        balancing_invoices = self.invoice_rows.filter(balance_payments=True)
-        has_balancing_invoice = balancing_invoices.count()
-        if not exclude_invoice and has_balancing_invoice:
+        if not exclude_invoice and self.balanced:
             return 0
 
-        invoice_rows = self.invoice_rows.filter(invoice__state__gte=1)
+        invoice_amount = self.invoiced_amount
         if exclude_invoice:
-            invoice_rows = invoice_rows.exclude(invoice=exclude_invoice)
-        invoice_amount = invoice_rows.aggregate(amount=Sum('amount'))
-        return self.amount - (invoice_amount['amount'] or 0)
+            invoice_amount = invoice_amount - (self.invoice_rows.filter(invoice=exclude_invoice).aggregate(amount=Sum('amount'))['amount'] or 0)
+        return self.amount - invoice_amount
 
     def get_payment_delay(self):
         if self.payment_delay <> PAYMENT_DELAY_OTHER:
@@ -257,12 +278,21 @@ class Proposal(OwnedObject):
             raise ProposalAmountError(ugettext("Proposal amount can't be less than sum of invoices"))
         self.save(user=self.owner)
 
+    def get_pdf_filename(self):
+        return ugettext('proposal_%(id)d.pdf') % {'id': self.id}
+
+    def get_pdf_cache_objects(self):
+        """
+        Objects used to render the pdf of the proposal
+        """
+        customer = self.project.customer
+        return [self, customer, customer.address] + list(self.proposal_rows.all())
+
     def to_pdf(self, user, response):
         """
         Generate a PDF file for the proposal
         """
-        filename = ugettext('proposal_%(id)d.pdf') % {'id': self.id}
-        response['Content-Disposition'] = 'attachment; filename=%s' % (filename)
+        response['Content-Disposition'] = 'attachment; filename=%s' % (self.get_pdf_filename())
 
         proposal_template = ProposalTemplate(response, user)
 
@@ -405,11 +435,62 @@ def update_row_amount(sender, instance, **kwargs):
     row = instance
     row.amount = Decimal(row.quantity) * Decimal(row.unit_price)
 
+# parent amounts to update when leaving the current batch_edit block, per thread
+_batch_edit = threading.local()
+
+def defer_amount_update(update_amounts, parent_id):
+    """
+    Returns False outside of a batch_edit block, otherwise
+    update_amounts will be called on exit with parent_id
+    """
+    updates = getattr(_batch_edit, 'updates', None)
+    if updates is None:
+        return False
+    updates.setdefault(update_amounts, set()).add(parent_id)
+    return True
+
+class batch_edit(object):
+    """
+    Context manager suspending the update of proposal and invoice
+    amounts each time one of their rows is saved or deleted.
+    Amounts of the parents of these rows are updated once on exit:
+
+        with batch_edit():
+            for row in rows:
+                row.save(user=user)
+
+    Blocks can be nested, amounts are updated when leaving the outermost one.
+    Nothing is updated if the block raises an exception.
+    Parents already loaded are not refreshed.
+    """
+    def __enter__(self):
+        self.outermost = getattr(_batch_edit, 'updates', None) is None
+        if self.outermost:
+            _batch_edit.updates = {}
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.outermost:
+            updates = _batch_edit.updates
+            del _batch_edit.updates
+            if exc_type is None:
+                for update_amounts, parent_ids in updates.items():
+                    update_amounts(parent_ids)
+        return False
+
 class ProposalRow(Row):
     proposal = models.ForeignKey(Proposal, related_name="proposal_rows")
 
+def update_proposals_amount(proposal_ids):
+    amounts = dict(ProposalRow.objects.filter(proposal__in=proposal_ids).values_list('proposal').annotate(Sum('amount')).order_by())
+    for proposal in Proposal.objects.filter(pk__in=proposal_ids).iterator():
+        proposal.amount = amounts.get(proposal.id) or 0
+        proposal.save(user=proposal.owner)
+
 def update_proposal_amount(sender, instance, created, **kwargs):
     row = instance
+    if defer_amount_update(update_proposals_amount, row.proposal_id):
+        return
     proposal = row.proposal
     proposal.amount = proposal.proposal_rows.all().aggregate(sum=Sum('amount'))['sum'] or 0
     proposal.save(user=proposal.owner)
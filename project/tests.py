@@ -15,9 +15,13 @@ from accounts.models import Invoice, InvoiceRow, INVOICE_STATE_EDITED, \
 from contact.models import Contact, Address, Country, CONTACT_TYPE_PERSON
 import datetime
 import hashlib
+import os
+import shutil
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.webdesign import lorem_ipsum
-from autoentrepreneur.models import AUTOENTREPRENEUR_REGISTER_RSEIRL
+from autoentrepreneur.models import AUTOENTREPRENEUR_REGISTER_RSEIRL, UserProfile
+from project.utils.pdf import get_letterhead
 from django.utils import simplejson
 
 class ContractPermissionTest(TestCase):
@@ -673,7 +677,9 @@ class ProposalTest(TestCase):
                                           balance_payments=False,
                                           owner_id=1)
 
-        self.assertEqual(p.get_remaining_to_invoice(), 1005)
+        # amounts are updated in database by proposal and invoice rows
+        p = Proposal.objects.get(pk=p.id)
+        self.assertEqual(p.get_remaining_to_invoice(), 3010)
 
     def testAmountGTEInvoices(self):
         """
@@ -800,9 +806,9 @@ class ProposalTest(TestCase):
         f.write(response.content)
         f.close()
         content = response.content.split("\n")
-        invariant_content = content[0:66] + content[67:110] + content[111:-1]
+        invariant_content = content[0:94] + content[95:139] + content[140:-1]
         self.assertEquals(hashlib.md5("\n".join(invariant_content)).hexdigest(),
-                          "489e25b4c6a9c868301776b0883bc0b6")
+                          "dd5d445ee2f21059318fc0497aac92d2")
 
     def testDownloadPdfWithFooterNote(self):
         """
@@ -839,9 +845,9 @@ class ProposalTest(TestCase):
         f.write(response.content)
         f.close()
         content = response.content.split("\n")
-        invariant_content = content[0:66] + content[67:110] + content[111:-1]
+        invariant_content = content[0:94] + content[95:139] + content[140:-1]
         self.assertEquals(hashlib.md5("\n".join(invariant_content)).hexdigest(),
-                          "7dc9d6a1064e0784223c1054dd48b957")
+                          "08a45c98b17c3b0236aa897237e26fec")
 
     def testDownloadPdfWithRegistrationNumber(self):
         """
@@ -882,9 +888,64 @@ class ProposalTest(TestCase):
         f.write(response.content)
         f.close()
         content = response.content.split("\n")
-        invariant_content = content[0:66] + content[67:110] + content[111:-1]
+        invariant_content = content[0:94] + content[95:139] + content[140:-1]
         self.assertEquals(hashlib.md5("\n".join(invariant_content)).hexdigest(),
-                          "535fc052b7141a883e010a4d3720d7a7")
+                          "e8d015dc62a391c25b5c1d8648c0aaf9")
+
+    def testLetterheadCache(self):
+        user = User.objects.get(pk=1)
+        profile = user.get_profile()
+        self.assertFalse(u'Lyon' in get_letterhead(user).footer_text)
+        profile.register = AUTOENTREPRENEUR_REGISTER_RSEIRL
+        profile.registration_city = 'Paris'
+        profile.save()
+        self.assertEquals(get_letterhead(user).register_info, u'RSEIRL Paris %s' % (profile.company_id[:9]))
+        address = profile.address
+        address.city = 'Lyon'
+        address.save()
+        self.assertTrue(u'Lyon' in get_letterhead(user).footer_text)
+        # changes made by another process, which can't clear this process cache
+        UserProfile.objects.filter(user=user).update(iban_bban='FR7630001007941234567890185')
+        self.assertEquals(get_letterhead(User.objects.get(pk=1)).iban_bban, 'FR7630001007941234567890185')
+
+    def testDownloadPdfCache(self):
+        p = Proposal.objects.create(project_id=30,
+                                    update_date=datetime.date(2011, 2, 5),
+                                    state=PROPOSAL_STATE_DRAFT,
+                                    begin_date=datetime.date(2010, 8, 1),
+                                    end_date=datetime.date(2010, 8, 15),
+                                    contract_content='Content of contract',
+                                    amount=2005,
+                                    reference='XXX',
+                                    expiration_date=datetime.date(2010, 8, 2),
+                                    owner_id=1)
+
+        p_row = ProposalRow.objects.create(proposal_id=p.id,
+                                           label='Day of work',
+                                           category=ROW_CATEGORY_SERVICE,
+                                           quantity=20,
+                                           unit_price='200.5',
+                                           owner_id=1)
+
+        settings.PDF_CACHE_SIZE = 10 * 1024 * 1024
+        path = None
+        try:
+            response = self.client.get(reverse('proposal_download', kwargs={'id': p.id}))
+            self.assertEqual(response.status_code, 200)
+            path = response['X-Sendfile']
+            self.assertTrue(os.path.exists(path))
+
+            response = self.client.get(reverse('proposal_download', kwargs={'id': p.id}))
+            self.assertEquals(response['X-Sendfile'], path)
+
+            p_row.label = 'Day of work 2'
+            p_row.save()
+            response = self.client.get(reverse('proposal_download', kwargs={'id': p.id}))
+            self.assertNotEquals(response['X-Sendfile'], path)
+        finally:
+            settings.PDF_CACHE_SIZE = 0
+            if path:
+                shutil.rmtree(os.path.dirname(path), ignore_errors=True)
 
     def testBug240(self):
         """
@@ -921,9 +982,9 @@ class ProposalTest(TestCase):
         f.write(response.content)
         f.close()
         content = response.content.split("\n")
-        invariant_content = content[0:76] + content[77:121] + content[122:-1]
+        invariant_content = content[0:104] + content[105:150] + content[151:-1]
         self.assertEquals(hashlib.md5("\n".join(invariant_content)).hexdigest(),
-                          "b0ba361910042d9fd727ad17eb80e94a")
+                          "a4c31592f2db7bd2e9db1430655b4446")
 
     def testBug245(self):
         """
@@ -959,9 +1020,9 @@ class ProposalTest(TestCase):
         f.write(response.content)
         f.close()
         content = response.content.split("\n")
-        invariant_content = content[0:66] + content[67:110] + content[111:-1]
+        invariant_content = content[0:94] + content[95:139] + content[140:-1]
         self.assertEquals(hashlib.md5("\n".join(invariant_content)).hexdigest(),
-                          "72424ed26747855a7166a887b77eb75b")
+                          "dfced4330b7779cbc67e7fbf6ea6bd56")
 
     def testContractDownloadPdf(self):
         """
@@ -1173,9 +1234,9 @@ class ProposalTest(TestCase):
         f.write(response.content)
         f.close()
         content = response.content.split("\n")
-        invariant_content = content[0:66] + content[67:110] + content[111:-1]
+        invariant_content = content[0:94] + content[95:139] + content[140:-1]
         self.assertEquals(hashlib.md5("\n".join(invariant_content)).hexdigest(),
-                          "c892095693e8cd4470738b36b60b6a84")
+                          "86e6c614e2abf679f4617d31531e2017")
 
     def testDownloadPdfWithRowDetail(self):
         """
@@ -1232,9 +1293,9 @@ class ProposalTest(TestCase):
         f.write(response.content)
         f.close()
         content = response.content.split("\n")
-        invariant_content = content[0:95] + content[96:152] + content[153:-1]
+        invariant_content = content[0:124] + content[125:182] + content[183:-1]
         self.assertEquals(hashlib.md5("\n".join(invariant_content)).hexdigest(),
-                          "3af10992262c39ea7d83e54248797b1a")
+                          "5bd62e6f6efdf8b997d6ab26ebeb4e58")
 
 class Bug31Test(TestCase):
     fixtures = ['test_dashboard_product_sales']
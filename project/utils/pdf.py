@@ -16,6 +16,96 @@ from reportlab.lib.enums import TA_CENTER
 from custom_canvas import NumberedCanvas
 from django.template.defaultfilters import force_escape
 from reportlab.platypus.paragraph import FragLine, ParaLines
+from django.core.cache import cache
+from django.utils.encoding import smart_str
+from cStringIO import StringIO
+from contact.models import Address
+import hashlib
+
+# seconds during which the letterhead of a user is kept in cache
+LETTERHEAD_CACHE_TIMEOUT = 3600
+
+def get_letterhead_cache_key(user):
+    """
+    Built from the values the letterhead is made of, so that a change made
+    in any process gives a new key without invalidating the cache
+    """
+    profile = user.get_profile()
+    address_modification = Address.objects.filter(pk=profile.address_id).values_list('modification_datetime', flat=True)[0]
+    values = [user.first_name, user.last_name, address_modification]
+    values.extend([getattr(profile, field.attname) for field in profile._meta.fields])
+    return 'pdf_letterhead_%s_%s' % (user.id, hashlib.sha1(smart_str(repr(values))).hexdigest())
+
+class Letterhead(object):
+    """
+    Parts of proposals and invoices depending only on the user :
+    header content, logo data and footer lines
+    """
+    def __init__(self, user):
+        profile = user.get_profile()
+        address = profile.address
+
+        self.footer_text = u"%s %s - %s, %s %s" % (user.first_name,
+                                                   user.last_name,
+                                                   address.street.replace("\n", ", ").replace("\r", ""),
+                                                   address.zipcode,
+                                                   address.city)
+        if address.country:
+            self.footer_text = self.footer_text + u", %s" % (address.country)
+        self.footer_extra_info = u"SIRET : %s" % (profile.company_id)
+        if profile.vat_number:
+            self.footer_extra_info = u"%s - N° TVA : %s" % (self.footer_extra_info, profile.vat_number)
+
+        user_header_content = u"""
+        %s %s<br/>
+        %s<br/>
+        %s %s<br/>
+        %s<br/>
+        SIRET : %s<br/>
+        """
+        self.user_header_content = user_header_content % (user.first_name,
+                                                          user.last_name,
+                                                          address.street.replace("\n", "<br/>"),
+                                                          address.zipcode,
+                                                          address.city,
+                                                          address.country or '',
+                                                          profile.company_id)
+        if profile.phonenumber:
+            self.user_header_content = u"%s%s<br/>" % (self.user_header_content, profile.phonenumber)
+        if profile.professional_email:
+            self.user_header_content = u"%s%s<br/>" % (self.user_header_content, profile.professional_email)
+
+        self.logo_data = None
+        if profile.logo_file:
+            logo_file = open("%s%s" % (settings.FILE_UPLOAD_DIR, profile.logo_file), 'rb')
+            try:
+                self.logo_data = logo_file.read()
+            finally:
+                logo_file.close()
+
+        if profile.register:
+            self.register_info = u'%s %s %s' % (profile.get_register_display(),
+                                                profile.registration_city,
+                                                profile.company_id[:9])
+        else:
+            self.register_info = u"Dispensé d'immatriculation au registre du commerce et des sociétés (RCS) et au répertoire des métiers (RM)"
+
+        self.vat_number = profile.vat_number
+        self.iban_bban = profile.iban_bban
+        self.bic = profile.bic
+
+    def get_logo(self):
+        if self.logo_data is None:
+            return None
+        return Image(StringIO(self.logo_data))
+
+def get_letterhead(user):
+    key = get_letterhead_cache_key(user)
+    letterhead = cache.get(key)
+    if letterhead is None:
+        letterhead = Letterhead(user)
+        cache.set(key, letterhead, LETTERHEAD_CACHE_TIMEOUT)
+    return letterhead
 
 class ProposalTemplate(object):
 
@@ -65,6 +155,7 @@ class ProposalTemplate(object):
     def __init__(self, response, user):
         self.response = response
         self.user = user
+        self.letterhead = get_letterhead(user)
         self.doc = None
         self.story = []
         self.space_before_footer = 0.55 * inch
@@ -77,23 +168,14 @@ class ProposalTemplate(object):
 
     def init_doc(self, title):
 
+        letterhead = self.letterhead
+
         def proposal_footer(canvas, doc):
             canvas.saveState()
             canvas.setFont('Helvetica', 10)
             PAGE_WIDTH = defaultPageSize[0]
-            footer_text = "%s %s - %s, %s %s" % (self.user.first_name,
-                                                 self.user.last_name,
-                                                 self.user.get_profile().address.street.replace("\n", ", ").replace("\r", ""),
-                                                 self.user.get_profile().address.zipcode,
-                                                 self.user.get_profile().address.city)
-            if self.user.get_profile().address.country:
-                footer_text = footer_text + u", %s" % (self.user.get_profile().address.country)
-
-            canvas.drawCentredString(PAGE_WIDTH / 2.0, 0.5 * inch, footer_text)
-            extra_info = u"SIRET : %s" % (self.user.get_profile().company_id)
-            if self.user.get_profile().vat_number:
-                extra_info = u"%s - N° TVA : %s" % (extra_info, self.user.get_profile().vat_number)
-            canvas.drawCentredString(PAGE_WIDTH / 2.0, 0.35 * inch, extra_info)
+            canvas.drawCentredString(PAGE_WIDTH / 2.0, 0.5 * inch, letterhead.footer_text)
+            canvas.drawCentredString(PAGE_WIDTH / 2.0, 0.35 * inch, letterhead.footer_extra_info)
             canvas.restoreState()
 
         self.doc = BaseDocTemplate(self.response, title=title, leftMargin=0.5 * inch, rightMargin=0.5 * inch)
@@ -103,26 +185,6 @@ class ProposalTemplate(object):
     def add_headers(self, proposal, customer, document_date):
 
         data = []
-        user_header_content = u"""
-        %s %s<br/>
-        %s<br/>
-        %s %s<br/>
-        %s<br/>
-        SIRET : %s<br/>
-        """
-        user_header_content = user_header_content % (self.user.first_name,
-                                                     self.user.last_name,
-                                                     self.user.get_profile().address.street.replace("\n", "<br/>"),
-                                                     self.user.get_profile().address.zipcode,
-                                                     self.user.get_profile().address.city,
-                                                     self.user.get_profile().address.country or '',
-                                                     self.user.get_profile().company_id)
-
-        if self.user.get_profile().phonenumber:
-            user_header_content = "%s%s<br/>" % (user_header_content, self.user.get_profile().phonenumber)
-        if self.user.get_profile().professional_email:
-            user_header_content = "%s%s<br/>" % (user_header_content, self.user.get_profile().professional_email)
-
         customer_header_content = u"""
         <br/><br/><br/><br/>
         %s<br/>
@@ -131,10 +193,9 @@ class ProposalTemplate(object):
         %s<br/>
         """
 
-        if self.user.get_profile().logo_file:
-            user_header = Image("%s%s" % (settings.FILE_UPLOAD_DIR, self.user.get_profile().logo_file))
-        else:
-            user_header = Paragraph(user_header_content, self.styleH)
+        user_header = self.letterhead.get_logo()
+        if user_header is None:
+            user_header = Paragraph(self.letterhead.user_header_content, self.styleH)
 
         data.append([user_header,
                     '',
@@ -148,7 +209,7 @@ class ProposalTemplate(object):
 
         table_style = [('VALIGN', (0, 0), (-1, -1), 'TOP'), ]
 
-        if self.user.get_profile().logo_file:
+        if self.letterhead.logo_data is not None:
             table_style.append(('TOPPADDING', (0, 0), (0, 0), 0))
             table_style.append(('LEFTPADDING', (0, 0), (0, 0), 0))
 
@@ -159,13 +220,7 @@ class ProposalTemplate(object):
         self.story.append(Spacer(self.doc.width, 0.25 * inch))
 
         data = []
-        if self.user.get_profile().register:
-            msg = u'%s %s %s' % (self.user.get_profile().get_register_display(),
-                                 self.user.get_profile().registration_city,
-                                 self.user.get_profile().company_id[:9])
-        else:
-            msg = u"Dispensé d'immatriculation au registre du commerce et des sociétés (RCS) et au répertoire des métiers (RM)"
-        data.append([Paragraph(msg, self.styleN),
+        data.append([Paragraph(self.letterhead.register_info, self.styleN),
                     '',
                     Paragraph("<br/>" + _("Date : %s") % (localize(document_date)), self.styleH2)])
 
@@ -207,12 +262,12 @@ class ProposalTemplate(object):
                 max_row_count = max_row_count + normal_page_count
 
         for i in range(max_row_count - row_count):
-            if self.user.get_profile().vat_number:
+            if self.letterhead.vat_number:
                 data.append(['', '', '', '', ''])
             else:
                 data.append(['', '', '', ''])
 
-        if self.user.get_profile().vat_number:
+        if self.letterhead.vat_number:
             row_table = Table(data, [4.2 * inch, 0.8 * inch, 0.9 * inch, 0.8 * inch, 0.5 * inch], (max_row_count + 1) * [0.3 * inch])
         else:
             row_table = Table(data, [4.7 * inch, 0.8 * inch, 0.9 * inch, 0.8 * inch], (max_row_count + 1) * [0.3 * inch])
@@ -228,7 +283,7 @@ class ProposalTemplate(object):
 
         row_style += extra_style
 
-        if self.user.get_profile().vat_number:
+        if self.letterhead.vat_number:
             row_style.append(('BOX', (4, 1), (4, -1), 0.25, colors.black))
 
         row_table.setStyle(TableStyle(row_style))
@@ -252,7 +307,7 @@ class ProposalTemplate(object):
         extra_style = []
         data = []
         data.append([ugettext('Label'), ugettext('Quantity'), ugettext('Unit price'), ugettext('Total excl tax')])
-        if self.user.get_profile().vat_number:
+        if self.letterhead.vat_number:
             data[0].append(ugettext('VAT'))
             label_width = 4.0 * inch
         else:
@@ -272,7 +327,7 @@ class ProposalTemplate(object):
             total = row.quantity * row.unit_price
             total = total.quantize(Decimal(1)) if total == total.to_integral() else total.normalize()
             data_row = [label, localize(quantity), "%s %s" % (localize(unit_price), "€".decode('utf-8')), "%s %s" % (localize(total), "€".decode('utf-8'))]
-            if self.user.get_profile().vat_number:
+            if self.letterhead.vat_number:
                 if row.vat_rate:
                     data_row.append("%s%%" % (localize(row.vat_rate)))
                 else:
@@ -281,7 +336,7 @@ class ProposalTemplate(object):
 
             for extra_row in splitted_para.lines[1:]:
                 label = self.get_splitted_content(extra_row)
-                if self.user.get_profile().vat_number:
+                if self.letterhead.vat_number:
                     data.append([label, '', '', '', ''])
                 else:
                     data.append([label, '', '', ''])
@@ -305,7 +360,7 @@ class ProposalTemplate(object):
     def get_total_amount(self, amount, rows):
         amount = amount.quantize(Decimal(1)) if amount == amount.to_integral() else amount.normalize()
 
-        if self.user.get_profile().vat_number:
+        if self.letterhead.vat_number:
             total_amount = [Paragraph(_("Total excl tax : %(amount)s %(currency)s") % {'amount': localize(amount), 'currency' : "€".decode('utf-8')}, ProposalTemplate.styleN)]
             vat_amounts = {}
             for row in rows:
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Disk cache of rendered proposals and invoices.
+
+A document is stored under the upload dir of its owner with a name computed
+from everything used to render it, so a stale entry can't be served: any
+change of the document, its rows, its customer or the user letterhead gives
+a new name. Old entries are evicted, least recently downloaded first, when
+the cache of a user grows over PDF_CACHE_SIZE bytes.
+"""
+import errno
+import hashlib
+import os
+import tempfile
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils import translation
+from django.utils.encoding import smart_str
+from project.utils.pdf import get_letterhead
+
+# change it when the layout of documents changes to ignore previous renderings
+PDF_CACHE_VERSION = '1'
+
+def get_pdf_cache_size():
+    return getattr(settings, 'PDF_CACHE_SIZE', 0)
+
+def get_pdf_cache_dir(user):
+    return "%s%s/%s" % (settings.FILE_UPLOAD_DIR, user.get_profile().uuid, 'pdf_cache')
+
+def get_field_values(obj):
+    if obj is None:
+        return None
+    return [(field.attname, unicode(getattr(obj, field.attname))) for field in obj._meta.fields]
+
+def get_pdf_cache_key(letterhead, objects):
+    content = hashlib.sha1()
+    content.update(PDF_CACHE_VERSION)
+    content.update(translation.get_language() or '')
+    letterhead_values = [(name, value) for name, value in sorted(letterhead.__dict__.items()) if name != 'logo_data']
+    content.update(smart_str(repr(letterhead_values)))
+    content.update(hashlib.sha1(letterhead.logo_data or '').hexdigest())
+    for obj in objects:
+        content.update(smart_str(repr(get_field_values(obj))))
+    return content.hexdigest()
+
+def evict_pdf_cache(cache_dir, max_size, keep=None):
+    entries = []
+    for filename in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort(reverse=True)
+    size = 0
+    for mtime, file_size, path in entries:
+        size = size + file_size
+        if size > max_size and path != keep:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def render_pdf(user, document, path):
+    content = HttpResponse()
+    document.to_pdf(user, content)
+    cache_dir = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+    try:
+        os.write(fd, content.content)
+    finally:
+        os.close(fd)
+    os.rename(tmp_path, path)
+
+def pdf_download_response(user, document):
+    """
+    Returns a response for the pdf of document, an invoice or a proposal.
+    When PDF_CACHE_SIZE is set, the document is rendered once in the cache
+    and served through X-Sendfile
+    """
+    response = HttpResponse(mimetype='application/pdf')
+    max_size = get_pdf_cache_size()
+    if not max_size:
+        document.to_pdf(user, response)
+        return response
+
+    cache_dir = get_pdf_cache_dir(user)
+    try:
+        os.makedirs(cache_dir)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+    key = get_pdf_cache_key(get_letterhead(user), document.get_pdf_cache_objects())
+    path = os.path.join(cache_dir, '%s.pdf' % (key))
+    if os.path.exists(path):
+        os.utime(path, None)
+    else:
+        render_pdf(user, document, path)
+        evict_pdf_cache(cache_dir, max_size, keep=path)
+
+    response['Content-Disposition'] = 'attachment; filename=%s' % (document.get_pdf_filename())
+    response['X-Sendfile'] = path
+    return response
@@ -5,7 +5,8 @@ from django.db.transaction import commit_on_success, rollback
 from django.shortcuts import get_object_or_404, redirect, render_to_response
 from project.models import Project, PROJECT_STATE_STARTED, Proposal, ProposalRow, \
     Contract, PROJECT_STATE_FINISHED, \
-    ProposalAmountError, PROPOSAL_STATE_SENT, CatalogItem, CatalogSection
+    ProposalAmountError, PROPOSAL_STATE_SENT, CatalogItem, CatalogSection, \
+    batch_edit
 from django.contrib import messages
 from django.core.urlresolvers import reverse
 from django.template.context import RequestContext
@@ -19,6 +20,7 @@ from django.http import HttpResponse
 from django.utils import simplejson
 from accounts.models import Invoice
 from core.decorators import settings_required
+from project.utils.pdf_cache import pdf_download_response
 from autoentrepreneur.decorators import subscription_required
 import datetime
 from django.utils.encoding import smart_str
@@ -61,8 +63,7 @@ def contract_create_or_edit(request, id=None, contact_id=None):
             if request.FILES:
                 try:
                     if old_file:
-                        if os.path.exists(old_file.path):
-                            os.remove(old_file.path)
+                        old_file.storage.delete(old_file.name)
                 except:
                     pass
             user = request.user
@@ -378,8 +379,7 @@ def proposal_create_or_edit(request, id=None, project_id=None):
             if request.FILES:
                 try:
                     if old_file:
-                        if os.path.exists(old_file.path):
-                            os.remove(old_file.path)
+                        old_file.storage.delete(old_file.name)
                 except:
                     pass
             try:
@@ -389,14 +389,15 @@ def proposal_create_or_edit(request, id=None, project_id=None):
                 proposal.save(user=user)
 
                 proposalForm.save_m2m()
-                for proposalrowform in proposalrowformset.forms:
-                    if proposalrowform not in proposalrowformset.deleted_forms and proposalrowform.cleaned_data:
-                        proposalrow = proposalrowform.save(commit=False)
-                        proposalrow.proposal = proposal
-                        proposalrow.save(user=user)
+                with batch_edit():
+                    for proposalrowform in proposalrowformset.forms:
+                        if proposalrowform not in proposalrowformset.deleted_forms and proposalrowform.cleaned_data:
+                            proposalrow = proposalrowform.save(commit=False)
+                            proposalrow.proposal = proposal
+                            proposalrow.save(user=user)
 
-                for deleted_proposalrowform in proposalrowformset.deleted_forms:
-                    deleted_proposalrowform.instance.delete()
+                    for deleted_proposalrowform in proposalrowformset.deleted_forms:
+                        deleted_proposalrowform.instance.delete()
 
                 proposal.update_amount()
 
@@ -487,9 +488,7 @@ def proposal_download(request, id):
     user = request.user
     proposal = get_object_or_404(Proposal, pk=id, owner=user)
 
-    response = HttpResponse(mimetype='application/pdf')
-    proposal.to_pdf(user, response)
-    return response
+    return pdf_download_response(user, proposal)
 
 @settings_required
 @subscription_required